@@ -1,10 +1,14 @@
 import axios from "axios";
 import fs from "fs";
+import zlib from "zlib";
 import vscode from "vscode";
 import { BaseComponent } from "./base-component";
 
 // const regPortInfo = /PORT:[0-9]+/;
 
+// Request bodies larger than this are sent gzip-compressed
+const COMPRESS_MIN_LENGTH = 64 * 1024;
+
 class ModelServerProcess extends BaseComponent{
     constructor() {
         super();
@@ -31,10 +35,18 @@ class ModelServerProcess extends BaseComponent{
         console.log("[ModelServer] Sending to ${this.toURL(urlPath)}");
         console.log("[ModelServer] Sending request:");
         console.log(jsonObject);
-        const response = await axios.post(this.toURL(urlPath), jsonObject, {
-            headers: {
-                "Content-Type": "application/json",
-            },
+        let body = JSON.stringify(jsonObject);
+        const headers = {
+            "Content-Type": "application/json",
+            // lets the server drop stale requests of this window
+            "X-Session-Id": vscode.env.sessionId,
+        };
+        if (body.length > COMPRESS_MIN_LENGTH) {
+            body = zlib.gzipSync(body);
+            headers["Content-Encoding"] = "gzip";
+        }
+        const response = await axios.post(this.toURL(urlPath), body, {
+            headers: headers,
             timeout: 300000
         });
         if (response.statusText === "OK") {
@@ -85,7 +97,13 @@ async function queryGenerator(json_obj) {
     // return await MockBackend.delayedResponse("gen");
 }
 
+// The server answers 409 to a request replaced by a newer one of this window
+function isSuperseded(err) {
+    return axios.isAxiosError(err) && err.response?.status === 409;
+}
+
 export {
+    isSuperseded,
     queryDiscriminator,
     queryLocator,
     queryGenerator
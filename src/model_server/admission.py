@@ -0,0 +1,218 @@
+import math
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+from metrics import Counter, Histogram, register_collector
+
+# Defaults, overridden by the [admission] section of server.ini
+ENABLED = True
+SLOTS = 3
+RESERVED_SLOTS = 1
+MAX_QUEUED = 32
+MAX_WAIT_SECONDS = 30
+# lower runs first
+PRIORITIES = {'generator': 0, 'locator': 1, 'discriminator': 2}
+
+# lines per window, as cut by each model's interface
+LOCATOR_WINDOW_LINES = 10
+DISCRIMINATOR_WINDOW_LINES = 30
+
+rejections = Counter(
+    'coedpilot_admission_rejections_total', 'Requests turned away by admission control.',
+    ('role', 'reason'))
+queue_seconds = Histogram(
+    'coedpilot_admission_wait_seconds', 'Time a request waited for a slot.', ('role',))
+
+
+class Rejected(Exception):
+    """The server is too busy for this request. `status` is 429 or 503."""
+
+    def __init__(self, status, message, retry_after=1):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def estimate_cost(model_role, json_input):
+    '''
+    Estimate the work of a request before running it, from its file, line
+    and window counts. The cost is in model windows, comparable across roles.
+    '''
+    if model_role == 'generator':
+        # one window around the edit, decoded by beam search
+        return {"files": 1, "lines": len(json_input.get("atLines", [])), "windows": 1, "cost": 1}
+    files = json_input.get("files", [])
+    lines = [content.count('\n') + 1 for _, content in files]
+    if model_role == 'locator':
+        windows = sum(math.ceil(count / LOCATOR_WINDOW_LINES) for count in lines)
+        cost = windows
+    else:
+        # an embedding per window plus the hunk, and the dependency analyzer per file
+        windows = sum(count // DISCRIMINATOR_WINDOW_LINES + 1 for count in lines)
+        cost = windows + 2 * len(files)
+    return {"files": len(files), "lines": sum(lines), "windows": windows, "cost": cost}
+
+
+class Ticket:
+    def __init__(self, model_role, priority, cost, seq):
+        self.model_role = model_role
+        self.priority = priority
+        self.cost = cost
+        self.seq = seq
+        self.granted = False
+
+    def order(self):
+        # priority class first, shortest job first inside a class, then arrival
+        return (self.priority, self.cost, self.seq)
+
+
+class Scheduler:
+    """
+        Let at most `slots` predict calls run at once. The others wait in a
+        queue bounded per role by `max_queued` (429 beyond it) for at most
+        `max_wait` seconds (503 after it). A freed slot goes to the waiting
+        request of the highest priority class, and within a class to the one
+        with the lowest estimated cost. `reserved` slots are only used by the
+        first class (priority 0), so it never waits behind long jobs.
+    """
+
+    def __init__(self, slots, reserved, max_queued, max_wait, priorities):
+        self.slots = max(1, slots)
+        self.reserved = min(max(0, reserved), self.slots - 1)
+        self.max_queued = max_queued  # role -> limit
+        self.max_wait = max_wait
+        self.priorities = priorities
+        self._waiting = []
+        self._queued = dict()
+        self._running = 0
+        self._running_low = 0  # slots held by priority > 0
+        self._seq = 0
+        self._cond = threading.Condition()
+
+    def _can_run(self, ticket):
+        if self._running >= self.slots:
+            return False
+        return ticket.priority == 0 or self._running_low < self.slots - self.reserved
+
+    def _grant(self, ticket):
+        ticket.granted = True
+        self._running += 1
+        if ticket.priority > 0:
+            self._running_low += 1
+
+    def _dispatch(self):
+        for ticket in sorted(self._waiting, key=Ticket.order):
+            if self._can_run(ticket):
+                self._waiting.remove(ticket)
+                self._queued[ticket.model_role] -= 1
+                self._grant(ticket)
+        self._cond.notify_all()
+
+    def _leave(self, ticket):
+        self._waiting.remove(ticket)
+        self._queued[ticket.model_role] -= 1
+
+    @contextmanager
+    def admit(self, model_role, cost, token=None):
+        '''Wait for a slot, raising Rejected if the queue is full or the wait too long.'''
+        start_time = time.perf_counter()
+        with self._cond:
+            self._seq += 1
+            ticket = Ticket(model_role, self.priorities.get(model_role, len(self.priorities)),
+                            cost, self._seq)
+            if self._can_run(ticket) and not any(
+                    it.order() < ticket.order() for it in self._waiting):
+                self._grant(ticket)
+            else:
+                limit = self.max_queued.get(model_role, MAX_QUEUED)
+                if self._queued.get(model_role, 0) >= limit:
+                    rejections.inc(model_role, 'queue_full')
+                    raise Rejected(
+                        429, f'Too many queued {model_role} requests ({limit}).')
+                self._waiting.append(ticket)
+                self._queued[model_role] = self._queued.get(model_role, 0) + 1
+            deadline = start_time + self.max_wait
+            while not ticket.granted:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    self._leave(ticket)
+                    rejections.inc(model_role, 'timeout')
+                    raise Rejected(
+                        503, f'No slot for {model_role} within {self.max_wait}s.',
+                        retry_after=math.ceil(self.max_wait))
+                if token is not None and token.cancelled:
+                    self._leave(ticket)
+                    token.check()
+                # cancellation doesn't notify us, so look again now and then
+                self._cond.wait(min(remaining, 0.1))
+        queue_seconds.observe(model_role, value=time.perf_counter() - start_time)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._running -= 1
+                if ticket.priority > 0:
+                    self._running_low -= 1
+                self._dispatch()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "slots": self.slots,
+                "reserved": self.reserved,
+                "running": self._running,
+                "queued": dict(self._queued)
+            }
+
+
+scheduler = None
+
+
+def configure(config):
+    global ENABLED, SLOTS, RESERVED_SLOTS, MAX_QUEUED, MAX_WAIT_SECONDS, scheduler
+    max_queued = dict()
+    if config.has_section('admission'):
+        section = config['admission']
+        ENABLED = section.getboolean('Enabled', ENABLED)
+        SLOTS = section.getint('Slots', SLOTS)
+        RESERVED_SLOTS = section.getint('ReservedSlots', RESERVED_SLOTS)
+        MAX_QUEUED = section.getint('MaxQueued', MAX_QUEUED)
+        MAX_WAIT_SECONDS = section.getfloat('MaxWaitSeconds', MAX_WAIT_SECONDS)
+        # per-role overrides live in sections named `admission.<role>`
+        for name in config.sections():
+            if name.startswith('admission.'):
+                role = name[len('admission.'):]
+                PRIORITIES[role] = config[name].getint('Priority', PRIORITIES.get(role, 0))
+                max_queued[role] = config[name].getint('MaxQueued', MAX_QUEUED)
+    scheduler = Scheduler(SLOTS, RESERVED_SLOTS, max_queued, MAX_WAIT_SECONDS, PRIORITIES) \
+        if ENABLED else None
+
+
+def get_scheduler():
+    global scheduler
+    if scheduler is None and ENABLED:
+        scheduler = Scheduler(SLOTS, RESERVED_SLOTS, dict(), MAX_WAIT_SECONDS, PRIORITIES)
+    return scheduler
+
+
+def admit(model_role, json_input, token=None):
+    '''Context manager holding a slot while a request runs, a no-op when admission control is off.'''
+    current = get_scheduler()
+    if current is None:
+        return nullcontext()
+    cost = estimate_cost(model_role, json_input)
+    print(f"+++ {model_role} cost estimate: {cost}")
+    return current.admit(model_role, cost["cost"], token)
+
+
+def collect_queued():
+    if scheduler is None:
+        return []
+    stats = scheduler.stats()
+    return [('coedpilot_admission_queued', 'gauge', 'Requests waiting for a slot.',
+             [({"role": role}, count) for role, count in stats["queued"].items()]),
+            ('coedpilot_admission_running', 'gauge', 'Predict calls holding a slot.',
+             [({}, stats["running"])])]
+
+
+register_collector(collect_queued)
@@ -0,0 +1,291 @@
+# Run the encoder-only graphs through ONNX Runtime or TorchScript.
+#
+# Usage: python backends.py LANGUAGE [ROLE ...] [--format onnx|torchscript]
+# Example: python backends.py python locator embedding --format onnx
+#
+# The locator at inference (encoder, dense, tanh, lm_head), the embedding
+# model (encoder, CLS vector) and the dependency analyzer (encoder, pooler,
+# dense) are exported with their post-processing folded in, so only small
+# tensors leave the graph. The exported graph goes to
+# models/<language>/<role>_export, and the server uses it when [backend]
+# names its format. Otherwise, or when the export is missing or stale,
+# PyTorch eager runs as before. The generator's beam search stays in PyTorch.
+
+import os
+import sys
+import json
+import argparse
+
+# Defaults, overridden by the [backend] section of server.ini
+BACKEND = 'torch'  # or 'onnx' or 'torchscript'
+THREADS = 0  # ONNX Runtime intra-op threads, 0 for its default
+# model role -> backend, from the [backend.<role>] sections
+ROLE_BACKENDS = dict()
+
+ROLES = ['locator', 'embedding', 'dependency']
+FORMATS = ['onnx', 'torchscript']
+META_FILE = 'export.json'
+GRAPH_FILES = {
+    'onnx': 'graph.onnx',
+    'torchscript': 'graph.pt'
+}
+OUTPUT_NAMES = {
+    'locator': ['label_ids', 'confidences'],
+    'embedding': ['embeddings'],
+    'dependency': ['scores']
+}
+
+
+def configure(config):
+    global BACKEND, THREADS
+    if config.has_section('backend'):
+        section = config['backend']
+        BACKEND = section.get('Backend', BACKEND).strip().lower()
+        THREADS = section.getint('Threads', THREADS)
+    for model_role in ROLES:
+        name = f'backend.{model_role}'
+        if config.has_section(name) and 'Backend' in config[name]:
+            ROLE_BACKENDS[model_role] = config[name].get('Backend').strip().lower()
+
+
+def get_backend(model_role):
+    return ROLE_BACKENDS.get(model_role, BACKEND)
+
+
+def get_export_dir(model_role, language):
+    import model_manager
+    return os.path.join(model_manager.BASE_DIR, language, f'{model_role}_export')
+
+
+def build_graph(model_role, model):
+    '''The inference graph of a role as an nn.Module of (input_ids, attention_mask).'''
+    import torch
+    import torch.nn as nn
+
+    class LocatorGraph(nn.Module):
+        """Label id and softmax confidence at every position."""
+
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask):
+            lm_logits = self.model(
+                source_ids=input_ids, source_mask=attention_mask, train=False)
+            confidences, label_ids = torch.softmax(lm_logits, dim=-1).max(dim=-1)
+            return label_ids, confidences
+
+    class EmbeddingGraph(nn.Module):
+        """The CLS embedding of each row."""
+
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask):
+            return self.model(input_ids, attention_mask)[0][:, 0, :]
+
+    class DependencyGraph(nn.Module):
+        """The dependency score of each row."""
+
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask):
+            return torch.sigmoid(self.model(input_ids, attention_mask))[:, 1]
+
+    graphs = {
+        'locator': LocatorGraph,
+        'embedding': EmbeddingGraph,
+        'dependency': DependencyGraph
+    }
+    return graphs[model_role](model).eval()
+
+
+class EagerRunner:
+    """Runs the graph in PyTorch on the model's device."""
+
+    def __init__(self, graph, device):
+        self.graph = graph
+        self.device = device
+
+    def __call__(self, input_ids, attention_mask):
+        import torch
+        with torch.no_grad():
+            outputs = self.graph(input_ids.to(self.device), attention_mask.to(self.device))
+        if not isinstance(outputs, tuple):
+            outputs = (outputs,)
+        return tuple(output.cpu() for output in outputs)
+
+
+class TorchScriptRunner:
+    """Runs a frozen TorchScript graph on the CPU."""
+
+    def __init__(self, path):
+        import torch
+        self.module = torch.jit.load(path, map_location='cpu')
+
+    def __call__(self, input_ids, attention_mask):
+        import torch
+        with torch.no_grad():
+            outputs = self.module(input_ids, attention_mask)
+        if not isinstance(outputs, tuple):
+            outputs = (outputs,)
+        return outputs
+
+
+class OnnxRunner:
+    """Runs an ONNX graph in ONNX Runtime on the CPU, with all graph optimizations."""
+
+    def __init__(self, path, threads=0):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.inter_op_num_threads = 1
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(
+            path, options, providers=['CPUExecutionProvider'])
+
+    def __call__(self, input_ids, attention_mask):
+        import torch
+        outputs = self.session.run(None, {
+            "input_ids": input_ids.numpy(),
+            "attention_mask": attention_mask.numpy()
+        })
+        return tuple(torch.from_numpy(output) for output in outputs)
+
+
+def read_metadata(directory):
+    with open(os.path.join(directory, META_FILE), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def get_runner(model_role, language, model, device):
+    '''
+    The runner of a role's graph: the exported one if [backend] asks for it
+    and an export of the loaded checkpoint exists, or else PyTorch eager.
+    Called once per batcher, so once per loaded model.
+    '''
+    import model_manager
+    backend = get_backend(model_role)
+    if backend == 'torch':
+        return EagerRunner(build_graph(model_role, model), device)
+    directory = get_export_dir(model_role, language)
+    try:
+        meta = read_metadata(directory)
+    except (OSError, ValueError):
+        meta = dict()
+    version = model_manager.get_model_version(model_role, language)
+    if meta.get("format") != backend or meta.get("source") != version:
+        print(f"+++ No {backend} export of {model_role} for {language}, using PyTorch. "
+              f"Run: python backends.py {language} {model_role} --format {backend}")
+        return EagerRunner(build_graph(model_role, model), device)
+    path = os.path.join(directory, GRAPH_FILES[backend])
+    try:
+        runner = OnnxRunner(path, THREADS) if backend == 'onnx' else TorchScriptRunner(path)
+    except (ImportError, RuntimeError, OSError) as err:
+        print(f"+++ Can't load the {backend} export of {model_role}, using PyTorch: {err}")
+        return EagerRunner(build_graph(model_role, model), device)
+    print(f"+++ Model type: {model_role} for language: {language} runs on {backend}")
+    return runner
+
+
+def sample_inputs(batch_size=2, length=16, vocab_size=100):
+    import torch
+    generator = torch.Generator().manual_seed(0)
+    # clear of the special token ids
+    input_ids = torch.randint(5, vocab_size, (batch_size, length), generator=generator)
+    attention_mask = torch.ones(batch_size, length, dtype=torch.long)
+    attention_mask[1, length // 2:] = 0
+    return input_ids, attention_mask
+
+
+def export(model_role, model, directory, export_format, source_version):
+    '''Export a role's graph of a model loaded on the CPU.'''
+    import torch
+    graph = build_graph(model_role, model)
+    inputs = sample_inputs()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, GRAPH_FILES[export_format])
+    if export_format == 'onnx':
+        dynamic_axes = {"input_ids": {0: 'batch', 1: 'length'},
+                        "attention_mask": {0: 'batch', 1: 'length'}}
+        for name in OUTPUT_NAMES[model_role]:
+            dynamic_axes[name] = {0: 'batch', 1: 'length'} if model_role == 'locator' \
+                else {0: 'batch'}
+        with torch.no_grad():
+            torch.onnx.export(
+                graph, inputs, path, input_names=['input_ids', 'attention_mask'],
+                output_names=OUTPUT_NAMES[model_role], dynamic_axes=dynamic_axes,
+                opset_version=14, do_constant_folding=True)
+    else:
+        with torch.no_grad():
+            traced = torch.jit.trace(graph, inputs)
+            module = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+        torch.jit.save(module, path)
+    with open(os.path.join(directory, META_FILE), 'w', encoding='utf-8') as f:
+        json.dump({"role": model_role, "format": export_format, "source": source_version},
+                  f, indent=4)
+    return graph
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the encoder graphs for ONNX Runtime or TorchScript.')
+    parser.add_argument('language')
+    parser.add_argument('roles', nargs='*', default=ROLES, help=f'default all: {", ".join(ROLES)}')
+    parser.add_argument('--format', choices=FORMATS, default='onnx')
+    parser.add_argument('--fixtures', action='store_true',
+                        help='export small random models instead of the checkpoints')
+    args = parser.parse_args()
+
+    unknown = [model_role for model_role in args.roles if model_role not in ROLES]
+    if unknown:
+        parser.error(f'unknown roles: {unknown}')
+    import torch
+    import configparser
+    import fixtures
+    import model_manager
+    from locator.interface import load_model as load_locator
+    from discriminator.interface import load_model as load_embedding, load_dependency_analyzer
+    from snapshot import split_model_info
+    # export what the server would load
+    config = configparser.ConfigParser()
+    config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.ini'))
+    fixtures.configure(config)
+    model_manager.configure(config)
+    if args.fixtures:
+        fixtures.ENABLED = True
+    loaders = {
+        'locator': load_locator,
+        'embedding': load_embedding,
+        'dependency': load_dependency_analyzer
+    }
+    for model_role in args.roles:
+        # the dependency analyzer is shared by all languages
+        role_language = 'all' if model_role == 'dependency' else args.language
+        directory = get_export_dir(model_role, role_language)
+        print(f'>>> Exporting {model_role} for {role_language} as {args.format} to {directory}')
+        model_info = model_manager.load_model_with_cache(
+            model_role, role_language, loaders[model_role])
+        model = split_model_info(model_role, model_info)[0].to('cpu')
+        graph = export(model_role, model, directory, args.format,
+                       model_manager.get_model_version(model_role, role_language))
+
+        # the export must answer like eager, also for other shapes than it was traced with
+        path = os.path.join(directory, GRAPH_FILES[args.format])
+        runner = OnnxRunner(path) if args.format == 'onnx' else TorchScriptRunner(path)
+        inputs = sample_inputs(batch_size=3, length=24)
+        expected = EagerRunner(graph, torch.device('cpu'))(*inputs)
+        for name, a, b in zip(OUTPUT_NAMES[model_role], expected, runner(*inputs)):
+            difference = (a.float() - b.float()).abs().max().item()
+            print(f'>>> {name}: max difference {difference:.2e}')
+            if difference > 1e-3 and name != 'label_ids':
+                print(f'+++ {name} differs from PyTorch')
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
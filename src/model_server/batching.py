@@ -0,0 +1,319 @@
+import os
+import threading
+import time
+from collections import deque
+from cancellation import RequestCancelled, current_token
+from metrics import register_collector
+import tracing
+
+# Defaults, overridden by the [batching] section of server.ini
+ENABLED = True
+MAX_BATCH_SIZE = 16
+MAX_WAIT_MS = 5
+LENGTH_BUCKETS = [64, 128, 256]  # token lengths, empty for one bucket
+
+batcher_cache = dict()
+batcher_cache_lock = threading.Lock()
+role_settings = dict()
+all_batchers = []
+
+
+def configure(config):
+    '''
+    Read batching settings from a ConfigParser. Per-role overrides live in
+    sections named `batching.<role>`, e.g. `[batching.generator]`.
+    '''
+    global ENABLED, MAX_BATCH_SIZE, MAX_WAIT_MS, LENGTH_BUCKETS
+    if not config.has_section('batching'):
+        return
+    section = config['batching']
+    ENABLED = section.getboolean('Enabled', ENABLED)
+    MAX_BATCH_SIZE = section.getint('MaxBatchSize', MAX_BATCH_SIZE)
+    MAX_WAIT_MS = section.getfloat('MaxWaitMs', MAX_WAIT_MS)
+    if 'LengthBuckets' in section:
+        LENGTH_BUCKETS = sorted(int(it) for it in section['LengthBuckets'].split(',') if it.strip())
+    for name in config.sections():
+        if name.startswith('batching.'):
+            role = name[len('batching.'):]
+            role_settings[role] = (
+                config[name].getint('MaxBatchSize', MAX_BATCH_SIZE),
+                config[name].getfloat('MaxWaitMs', MAX_WAIT_MS)
+            )
+
+
+class PendingRequest:
+    """Rows submitted by one caller, waiting for their slice of results."""
+
+    def __init__(self, rows, token=None, trace=None):
+        self.rows = rows
+        self.token = token
+        self.trace = trace
+        self.results = [None] * len(rows)
+        self.next_row = 0
+        self.finished_rows = 0
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher:
+    """
+        Collect rows submitted by concurrent callers into shared batches.
+
+        Parameters:
+
+        * `name`- used to name the worker thread.
+        * `batch_fn`- called with a list of rows and the cancel token of each
+          row, returns one result per row.
+        * `max_batch_size`- max number of rows passed to `batch_fn` at once.
+        * `max_wait_ms`- how long the first queued row may wait for others.
+    """
+
+    def __init__(self, name, batch_fn, max_batch_size, max_wait_ms):
+        self.name = name
+        self.batch_fn = batch_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self._closed = False
+        self._start()
+        all_batchers.append(self)
+
+    def _start(self):
+        self._queue = deque()
+        self._queued_rows = 0
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run, name=f'batcher-{self.name}', daemon=True)
+        self._thread.start()
+
+    def queue_depth(self):
+        return self._queued_rows
+
+    def close(self):
+        """Stop the worker thread once the rows already queued are processed."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def submit(self, rows):
+        """Block until every row is processed, return results in row order."""
+        if len(rows) == 0:
+            return []
+        pending = PendingRequest(rows, current_token(), tracing.current_trace())
+        with self._cond:
+            self._queue.append(pending)
+            self._queued_rows += len(rows)
+            self._cond.notify()
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.results
+
+    def _collect(self):
+        with self._cond:
+            while len(self._queue) == 0:
+                if self._closed:
+                    return None
+                self._cond.wait()
+            deadline = time.perf_counter() + self.max_wait
+            while self._queued_rows < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            # a large request may be split across batches, and several small
+            # requests may share one
+            slices = []
+            taken = 0
+            while len(self._queue) > 0 and taken < self.max_batch_size:
+                pending = self._queue[0]
+                if pending.token is not None and pending.token.cancelled:
+                    # superseded while queued, skip the rest of its rows
+                    self._queue.popleft()
+                    self._queued_rows -= len(pending.rows) - pending.next_row
+                    pending.error = RequestCancelled(
+                        f'Request {pending.token.request_id} cancelled in queue')
+                    pending.done.set()
+                    continue
+                start = pending.next_row
+                end = min(len(pending.rows), start + self.max_batch_size - taken)
+                slices.append((pending, start, end))
+                pending.next_row = end
+                taken += end - start
+                if end == len(pending.rows):
+                    self._queue.popleft()
+            self._queued_rows -= taken
+        return slices
+
+    def _fail(self, pending, err):
+        with self._cond:
+            if pending in self._queue:
+                self._queue.remove(pending)
+                self._queued_rows -= len(pending.rows) - pending.next_row
+        pending.error = err
+        pending.done.set()
+
+    def _run(self):
+        while True:
+            slices = self._collect()
+            if slices is None:
+                return
+            slices = [it for it in slices if not it[0].done.is_set()]
+            if len(slices) == 0:
+                continue
+            rows = []
+            tokens = []
+            for pending, start, end in slices:
+                rows.extend(pending.rows[start:end])
+                tokens.extend([pending.token] * (end - start))
+            try:
+                traces = [pending.trace for pending, _, _ in slices]
+                with tracing.activate(traces):
+                    with tracing.span(f'{self.name} batch', rows=len(rows), requests=len(slices)):
+                        outputs = self.batch_fn(rows, tokens)
+            except Exception as err:
+                for pending, _, _ in slices:
+                    if not pending.done.is_set():
+                        self._fail(pending, err)
+                continue
+
+            offset = 0
+            for pending, start, end in slices:
+                pending.results[start:end] = outputs[offset:offset + end - start]
+                offset += end - start
+                pending.finished_rows += end - start
+                if pending.done.is_set():
+                    continue
+                if pending.token is not None and pending.token.cancelled:
+                    self._fail(pending, RequestCancelled(
+                        f'Request {pending.token.request_id} cancelled in batch'))
+                elif pending.finished_rows == len(pending.rows):
+                    pending.done.set()
+
+
+class DirectBatcher:
+    """Stand-in used when batching is disabled: runs rows on the caller thread."""
+
+    def __init__(self, batch_fn, max_batch_size):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max(1, max_batch_size)
+
+    def queue_depth(self):
+        return 0
+
+    def close(self):
+        pass
+
+    def submit(self, rows):
+        token = current_token()
+        results = []
+        for i in range(0, len(rows), self.max_batch_size):
+            if token is not None:
+                token.check()
+            chunk = rows[i:i + self.max_batch_size]
+            results.extend(self.batch_fn(chunk, [token] * len(chunk)))
+        if token is not None:
+            token.check()
+        return results
+
+
+def restart_after_fork():
+    '''Threads don't survive fork(), give every batcher a new worker thread in the child.'''
+    global batcher_cache_lock
+    batcher_cache_lock = threading.Lock()
+    for batcher in all_batchers:
+        batcher._start()
+
+
+os.register_at_fork(after_in_child=restart_after_fork)
+
+
+def collect_queue_depth():
+    with batcher_cache_lock:
+        samples = [({"role": key[0], "language": key[1]}, batcher.queue_depth())
+                   for key, batcher in batcher_cache.items()]
+    return [('coedpilot_batcher_queue_rows', 'gauge',
+             'Rows waiting in a batcher queue.', samples)]
+
+
+register_collector(collect_queue_depth)
+
+
+def get_batcher(model_role, language, batch_fn_factory):
+    '''
+    Return the batcher shared by all requests for a role and language,
+    creating it with `batch_fn_factory()` on first use.
+    '''
+    key = (model_role, language)
+    with batcher_cache_lock:
+        if key not in batcher_cache:
+            max_batch_size, max_wait_ms = role_settings.get(
+                model_role, (MAX_BATCH_SIZE, MAX_WAIT_MS))
+            batch_fn = batch_fn_factory()
+            if ENABLED:
+                batcher_cache[key] = MicroBatcher(
+                    f'{model_role}-{language}', batch_fn, max_batch_size, max_wait_ms)
+            else:
+                batcher_cache[key] = DirectBatcher(batch_fn, max_batch_size)
+            print(
+                f"+++ Batcher for {model_role} ({language}) created, enabled: {ENABLED}")
+        return batcher_cache[key]
+
+
+def drop_batcher(model_role, language):
+    '''Stop and forget the batcher of a role and language, e.g. when its model is unloaded.'''
+    with batcher_cache_lock:
+        batcher = batcher_cache.pop((model_role, language), None)
+    if batcher is None:
+        return
+    batcher.close()
+    if batcher in all_batchers:
+        all_batchers.remove(batcher)
+
+
+def bucket_by_length(lengths):
+    '''
+    Group row indices by the smallest of LENGTH_BUCKETS that fits their
+    length, longer rows in a last bucket, each sorted by length.
+    '''
+    buckets = dict()
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        bucket = next((limit for limit in LENGTH_BUCKETS if lengths[i] <= limit), None)
+        buckets.setdefault(bucket, []).append(i)
+    return list(buckets.values())
+
+
+def run_bucketed(rows, lengths, run):
+    '''
+    Call `run` on the rows of each length bucket, so a long row doesn't pad
+    short ones to its length, and return the results in row order. Attention
+    costs grow with the square of the padded length.
+    '''
+    results = [None] * len(rows)
+    for indices in bucket_by_length(lengths):
+        outputs = run([rows[i] for i in indices])
+        for i, output in zip(indices, outputs):
+            results[i] = output
+    return results
+
+
+def submit_sorted(submit, rows, lengths):
+    '''
+    Submit rows sorted by length, so the batches they are split into hold
+    rows of similar length, and return the results in row order.
+    '''
+    order = sorted(range(len(rows)), key=lambda i: lengths[i])
+    outputs = submit([rows[i] for i in order])
+    results = [None] * len(rows)
+    for position, i in enumerate(order):
+        results[i] = outputs[position]
+    return results
+
+
+def trim_padding(source_ids, source_mask):
+    '''
+    Drop the trailing columns that are padding for every row of a batch, so a
+    batch of short inputs doesn't pay for the full max_length.
+    '''
+    width = max(1, int(source_mask.sum(dim=1).max().item()))
+    return source_ids[:, :width], source_mask[:, :width]
@@ -0,0 +1,362 @@
+# Micro-benchmarks of the hot stages of each model, at several input sizes.
+#
+# Usage: python benchmark.py [--stages NAME ...] [--output FILE] [--baseline FILE]
+# Example:
+#   python benchmark.py --output baseline.json
+#   python benchmark.py --baseline baseline.json --tolerance 0.15
+#
+# With --baseline, every stage is compared to the saved result on median time
+# and the exit status is 1 if any stage is slower by more than --tolerance.
+# Stages needing a checkpoint that isn't downloaded are reported as skipped,
+# or run with --fixtures on small random models (see [fixtures] in server.ini).
+
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import configparser
+import statistics
+import torch
+from torch.utils.data import DataLoader
+from locator import interface as locator_interface
+from generator import interface as generator_interface
+from generator.model import Beam
+from discriminator import interface as discriminator_interface
+from discriminator.siamese_net import load_siamese_data, evaluate_embedding_model, \
+    make_embedding_batch_fn, tokenize_request, embed_sorted, max_similarity
+from model_manager import load_model_with_cache, get_tokenizer
+import batching
+import fixtures
+import model_manager
+import quantization
+from batching import trim_padding
+
+COMMIT_MESSAGE = "Read the configuration from the environment"
+PREV_EDITS = [{
+    "beforeEdit": "    config = read_config(path)\n",
+    "afterEdit": "    config = read_config(os.environ.get('CONFIG', path))\n",
+    "codeAbove": "def main(path):\n",
+    "codeBelow": "    run(config)\n"
+}]
+
+STAGES = dict()  # name -> (setup function, sizes)
+
+
+def stage(name, sizes):
+    '''Register `setup(resources, size)`, which returns the function to time.'''
+    def register(setup):
+        STAGES[name] = (setup, sizes)
+        return setup
+    return register
+
+
+def synthetic_lines(count, seed=0):
+    '''Deterministic Python-like source lines.'''
+    rng = random.Random(seed)
+    templates = [
+        "def handler_{i}(request, config):\n",
+        "    value_{i} = compute(config[\"key_{i}\"], {n})\n",
+        "    if value_{i} > {n}:\n",
+        "        return {{\"status\": \"ok\", \"count\": value_{i} * {n}}}\n",
+        "    items_{i} = [item.name for item in request.items if item.size < {n}]\n",
+        "\n",
+    ]
+    return [rng.choice(templates).format(i=i, n=rng.randint(0, 1000)) for i in range(count)]
+
+
+class Resources:
+    """Tokenizers and models, loaded on first use and shared by the stages."""
+
+    def __init__(self, language):
+        self.language = language
+        self._tokenizer = None
+
+    def tokenizer(self):
+        if self._tokenizer is None:
+            self._tokenizer = fixtures.tokenizer() if fixtures.ENABLED else \
+                get_tokenizer("microsoft/codebert-base")
+        return self._tokenizer
+
+    def locator(self):
+        return load_model_with_cache(
+            locator_interface.MODEL_ROLE, self.language, locator_interface.load_model)
+
+    def generator(self):
+        return load_model_with_cache(
+            generator_interface.MODEL_ROLE, self.language, generator_interface.load_model)
+
+    def embedding(self):
+        return load_model_with_cache(
+            discriminator_interface.MODEL_ROLE, 'python', discriminator_interface.load_model)
+
+    def dependency(self):
+        return load_model_with_cache(
+            discriminator_interface.DEPENDENCY_ROLE, 'all',
+            discriminator_interface.load_dependency_analyzer)
+
+
+def locator_rows(tokenizer, windows):
+    lines = synthetic_lines(windows * locator_interface.CODE_WINDOW_LENGTH)
+    inputs = locator_interface.build_windows(lines, tokenizer, COMMIT_MESSAGE, PREV_EDITS)
+    examples = locator_interface.read_examples(inputs[:windows])
+    features = locator_interface.convert_examples_to_features(examples, tokenizer, stage='test')
+    source_ids = torch.tensor([f.source_ids for f in features], dtype=torch.long)
+    source_mask = torch.tensor([f.source_mask for f in features], dtype=torch.long)
+    return trim_padding(source_ids, source_mask)
+
+
+def generator_input(edits):
+    lines = synthetic_lines(2 * generator_interface.CONTEXT_LENGTH + 1)
+    at_line = generator_interface.CONTEXT_LENGTH
+    labels = ['replace' if i == at_line else 'keep' for i in range(len(lines))]
+    model_input = ''.join(' <mask> ' + line for line in lines) + ' </s> ' + COMMIT_MESSAGE
+    for prev_edit in PREV_EDITS * edits:
+        model_input += ' </s> remove ' + \
+            prev_edit["beforeEdit"] + ' add ' + prev_edit["afterEdit"]
+    return generator_interface.read_examples(model_input, labels)
+
+
+@stage('locator.build_windows', (100, 1000, 5000))
+def bench_build_windows(resources, lines):
+    tokenizer = resources.tokenizer()
+    file_lines = synthetic_lines(lines)
+    return lambda: locator_interface.build_windows(
+        file_lines, tokenizer, COMMIT_MESSAGE, PREV_EDITS)
+
+
+@stage('locator.convert_examples_to_features', (8, 64))
+def bench_locator_features(resources, windows):
+    tokenizer = resources.tokenizer()
+    lines = synthetic_lines(windows * locator_interface.CODE_WINDOW_LENGTH)
+    inputs = locator_interface.build_windows(lines, tokenizer, COMMIT_MESSAGE, PREV_EDITS)
+    examples = locator_interface.read_examples(inputs[:windows])
+    return lambda: locator_interface.convert_examples_to_features(
+        examples, tokenizer, stage='test')
+
+
+@stage('generator.convert_examples_to_features', (1, 8))
+def bench_generator_features(resources, prev_edits):
+    tokenizer = resources.tokenizer()
+    examples = generator_input(prev_edits)
+    return lambda: generator_interface.convert_examples_to_features(
+        examples, tokenizer, stage='test')
+
+
+@stage('locator.forward', (1, 8, 16))
+def bench_locator_forward(resources, batch_size):
+    model, tokenizer, device = resources.locator()
+    source_ids, source_mask = locator_rows(tokenizer, batch_size)
+    source_ids, source_mask = source_ids.to(device), source_mask.to(device)
+    model.eval()
+
+    def run():
+        with torch.no_grad():
+            return model(source_ids=source_ids, source_mask=source_mask, train=False)
+    return run
+
+
+@stage('generator.beam_advance', (32, 128))
+def bench_beam_advance(resources, steps):
+    # the bookkeeping of one beam, with random scores instead of the decoder
+    from generator.model import device
+    generator = torch.Generator().manual_seed(0)
+    vocab_size = 50265
+    word_lk = [torch.log_softmax(torch.randn(10, vocab_size, generator=generator), dim=-1).to(device)
+               for _ in range(4)]
+
+    def run():
+        beam = Beam(10, 0, 2)
+        for step in range(steps):
+            beam.advance(word_lk[step % len(word_lk)])
+        return beam.getHyp(beam.getFinal())
+    return run
+
+
+@stage('generator.decode', (1, 4))
+def bench_generator_decode(resources, batch_size):
+    model, tokenizer, device = resources.generator()
+    features = generator_interface.convert_examples_to_features(
+        generator_input(1), tokenizer, stage='test')
+    source_ids = torch.tensor([features[0].source_ids] * batch_size, dtype=torch.long)
+    source_mask = torch.tensor([features[0].source_mask] * batch_size, dtype=torch.long)
+    source_ids, source_mask = trim_padding(source_ids, source_mask)
+    source_ids, source_mask = source_ids.to(device), source_mask.to(device)
+    model.eval()
+
+    def run():
+        with torch.no_grad():
+            return model(source_ids=source_ids, source_mask=source_mask)
+    return run
+
+
+@stage('dependency.batch_gen', (8, 64))
+def bench_dependency(resources, pairs):
+    analyzer = resources.dependency()
+    hunk = ''.join([PREV_EDITS[0]["codeAbove"], PREV_EDITS[0]["beforeEdit"],
+                    PREV_EDITS[0]["codeBelow"]])
+    lines = synthetic_lines(pairs * 10)
+    windows = [''.join(lines[i:i + 10]) for i in range(0, len(lines), 10)]
+    corpus = analyzer.construct_corpus_pair([(hunk, window) for window in windows])
+    return lambda: analyzer.batch_gen(corpus)
+
+
+@stage('embedding.evaluate_embedding_model', (1, 8))
+def bench_embedding(resources, files):
+    model, tokenizer, device = resources.embedding()
+    hunk = {"code_window": [PREV_EDITS[0]["codeAbove"], PREV_EDITS[0]["beforeEdit"],
+                            PREV_EDITS[0]["codeBelow"]]}
+    dataset = [{
+        "hunk": hunk,
+        "file": ''.join(synthetic_lines(300, seed=i)),
+        "dependency_score": [0.5],
+        "label": 1
+    } for i in range(files)]
+    tensor_dataset = load_siamese_data(dataset, tokenizer, False)
+    dataloader = DataLoader(tensor_dataset, batch_size=1, shuffle=False)
+    return lambda: evaluate_embedding_model(model, dataloader, "test")
+
+
+@stage('embedding.request', (1, 8))
+def bench_embedding_request(resources, files):
+    '''The discriminator's path: the hunk once, all windows in length-sorted batches of 16.'''
+    model, tokenizer, device = resources.embedding()
+    batch_fn = make_embedding_batch_fn(model, device, 'python', tokenizer.pad_token_id)
+    hunk = ''.join([PREV_EDITS[0]["codeAbove"], PREV_EDITS[0]["beforeEdit"],
+                    PREV_EDITS[0]["codeBelow"]])
+    contents = [''.join(synthetic_lines(300, seed=i)) for i in range(files)]
+
+    def embed_rows(rows):
+        embeddings = []
+        for i in range(0, len(rows), 16):
+            embeddings.extend(batch_fn(rows[i:i + 16], [None] * len(rows[i:i + 16])))
+        return embeddings
+
+    def run():
+        rows, segments = tokenize_request(hunk, contents, tokenizer)
+        return max_similarity(embed_sorted(rows, embed_rows), segments, files)
+    return run
+
+
+def measure(run, repeat, warm_up):
+    for _ in range(warm_up):
+        run()
+    durations = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        run()
+        durations.append(time.perf_counter() - start_time)
+    return {
+        "medianMs": 1000 * statistics.median(durations),
+        "minMs": 1000 * min(durations),
+        "meanMs": 1000 * statistics.fmean(durations),
+        "runs": repeat
+    }
+
+
+def run_stages(names, language, repeat, warm_up):
+    resources = Resources(language)
+    results = dict()
+    for name in names:
+        setup, sizes = STAGES[name]
+        for size in sizes:
+            key = f'{name}[{size}]'
+            try:
+                run = setup(resources, size)
+            except (OSError, ValueError) as err:
+                # e.g. the checkpoint of this language isn't downloaded
+                print(f"+++ {key} skipped: {err}")
+                results[key] = {"skipped": str(err)}
+                continue
+            results[key] = measure(run, repeat, warm_up)
+            print(f"+++ {key}: {results[key]['medianMs']:.2f} ms")
+    return results
+
+
+def compare(results, baseline, tolerance):
+    '''Print each stage against the baseline, return the names of regressed stages.'''
+    regressions = []
+    print(f"\n{'stage':<50}{'baseline ms':>13}{'now ms':>10}{'ratio':>8}")
+    for key, result in results.items():
+        before = baseline.get(key)
+        if "medianMs" not in result or before is None or "medianMs" not in before:
+            continue
+        ratio = result["medianMs"] / before["medianMs"]
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  REGRESSION'
+            regressions.append(key)
+        elif ratio < 1 - tolerance:
+            flag = '  faster'
+        print(f"{key:<50}{before['medianMs']:>13.2f}{result['medianMs']:>10.2f}{ratio:>8.2f}{flag}")
+    return regressions
+
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "threads": torch.get_num_threads(),
+        "device": str(fixtures.get_device())
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the model server stages.')
+    parser.add_argument('--stages', nargs='*', default=list(STAGES.keys()),
+                        help=f'default all: {", ".join(STAGES.keys())}')
+    parser.add_argument('--language', default='python')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--warm-up', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=0, help='torch threads, 0 for the default')
+    parser.add_argument('--fixtures', action='store_true',
+                        help='use small random models instead of the checkpoints')
+    parser.add_argument('--output', help='write the results here as JSON')
+    parser.add_argument('--baseline', help='results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed slowdown of the median, as a fraction')
+    args = parser.parse_args()
+
+    unknown = [name for name in args.stages if name not in STAGES]
+    if unknown:
+        parser.error(f'unknown stages: {unknown}')
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    config = configparser.ConfigParser()
+    config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.ini'))
+    batching.configure(config)
+    model_manager.configure(config)
+    fixtures.configure(config)
+    quantization.configure(config)
+    fixtures.ENABLED = args.fixtures
+
+    report = {
+        "environment": environment(),
+        "models": fixtures.version() if fixtures.ENABLED else 'checkpoints',
+        "language": args.language,
+        "results": run_stages(args.stages, args.language, args.repeat, args.warm_up)
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get("models") != report["models"]:
+            print(f"+++ The baseline was measured with models {baseline.get('models')}")
+        if baseline.get("environment") != report["environment"]:
+            print("+++ The baseline was measured in another environment:")
+            print(f"    {baseline.get('environment')}")
+        regressions = compare(report["results"], baseline["results"], args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} stage(s) slower than the baseline")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import threading
+from contextlib import contextmanager
+
+
+class RequestCancelled(Exception):
+    """Raised at a checkpoint once a newer request has superseded this one."""
+    pass
+
+
+class CancelToken:
+    def __init__(self, session_id=None, request_id=None):
+        self.session_id = session_id
+        self.request_id = request_id
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def check(self):
+        if self.cancelled:
+            raise RequestCancelled(
+                f'Request {self.request_id} of session {self.session_id} is superseded')
+
+
+class GroupToken:
+    """
+        Token of a computation shared by several requests: cancelled only
+        once every participant's own token is cancelled.
+    """
+
+    def __init__(self):
+        self.tokens = []
+        self._lock = threading.Lock()
+
+    def add(self, token):
+        with self._lock:
+            self.tokens.append(token)
+
+    @property
+    def request_id(self):
+        return ','.join(str(token.request_id) for token in self.tokens)
+
+    @property
+    def session_id(self):
+        return ','.join(str(token.session_id) for token in self.tokens)
+
+    @property
+    def cancelled(self):
+        with self._lock:
+            return len(self.tokens) > 0 and all(token.cancelled for token in self.tokens)
+
+    def check(self):
+        if self.cancelled:
+            raise RequestCancelled(
+                f'Requests {self.request_id} are all superseded')
+
+
+# (session id, predict name) -> token of the newest request
+active_tokens = dict()
+active_tokens_lock = threading.Lock()
+thread_state = threading.local()
+
+
+def begin(session_id, predict_name, request_id=None):
+    '''
+    Register a new request and make its token current for this thread. An
+    older request of the same session and predict name is cancelled.
+    '''
+    token = CancelToken(session_id, request_id)
+    if session_id is not None:
+        key = (session_id, predict_name)
+        with active_tokens_lock:
+            previous = active_tokens.get(key)
+            active_tokens[key] = token
+        if previous is not None:
+            print(
+                f"+++ Request {previous.request_id} of session {session_id} superseded by {request_id}")
+            previous.cancel()
+    thread_state.token = token
+    return token
+
+
+def end(predict_name, token):
+    if token.session_id is not None:
+        key = (token.session_id, predict_name)
+        with active_tokens_lock:
+            if active_tokens.get(key) is token:
+                del active_tokens[key]
+    thread_state.token = None
+
+
+def current_token():
+    return getattr(thread_state, 'token', None)
+
+
+def checkpoint():
+    '''Raise RequestCancelled if the request running on this thread is superseded.'''
+    token = current_token()
+    if token is not None:
+        token.check()
+
+
+@contextmanager
+def use_token(token):
+    '''Make `token` current for this thread inside the block, e.g. a GroupToken.'''
+    previous = current_token()
+    thread_state.token = token
+    try:
+        yield token
+    finally:
+        thread_state.token = previous
@@ -0,0 +1,47 @@
+import os
+import json
+import time
+import threading
+
+# Defaults, overridden by the [capture] section of server.ini
+PATH = ''  # empty to disable
+MAX_REQUESTS = 10000
+
+lock = threading.Lock()
+captured = 0
+
+
+def configure(config):
+    global PATH, MAX_REQUESTS
+    if not config.has_section('capture'):
+        return
+    section = config['capture']
+    PATH = section.get('Path', PATH)
+    MAX_REQUESTS = section.getint('MaxRequests', MAX_REQUESTS)
+    if PATH and os.path.dirname(PATH):
+        os.makedirs(os.path.dirname(PATH), exist_ok=True)
+
+
+def record(endpoint, json_input, session_id=None):
+    '''
+    Append a predict request to the capture log, for replay with loadtest.py.
+    Workspace references are already resolved into `files` and
+    `targetFileContent` and are left out, so the log is self-contained.
+    '''
+    global captured
+    if not PATH:
+        return
+    body = {key: value for key, value in json_input.items()
+            if key not in ('workspace', 'filePaths')}
+    line = json.dumps({
+        "time": time.time(),
+        "endpoint": endpoint,
+        "sessionId": session_id,
+        "body": body
+    }, ensure_ascii=False)
+    with lock:
+        if captured >= MAX_REQUESTS:
+            return
+        captured += 1
+        with open(PATH, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
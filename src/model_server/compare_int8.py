@@ -0,0 +1,238 @@
+# Run captured requests with fp32 and int8 models and compare the answers.
+#
+# Usage: python compare_int8.py CAPTURE.jsonl [options]
+# Example: python compare_int8.py capture.jsonl --requests 200 --output int8.json
+#
+# Requests are captured by setting [capture] Path in server.ini. Every request
+# runs first with the fp32 models, then with the int8 ones (see [quantization]),
+# in this process and on the CPU. Reported per endpoint:
+#   /range          label agreement over all lines, and over the lines either
+#                   run marked for editing
+#   /discriminator  overlap (Jaccard) of the selected file sets
+#   /content        overlap of the top-k replacement candidates, and top-1 match
+# and the median latency of both runs. --min-agreement makes it exit 1 when an
+# endpoint agrees less, to gate enabling quantization.
+
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import configparser
+import statistics
+
+import batching
+import fixtures
+import model_manager
+import quantization
+from loadtest import load_capture
+
+ROLES = {
+    '/range': 'locator',
+    '/content': 'generator',
+    '/discriminator': 'discriminator'
+}
+
+
+def get_predictors():
+    from locator.interface import predict as locator_predict
+    from generator.interface import predict as generator_predict
+    from discriminator.interface import predict as discriminator_predict
+    return {
+        'locator': locator_predict,
+        'generator': generator_predict,
+        'discriminator': discriminator_predict
+    }
+
+
+def unload_all():
+    for it in model_manager.registry.stats()["models"]:
+        model_manager.registry.evict(it["role"], it["language"])
+
+
+def run_one(predictor, entry):
+    # predict functions may modify their input
+    json_input = copy.deepcopy(entry["body"])
+    with model_manager.request_scope():
+        start_time = time.perf_counter()
+        try:
+            output = predictor(json_input, json_input["language"])
+        except Exception as err:
+            print(f'+++ {entry["endpoint"]} failed: {type(err).__name__}: {err}')
+            output = None
+        return output, time.perf_counter() - start_time
+
+
+def run_all(entries, predictors, int8):
+    '''[(output, seconds)] of every entry, with or without quantization.'''
+    quantization.ENABLED = int8
+    quantization.ROLE_ENABLED.clear()
+    quantization.LANGUAGES = []
+    unload_all()
+    # load the models before timing, with the first request of each endpoint
+    seen = set()
+    for entry in entries:
+        if entry["endpoint"] not in seen:
+            seen.add(entry["endpoint"])
+            run_one(predictors[ROLES[entry["endpoint"]]], entry)
+    results = []
+    for i, entry in enumerate(entries):
+        results.append(run_one(predictors[ROLES[entry["endpoint"]]], entry))
+        if (i + 1) % 50 == 0:
+            print(f'>>> {"int8" if int8 else "fp32"}: {i + 1}/{len(entries)} requests')
+    return results
+
+
+def locator_labels(entry, output):
+    '''(file path, line) -> label, for every line of every file.'''
+    labels = dict()
+    for path, content in entry["body"]["files"]:
+        for line in range(len(content.splitlines(True))):
+            labels[(path, line)] = 'keep'
+    for it in output["data"]:
+        for line in it["atLines"]:
+            labels[(it["targetFilePath"], line)] = it["editType"]
+    return labels
+
+
+def compare_locator(entry, fp32, int8):
+    a = locator_labels(entry, fp32)
+    b = locator_labels(entry, int8)
+    edited = [key for key in a if a[key] != 'keep' or b.get(key) != 'keep']
+    return {
+        "agreement": sum(a[key] == b.get(key) for key in a) / len(a) if a else 1.0,
+        "editAgreement": sum(a[key] == b.get(key) for key in edited) / len(edited)
+        if edited else 1.0
+    }
+
+
+def compare_discriminator(entry, fp32, int8):
+    a = set(fp32["data"])
+    b = set(int8["data"])
+    return {
+        "agreement": len(a & b) / len(a | b) if a | b else 1.0,
+        "exactMatch": float(a == b)
+    }
+
+
+def compare_generator(entry, fp32, int8, top_k):
+    a = fp32["data"]["replacement"][:top_k]
+    b = int8["data"]["replacement"][:top_k]
+    k = min(top_k, max(len(a), len(b)))
+    return {
+        "agreement": len(set(a) & set(b)) / k if k else 1.0,
+        "top1Match": float(a[:1] == b[:1])
+    }
+
+
+def summarize(entries, fp32_results, int8_results, top_k):
+    by_endpoint = dict()
+    for entry, (fp32, fp32_seconds), (int8, int8_seconds) in \
+            zip(entries, fp32_results, int8_results):
+        it = by_endpoint.setdefault(entry["endpoint"], {
+            "scores": [], "fp32Seconds": [], "int8Seconds": [], "failed": 0})
+        if fp32 is None or int8 is None:
+            it["failed"] += 1
+            continue
+        role = ROLES[entry["endpoint"]]
+        if role == 'locator':
+            scores = compare_locator(entry, fp32, int8)
+        elif role == 'discriminator':
+            scores = compare_discriminator(entry, fp32, int8)
+        else:
+            scores = compare_generator(entry, fp32, int8, top_k)
+        it["scores"].append(scores)
+        it["fp32Seconds"].append(fp32_seconds)
+        it["int8Seconds"].append(int8_seconds)
+
+    report = dict()
+    for endpoint, it in sorted(by_endpoint.items()):
+        compared = len(it["scores"])
+        metrics = {name: statistics.mean(scores[name] for scores in it["scores"])
+                   for name in (it["scores"][0] if compared else [])}
+        fp32_median = statistics.median(it["fp32Seconds"]) if compared else float('nan')
+        int8_median = statistics.median(it["int8Seconds"]) if compared else float('nan')
+        report[endpoint] = {
+            "requests": compared,
+            "failed": it["failed"],
+            "metrics": metrics,
+            "fp32MedianMs": 1000 * fp32_median,
+            "int8MedianMs": 1000 * int8_median,
+            "speedup": fp32_median / int8_median if compared and int8_median > 0 else float('nan')
+        }
+    return report
+
+
+def print_report(report):
+    print(f"{'endpoint':<16}{'requests':>9}{'failed':>8}{'fp32 ms':>10}{'int8 ms':>10}"
+          f"{'speedup':>9}  agreement")
+    for endpoint, it in report.items():
+        metrics = ', '.join(f'{name} {value:.3f}' for name, value in it["metrics"].items())
+        print(f"{endpoint:<16}{it['requests']:>9}{it['failed']:>8}{it['fp32MedianMs']:>10.1f}"
+              f"{it['int8MedianMs']:>10.1f}{it['speedup']:>9.2f}  {metrics}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare fp32 and int8 models on captured requests.')
+    parser.add_argument('capture', help='JSON lines written by [capture] Path')
+    parser.add_argument('--endpoints', nargs='*', default=[],
+                        help='e.g. /content /range, default all')
+    parser.add_argument('--requests', type=int, default=0, help='use the first N, 0 for all')
+    parser.add_argument('--top-k', type=int, default=5, help='generator candidates compared')
+    parser.add_argument('--threads', type=int, default=0, help='torch threads, 0 for the default')
+    parser.add_argument('--fixtures', action='store_true',
+                        help='use small random models instead of the checkpoints')
+    parser.add_argument('--no-cache', action='store_true',
+                        help="don't keep the quantized models on disk")
+    parser.add_argument('--min-agreement', type=float, default=0,
+                        help='exit 1 if the mean agreement of an endpoint is below this')
+    parser.add_argument('--output', help='also write the report here as JSON')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.ini'))
+    batching.configure(config)
+    model_manager.configure(config)
+    fixtures.configure(config)
+    quantization.configure(config)
+    if args.fixtures:
+        fixtures.ENABLED = True
+    if args.no_cache:
+        quantization.CACHE = False
+    import torch
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    if quantization.accelerator_available():
+        print('+++ int8 quantization runs on the CPU only, hide the GPU to compare')
+        sys.exit(1)
+
+    entries = load_capture(args.capture, args.endpoints or list(ROLES.keys()))
+    if args.requests:
+        entries = entries[:args.requests]
+    if len(entries) == 0:
+        print(f'No requests to compare in {args.capture}')
+        sys.exit(1)
+    predictors = get_predictors()
+    fp32_results = run_all(entries, predictors, int8=False)
+    int8_results = run_all(entries, predictors, int8=True)
+
+    report = {
+        "models": fixtures.version() if fixtures.ENABLED else 'checkpoints',
+        "topK": args.top_k,
+        "threads": torch.get_num_threads(),
+        "endpoints": summarize(entries, fp32_results, int8_results, args.top_k)
+    }
+    print_report(report["endpoints"])
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=4)
+    below = [endpoint for endpoint, it in report["endpoints"].items()
+             if it["metrics"] and it["metrics"]["agreement"] < args.min_agreement]
+    if below:
+        print(f'+++ agreement below {args.min_agreement}: {", ".join(below)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,8 +4,8 @@ import torch
 import numpy as np
 import torch.nn as nn
 from huggingface_hub import PyTorchModelHubMixin
-from transformers import EncoderDecoderModel, RobertaTokenizerFast, PreTrainedModel
-from torch.utils.data import DataLoader, TensorDataset
+from transformers import RobertaConfig, RobertaModel, RobertaTokenizerFast, PreTrainedModel
+from batching import DirectBatcher, run_bucketed, submit_sorted
 
 
 class DependencyAnalyzer(nn.Module, PyTorchModelHubMixin):
@@ -13,8 +13,8 @@ class DependencyAnalyzer(nn.Module, PyTorchModelHubMixin):
                  match_tokenizer: RobertaTokenizerFast = None):
         super(DependencyAnalyzer, self).__init__()
         if not encoder:
-            encoder: PreTrainedModel = EncoderDecoderModel.from_encoder_decoder_pretrained(
-                "microsoft/codebert-base", "microsoft/codebert-base").encoder
+            # the encoder half of an encoder-decoder of codebert, without the decoder
+            encoder: PreTrainedModel = RobertaModel.from_pretrained("microsoft/codebert-base")
         if match_tokenizer:
             encoder.resize_token_embeddings(len(match_tokenizer))
             encoder.config.decoder_start_token_id = match_tokenizer.cls_token_id
@@ -22,7 +22,7 @@ class DependencyAnalyzer(nn.Module, PyTorchModelHubMixin):
             encoder.config.eos_token_id = match_tokenizer.sep_token_id
             encoder.config.vocab_size = match_tokenizer.vocab_size
         self.encoder = encoder
-        self.dense = nn.Linear(768, 2)
+        self.dense = nn.Linear(encoder.config.hidden_size, 2)
 
     def forward(self, input_ids, attention_mask):
         outputs = self.encoder(
@@ -33,15 +33,16 @@ class DependencyAnalyzer(nn.Module, PyTorchModelHubMixin):
         return output_2d
 
 
-def load_model_and_tokenizer():
-    model_dir = os.path.join(
-        os.path.dirname(__file__),
-        '..',
-        '..',
-        '..',
-        'models',
-        'dependency-analyzer')
-    model_path = os.path.join(model_dir, 'pytorch_model.bin')
+def load_model_and_tokenizer(model_path=None):
+    if model_path is None:
+        model_dir = os.path.join(
+            os.path.dirname(__file__),
+            '..',
+            '..',
+            '..',
+            'models',
+            'dependency-analyzer')
+        model_path = os.path.join(model_dir, 'pytorch_model.bin')
 
     if torch.cuda.is_available():
         device = torch.device('cuda')
@@ -49,17 +50,21 @@ def load_model_and_tokenizer():
         device = torch.device('mps')
     else:
         device = torch.device('cpu')
-    tokenizer = RobertaTokenizerFast.from_pretrained('microsoft/codebert-base')
-    special_tokens = ['<from>', '<to>']
-    tokenizer.add_tokens(special_tokens, special_tokens=True)
-    model = DependencyAnalyzer(match_tokenizer=tokenizer)
+    from model_manager import get_tokenizer, build_encoder
+    tokenizer = get_tokenizer('microsoft/codebert-base', fast=True,
+                              added_tokens=('<from>', '<to>'))
+    # every weight comes from the checkpoint, skip the pretrained ones
+    encoder = build_encoder(RobertaConfig.from_pretrained('microsoft/codebert-base'))
+    model = DependencyAnalyzer(encoder=encoder, match_tokenizer=tokenizer)
     model.load_state_dict(torch.load(model_path, map_location=device))
     return model, tokenizer
 
 
 class DependencyClassifier:
-    def __init__(self):
-        self.model, self.tokenizer = load_model_and_tokenizer()
+    def __init__(self, model=None, tokenizer=None):
+        if model is None:
+            model, tokenizer = load_model_and_tokenizer()
+        self.model, self.tokenizer = model, tokenizer
         if torch.cuda.is_available():
             self.model.to(torch.device('cuda'))
         elif torch.backends.mps.is_available():
@@ -89,41 +94,47 @@ class DependencyClassifier:
         outputs = sigmoid(outputs).detach().cpu()
         return outputs[1]
 
-    def batch_gen(self, corpus_pair: 'list[str]'):
-        sigmoid = nn.Sigmoid()
+    def make_batch_fn(self):
+        """
+        Build the function run by the batcher: takes unpadded input id rows
+        from any number of requests, returns the dependency score of each row.
+        """
+        import backends
         if torch.cuda.is_available():
             device = torch.device('cuda')
         elif torch.backends.mps.is_available():
             device = torch.device('mps')
         else:
             device = torch.device('cpu')
+        self.model.eval()
+        # shared by all languages
+        runner = backends.get_runner('dependency', 'all', self.model, device)
+
+        def score(rows):
+            token_input = self.tokenizer.pad(
+                {"input_ids": rows}, padding=True, return_tensors='pt')
+            scores, = runner(token_input["input_ids"], token_input["attention_mask"])
+            return scores.tolist()
+
+        def batch_fn(rows, tokens):
+            # rows of concurrent requests may differ in length, pad per bucket
+            return run_bucketed(rows, [len(row) for row in rows], score)
+
+        return batch_fn
+
+    def batch_gen(self, corpus_pair: 'list[str]', batcher=None):
+        if batcher is None:
+            # batches of 32 on this thread
+            batcher = DirectBatcher(self.make_batch_fn(), 32)
         token_input = self.tokenizer(
-            corpus_pair,
-            return_tensors='pt',
-            padding=True,
-            truncation=True,
-            max_length=512)
-        dataset = TensorDataset(
-            token_input["input_ids"],
-            token_input["attention_mask"])
-        dataloader = DataLoader(dataset, batch_size=32, shuffle=False)
-
-        preds = []
-        with torch.no_grad():
-            for batch in dataloader:
-                batch_input, attention_mask = [
-                    item.to(device) for item in batch]
-                outputs = self.model(
-                    input_ids=batch_input,
-                    attention_mask=attention_mask)
-                outputs = sigmoid(outputs)[:, 1]
-                preds.append(outputs.detach().cpu())
-        preds = torch.cat(preds, dim=0)
-        return preds.numpy()
+            corpus_pair, truncation=True, max_length=512)
+        rows = token_input["input_ids"]
+        # each batch pads to its longest row, keep long ones together
+        return np.array(submit_sorted(batcher.submit, rows, [len(row) for row in rows]))
 
 
 def cal_dep_score(hunk: dict, file_content: str,
-                  dependency_analyzer: DependencyClassifier):
+                  dependency_analyzer: DependencyClassifier, batcher=None):
     def split2window_str(lines):
         windows = []
         for i in range(len(lines) // 10 + 1):
@@ -146,7 +157,7 @@ def cal_dep_score(hunk: dict, file_content: str,
     for windowB in code_window_strsB:
         code_window_pairs.append((hunk_window_str, windowB))
     corpus_pair = dependency_analyzer.construct_corpus_pair(code_window_pairs)
-    results = dependency_analyzer.batch_gen(corpus_pair)
+    results = dependency_analyzer.batch_gen(corpus_pair, batcher)
     assert len(results) == len(code_window_strsB)
     # get dep score
     dep_score_max = np.max(results).item()
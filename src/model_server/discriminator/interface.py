@@ -3,24 +3,34 @@ import torch
 import pickle
 import jsonlines
 import numpy as np
-from torch.utils.data import DataLoader
 from sklearn.linear_model import LinearRegression
-from transformers import RobertaTokenizer, RobertaModel
-from .dependency_analyzer import cal_dep_score, DependencyClassifier
-from .siamese_net import evaluate_embedding_model, load_siamese_data
+from transformers import RobertaConfig
+from .dependency_analyzer import cal_dep_score, DependencyClassifier, load_model_and_tokenizer
+from .siamese_net import make_embedding_batch_fn, request_windows, tokenize_texts, \
+    embed_sorted, max_similarity
 from perf import Stopwatch
-from model_manager import load_model_with_cache
+from model_manager import load_model_with_cache, get_tokenizer, build_encoder, get_model_version
+from embedding_store import store as embedding_store
+import window_index
+import prefilter
+import fixtures
+from batching import get_batcher
+from cancellation import checkpoint
+from metrics import files_processed, windows_processed, tokens_processed
 
 MODEL_ROLE = "embedding"
+DEPENDENCY_ROLE = "dependency"
+PREDICT_NAME = "discriminator"
 OUTPUT_MAX = 10
 
 
 def construct_discriminator_dataset(
-        hunk, file_name_contents, dependency_analyzer):
+        hunk, file_name_contents, dependency_analyzer, batcher=None):
     dataset = []
     for file_name_content in file_name_contents:
+        checkpoint()
         dep_score_list = cal_dep_score(
-            hunk, file_name_content[1], dependency_analyzer)
+            hunk, file_name_content[1], dependency_analyzer, batcher)
         sample = {}
         sample['hunk'] = hunk
         sample['file'] = file_name_content[1]
@@ -38,9 +48,9 @@ def load_model(model_path):
         device = torch.device('mps')
     else:
         device = torch.device('cpu')
-    model = RobertaModel.from_pretrained("huggingface/CodeBERTa-small-v1")
-    tokenizer = RobertaTokenizer.from_pretrained(
-        "huggingface/CodeBERTa-small-v1")
+    # every weight comes from the checkpoint, skip the pretrained ones
+    model = build_encoder(RobertaConfig.from_pretrained("huggingface/CodeBERTa-small-v1"))
+    tokenizer = get_tokenizer("huggingface/CodeBERTa-small-v1")
     model.load_state_dict(torch.load(model_path, map_location=device))
     model.to(device)
     return model, tokenizer, device
@@ -54,13 +64,14 @@ def load_reg_model(lang):
     return reg
 
 
+def load_dependency_analyzer(model_path):
+    # the dependency analyzer is shared by all languages
+    return DependencyClassifier(*load_model_and_tokenizer(model_path))
+
+
 class DiscriminatorPredictor:
     _instance = None
-    _model = None
-    _tokenizer = None
-    _device = None
     _reg_model = None
-    _dependency_analyzer = None
 
     def __init__(self):
         raise RuntimeError('Call get_instance() instead')
@@ -75,19 +86,78 @@ class DiscriminatorPredictor:
     def _initialize(self):
         """初始化所有需要的模型和组件"""
         print("初始化判别器...")
-        # 加载嵌入模型
-        self._model, self._tokenizer, self._device = load_model_with_cache(
-            MODEL_ROLE, 'python', load_model)
+        # 加载嵌入模型和依赖分析器, 它们由 model_manager 管理, 可能被换出
+        self.load_models()
         # 加载回归模型
-        self._reg_model = load_reg_model('python')
-        # 加载依赖分析器
-        self._dependency_analyzer = DependencyClassifier()
+        self._reg_model = fixtures.regression_model() if fixtures.ENABLED \
+            else load_reg_model('python')
         print("判别器初始化完成")
 
+    def load_models(self):
+        """Return the embedding model, tokenizer, device and dependency analyzer, with their batchers."""
+        model, tokenizer, device = load_model_with_cache(
+            MODEL_ROLE, 'python', load_model)
+        dependency_analyzer = load_model_with_cache(
+            DEPENDENCY_ROLE, 'all', load_dependency_analyzer)
+        # 请求间共享批处理
+        embedding_batcher = get_batcher(
+            MODEL_ROLE, 'python',
+            lambda: make_embedding_batch_fn(model, device, 'python', tokenizer.pad_token_id))
+        dependency_batcher = get_batcher(
+            DEPENDENCY_ROLE, 'all', dependency_analyzer.make_batch_fn)
+        return model, tokenizer, dependency_analyzer, embedding_batcher, dependency_batcher
+
+    def embedding_similarity(self, models, hunk, files, json_input, language, complete):
+        """
+        For each of `files`, the max cosine similarity between the hunk and
+        its windows. The hunk is embedded once, windows embedded by earlier
+        requests come from the embedding store and the rest share
+        length-sorted batches. `models` as load_models() returns them.
+        """
+        model, tokenizer, _, embedding_batcher, _ = models
+        model_version = get_model_version(MODEL_ROLE, 'python')
+        files_processed.inc(PREDICT_NAME, language, amount=len(files))
+
+        def embed_texts(missing):
+            rows = tokenize_texts(missing, tokenizer)
+            windows_processed.inc(PREDICT_NAME, language, amount=len(rows))
+            tokens_processed.inc(PREDICT_NAME, language, amount=sum(len(row[0]) for row in rows))
+            return embed_sorted(rows, embedding_batcher.submit).numpy()
+
+        workspace_id = (json_input.get("workspace") or {}).get("id")
+        window_count = sum(len(content.splitlines()) // 30 + 1 for _, content in files)
+        if window_index.ENABLED and workspace_id and window_count >= window_index.MIN_WINDOWS:
+            # large workspace: search the workspace's window index, files
+            # outside the best candidates get the lowest similarity found
+            def embed_files(contents):
+                texts, segments = request_windows("", contents)
+                embeddings, _ = embedding_store.embed(
+                    model_version, texts[1:], embed_texts, dim=model.config.hidden_size)
+                segments = segments.numpy()
+                return [embeddings[segments == file_idx] for file_idx in range(len(contents))]
+
+            hunk_embedding, _ = embedding_store.embed(
+                model_version, [hunk], embed_texts, dim=model.config.hidden_size)
+            similarities = window_index.file_similarity(
+                model_version, workspace_id, hunk_embedding[0], files, embed_files, complete)
+            # the lowest found among this request's files
+            requested = [similarities[path] for path, _ in files if path in similarities]
+            floor = min(requested) if requested else -1.0
+            return [similarities.get(path, floor) for path, _ in files]
+
+        texts, segments = request_windows(hunk, [content for _, content in files])
+        embeddings, computed = embedding_store.embed(
+            model_version, texts, embed_texts, dim=model.config.hidden_size)
+        print(f"+++ Embedded {computed} of {len(texts)} windows, the rest were stored")
+        return max_similarity(torch.from_numpy(embeddings), segments, len(files))
+
     def predict(self, json_input):
         """预测方法"""
+        language = json_input.get("language", "python")
         stopwatch = Stopwatch()
         stopwatch.start()
+        models = self.load_models()
+        _, _, dependency_analyzer, _, dependency_batcher = models
 
         # 0. remove targetFilePath from input["files"]
         if (len(json_input["prevEdits"]) == 0):
@@ -106,19 +176,39 @@ class DiscriminatorPredictor:
         if (len(json_input["files"]) == 0):
             return {"data": []}
 
-        # 1. construct discriminator dataset
+        hunk = "".join(prev_edit_hunk["code_window"])
+        files = json_input["files"]
+        # the window index follows the workspace when it gets all its files
+        complete = "filePaths" not in json_input
+        embedding_similiarity = None
+
+        # 1. Keep the files worth the dependency analyzer: the best by the
+        # identifiers they share with the hunk, and optionally by embedding
+        if prefilter.applies(len(files)):
+            scores = prefilter.lexical_scores(hunk, [it[1] for it in files])
+            if prefilter.EMBEDDING_TOP_FILES > 0:
+                embedding_similiarity = self.embedding_similarity(
+                    models, hunk, files, json_input, language, complete)
+            kept = prefilter.select(scores, embedding_similiarity)
+            print(f"+++ Prefilter kept {len(kept)} of {len(files)} files")
+            files = [files[idx] for idx in kept]
+            complete = False
+            if embedding_similiarity is not None:
+                embedding_similiarity = [embedding_similiarity[idx] for idx in kept]
+            stopwatch.lap('prefilter files')
+
+        # 2. construct discriminator dataset
         dataset = construct_discriminator_dataset(
-            prev_edit_hunk, json_input["files"], self._dependency_analyzer)
+            prev_edit_hunk, files, dependency_analyzer, dependency_batcher)
         stopwatch.lap('build code collection')
 
-        # 2. Calculate the semantic similarity
-        tensor_dataset = load_siamese_data(dataset, self._tokenizer, False)
-        dataloader = DataLoader(tensor_dataset, batch_size=1, shuffle=False)
-        embedding_similiarity = evaluate_embedding_model(
-            self._model, dataloader, "test")
-        stopwatch.lap('calculate the semantic similarity')
+        # 3. Calculate the semantic similarity
+        if embedding_similiarity is None:
+            embedding_similiarity = self.embedding_similarity(
+                models, hunk, files, json_input, language, complete)
+            stopwatch.lap('calculate the semantic similarity')
 
-        # 3. Use linear regression to predict label
+        # 4. Use linear regression to predict label
         X_test = [dataset[idx]["dependency_score"] + [embedding_similiarity[idx]]
                   for idx in range(len(embedding_similiarity))]
         y_pred = self._reg_model.predict(X_test)
@@ -127,10 +217,10 @@ class DiscriminatorPredictor:
         files_pred = []
         for i in range(len(y_pred)):
             if y_pred[i] == 1:
-                files_pred.append(json_input["files"][i][0])
+                files_pred.append(files[i][0])
         stopwatch.lap('infer result')
 
-        # 4. prepare output
+        # 5. prepare output
         output = {"data": []}
         for file in files_pred:
             output["data"].append(file)
@@ -140,10 +230,16 @@ class DiscriminatorPredictor:
         
         print("+++ Discriminator profiling:")
         stopwatch.print_result()
+        stopwatch.record(PREDICT_NAME, language)
 
         return output
 
 
+def preload(language):
+    '''Load the models ahead of the first request. Only python models are used for now.'''
+    DiscriminatorPredictor.get_instance()
+
+
 def predict(json_input, language):
     '''
     Function: this is the interface between discriminator and VSCode extension
@@ -7,6 +7,9 @@ import torch.nn.functional as F
 from torch.utils.data import DataLoader
 from transformers import RobertaConfig, RobertaModel, RobertaTokenizer
 from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score
+from torch.nn.utils.rnn import pad_sequence
+from batching import trim_padding, run_bucketed, submit_sorted
+import backends
 
 
 def train_embedding_model(model: RobertaModel, train_dataloader: DataLoader, dev_dataloader: DataLoader,
@@ -117,18 +120,19 @@ def train_embedding_model(model: RobertaModel, train_dataloader: DataLoader, dev
         evaluate_embedding_model(model, dev_dataloader, "validation")
 
 
+def split2window(lines: list, window_len: int = 30) -> list:
+    windows = []
+    for i in range(len(lines) // window_len + 1):
+        if i == len(lines) // window_len:
+            window = ''.join(lines[i * window_len:])
+        else:
+            window = ''.join(lines[i * window_len:(i + 1) * window_len])
+        windows.append(window)
+    return windows
+
+
 def load_siamese_data(
         dataset: 'list[dict]', tokenizer: RobertaTokenizer, debug_mode: bool = False) -> list:
-    def split2window(lines: list, window_len: int = 30) -> list:
-        windows = []
-        for i in range(len(lines) // window_len + 1):
-            if i == len(lines) // window_len:
-                window = ''.join(lines[i * window_len:])
-            else:
-                window = ''.join(lines[i * window_len:(i + 1) * window_len])
-            windows.append(window)
-        return windows
-
     tensor_dataset = []
     for sample_idx, sample in enumerate(tqdm(dataset, desc="Loading data")):
         hunk = sample["hunk"]
@@ -160,6 +164,83 @@ def load_siamese_data(
     return tensor_dataset
 
 
+def make_embedding_batch_fn(model: RobertaModel, device: torch.device, language: str,
+                            pad_token_id: int = 1):
+    """
+    Build the function run by the batcher: takes (input_ids, attention_mask)
+    rows from any number of requests, of any lengths, returns the CLS
+    embedding of each row.
+    """
+    model.eval()
+    runner = backends.get_runner('embedding', language, model, device)
+
+    def embed(rows):
+        input_ids = pad_sequence([row[0] for row in rows], batch_first=True,
+                                 padding_value=pad_token_id)
+        attn_masks = pad_sequence([row[1] for row in rows], batch_first=True)
+        input_ids, attn_masks = trim_padding(input_ids, attn_masks)
+        embeddings, = runner(input_ids, attn_masks)
+        return list(embeddings)
+
+    def batch_fn(rows, tokens):
+        # rows of concurrent requests may differ in length, pad per bucket
+        return run_bucketed(rows, [int(row[1].sum()) for row in rows], embed)
+
+    return batch_fn
+
+
+def request_windows(hunk: str, files: 'list[str]'):
+    """
+    The texts to embed for a request, the hunk once and then the 30-line
+    windows of every file, and for each window the index of its file.
+    """
+    texts = [hunk]
+    segments = []
+    for file_idx, file in enumerate(files):
+        windows = split2window(file.splitlines(True))
+        texts.extend(windows)
+        segments.extend([file_idx] * len(windows))
+    return texts, torch.tensor(segments, dtype=torch.long)
+
+
+def tokenize_texts(texts: 'list[str]', tokenizer: RobertaTokenizer) -> list:
+    """(input_ids, attention_mask) rows of `texts`, without padding."""
+    encoded = tokenizer(texts, truncation=True, max_length=512)
+    return [(torch.tensor(input_ids, dtype=torch.long), torch.tensor(attn_mask, dtype=torch.long))
+            for input_ids, attn_mask in zip(encoded["input_ids"], encoded["attention_mask"])]
+
+
+def tokenize_request(hunk: str, files: 'list[str]', tokenizer: RobertaTokenizer):
+    """
+    Tokenize the hunk once and the 30-line windows of every file, without
+    padding. Returns (input_ids, attention_mask) rows, the hunk first, and
+    for each window row the index of its file.
+    """
+    texts, segments = request_windows(hunk, files)
+    return tokenize_texts(texts, tokenizer), segments
+
+
+def embed_sorted(rows: list, embed_rows) -> torch.Tensor:
+    """
+    Embed rows with `embed_rows`, which maps a list of rows to a list of
+    embeddings and batches them in order, e.g. a batcher's submit. Rows are
+    passed sorted by length, so batches hold rows of similar length and
+    little padding; the embeddings come back in the original order.
+    """
+    return torch.stack(submit_sorted(embed_rows, rows, [int(row[1].sum()) for row in rows]))
+
+
+def max_similarity(embeddings: torch.Tensor, segments: torch.Tensor, file_count: int) -> np.array:
+    """
+    For each file, the max cosine similarity between the hunk, embeddings[0],
+    and the file's windows, embeddings[1:] labelled by `segments`.
+    """
+    similarity = F.cosine_similarity(embeddings[0:1], embeddings[1:], dim=1)
+    per_file = torch.full((file_count,), float('-inf'), dtype=similarity.dtype)
+    per_file = per_file.scatter_reduce(0, segments, similarity, reduce='amax')
+    return per_file.numpy()
+
+
 def evaluate_embedding_model(
         model: RobertaModel, dataloader: DataLoader, mode: str) -> np.array:
     if torch.cuda.is_available():
@@ -0,0 +1,222 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from metrics import Counter, register_collector
+
+# Defaults, overridden by the [embeddings] section of server.ini
+ENABLED = True
+MAX_MEMORY_MB = 256
+DISK_DIR = ''  # empty to keep vectors in memory only
+DISK_MAX_VECTORS = 200000
+
+# bytes an in-memory entry costs beyond its float16 values
+ENTRY_OVERHEAD = 200
+
+embedding_store_requests = Counter(
+    'coedpilot_embedding_store_requests_total', 'Window embedding lookups.',
+    ('result',))
+
+
+def configure(config):
+    global ENABLED, MAX_MEMORY_MB, DISK_DIR, DISK_MAX_VECTORS
+    if not config.has_section('embeddings'):
+        return
+    section = config['embeddings']
+    ENABLED = section.getboolean('Enabled', ENABLED)
+    MAX_MEMORY_MB = section.getint('MaxMemoryMb', MAX_MEMORY_MB)
+    DISK_DIR = section.get('DiskDir', DISK_DIR)
+    DISK_MAX_VECTORS = section.getint('DiskMaxVectors', DISK_MAX_VECTORS)
+    store.reset(MAX_MEMORY_MB * 2 ** 20, DISK_DIR, DISK_MAX_VECTORS)
+
+
+def window_digest(text):
+    # hex, as numpy strips trailing NUL bytes from a raw digest
+    return hashlib.sha1(text.encode('utf-8')).hexdigest().encode('ascii')
+
+
+class DiskVectors:
+    """
+        A ring of `capacity` float16 vectors of one model in a memory-mapped
+        file, found again after a restart. Each record holds the digest of its
+        window, a sequence number (0 for empty) and the vector; when full the
+        oldest record is overwritten.
+    """
+
+    def __init__(self, path, dim, capacity):
+        # numpy is imported on use, the server imports this module at startup
+        import numpy as np
+        self.dtype = np.dtype([('digest', 'S40'), ('seq', '<i8'), ('vector', '<f2', (dim,))])
+        mode = 'r+' if os.path.isfile(path) and \
+            os.path.getsize(path) == self.dtype.itemsize * capacity else 'w+'
+        self.records = np.memmap(path, dtype=self.dtype, mode=mode, shape=(capacity,))
+        filled = np.nonzero(self.records['seq'])[0]
+        self.slots = {bytes(self.records['digest'][i]): int(i) for i in filled}
+        self.seq = int(self.records['seq'].max()) if len(filled) else 0
+        # records are written in order until the ring is full
+        self.filled = int(filled[-1]) + 1 if len(filled) else 0
+        self.capacity = capacity
+
+    def get(self, digest):
+        import numpy as np
+        slot = self.slots.get(digest)
+        if slot is None:
+            return None
+        record = self.records[slot]
+        # never hand out the vector of another window
+        if bytes(record['digest']) != digest:
+            del self.slots[digest]
+            return None
+        return np.array(record['vector'])
+
+    def put(self, digest, vector):
+        import numpy as np
+        if digest in self.slots:
+            return
+        if self.filled < self.capacity:
+            slot = self.filled
+            self.filled += 1
+        else:
+            slot = int(np.argmin(self.records['seq']))
+            self.slots.pop(bytes(self.records['digest'][slot]), None)
+        self.seq += 1
+        self.records[slot] = (digest, self.seq, vector)
+        self.slots[digest] = slot
+
+
+class EmbeddingStore:
+    """
+        CLS vectors of code windows, keyed by the model that produced them and
+        a hash of the window text, stored as float16. The least recently used
+        vectors beyond `memory_budget` bytes are dropped from memory; with
+        `disk_dir` every vector is also written to a memory-mapped file per
+        model, looked up on a memory miss and kept across restarts. Each
+        worker of a [workers] pool has files of its own, see set_owner().
+    """
+
+    def __init__(self, memory_budget, disk_dir='', disk_max_vectors=0):
+        self._lock = threading.Lock()
+        self.owner = ''
+        self.reset(memory_budget, disk_dir, disk_max_vectors)
+
+    def set_owner(self, owner):
+        '''
+        Name the disk files after `owner`, e.g. a worker, as the slot index
+        of a file lives in the memory of the process using it.
+        '''
+        with self._lock:
+            self.owner = owner
+            self._disk = dict()
+
+    def reset(self, memory_budget, disk_dir='', disk_max_vectors=0):
+        with self._lock:
+            self.memory_budget = memory_budget
+            self.disk_dir = disk_dir
+            self.disk_max_vectors = disk_max_vectors
+            self._entries = OrderedDict()  # (model id, digest) -> vector
+            self._memory_bytes = 0
+            self._disk = dict()  # model id -> DiskVectors
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _disk_vectors(self, model_id, dim):
+        '''The disk ring of a model, opened on first use. Call with the lock held.'''
+        if not self.disk_dir or self.disk_max_vectors <= 0:
+            return None
+        disk = self._disk.get(model_id)
+        if disk is None:
+            name = hashlib.sha1(model_id.encode('utf-8')).hexdigest()[:16]
+            if self.owner:
+                name = f'{name}-{self.owner}'
+            path = os.path.join(
+                self.disk_dir, f'embeddings-{name}-{dim}x{self.disk_max_vectors}.mmap')
+            disk = DiskVectors(path, dim, self.disk_max_vectors)
+            self._disk[model_id] = disk
+        return disk
+
+    def _remember(self, key, vector):
+        '''Keep a vector in memory, dropping the least recently used. Call with the lock held.'''
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return
+        self._entries[key] = vector
+        self._memory_bytes += vector.nbytes + ENTRY_OVERHEAD
+        while self._memory_bytes > self.memory_budget and len(self._entries) > 0:
+            _, dropped = self._entries.popitem(last=False)
+            self._memory_bytes -= dropped.nbytes + ENTRY_OVERHEAD
+
+    def get(self, model_id, digest, dim=None):
+        key = (model_id, digest)
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                embedding_store_requests.inc('hit')
+                return vector
+            disk = self._disk_vectors(model_id, dim) if dim is not None \
+                else self._disk.get(model_id)
+            vector = disk.get(digest) if disk is not None else None
+            if vector is not None:
+                self._remember(key, vector)
+                embedding_store_requests.inc('disk_hit')
+                return vector
+        embedding_store_requests.inc('miss')
+        return None
+
+    def put(self, model_id, digest, vector):
+        import numpy as np
+        vector = np.asarray(vector, dtype=np.float16)
+        with self._lock:
+            self._remember((model_id, digest), vector)
+            disk = self._disk_vectors(model_id, vector.shape[0])
+            if disk is not None:
+                disk.put(digest, vector)
+
+    def embed(self, model_id, texts, compute, dim=None):
+        '''
+        The float16 vectors of `texts` as a float32 array, calling
+        `compute(texts)` for the ones not stored yet. `dim`, if known,
+        lets a fresh process find vectors on disk before computing any.
+        Returns (vectors, number computed).
+        '''
+        import numpy as np
+        if not ENABLED:
+            computed = np.asarray(compute(texts), dtype=np.float16)
+            return computed.astype(np.float32), len(texts)
+        digests = [window_digest(text) for text in texts]
+        vectors = [self.get(model_id, digest, dim) for digest in digests]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        unique = []
+        if missing:
+            # a window may repeat within a request
+            unique = list(OrderedDict.fromkeys(digests[i] for i in missing))
+            first = {digest: i for i, digest in reversed(list(enumerate(digests)))}
+            computed = np.asarray(compute([texts[first[digest]] for digest in unique]),
+                                  dtype=np.float16)
+            for digest, vector in zip(unique, computed):
+                self.put(model_id, digest, vector)
+            by_digest = dict(zip(unique, computed))
+            for i in missing:
+                vectors[i] = by_digest[digests[i]]
+        return np.stack(vectors).astype(np.float32), len(unique)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "vectors": len(self._entries),
+                "memoryBytes": self._memory_bytes,
+                "memoryBudget": self.memory_budget,
+                "diskVectors": {model_id: len(disk.slots) for model_id, disk in self._disk.items()}
+            }
+
+
+store = EmbeddingStore(MAX_MEMORY_MB * 2 ** 20)
+
+
+def collect_store_size():
+    stats = store.stats()
+    return [('coedpilot_embedding_store_bytes', 'gauge',
+             'Memory held by stored window embeddings.', [({}, stats["memoryBytes"])])]
+
+
+register_collector(collect_store_size)
@@ -0,0 +1,180 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+
+# Defaults, overridden by the [fixtures] section of server.ini
+ENABLED = False
+HIDDEN_SIZE = 64
+LAYERS = 2
+HEADS = 2
+INTERMEDIATE_SIZE = 128
+VOCAB_SIZE = 0  # 0 for just the byte-level vocabulary
+DECODER_MAX_LENGTH = 128
+SEED = 0
+
+# whole-word tokens the locator predicts and the generator puts at <mask>
+LABEL_TOKENS = ['keep', 'add', 'replace', 'remove']
+
+tokenizer_lock = threading.Lock()
+tokenizer_dir = None
+
+
+def configure(config):
+    global ENABLED, HIDDEN_SIZE, LAYERS, HEADS, INTERMEDIATE_SIZE, VOCAB_SIZE, \
+        DECODER_MAX_LENGTH, SEED
+    if not config.has_section('fixtures'):
+        return
+    section = config['fixtures']
+    ENABLED = section.getboolean('Enabled', ENABLED)
+    HIDDEN_SIZE = section.getint('HiddenSize', HIDDEN_SIZE)
+    LAYERS = section.getint('Layers', LAYERS)
+    HEADS = section.getint('Heads', HEADS)
+    INTERMEDIATE_SIZE = section.getint('IntermediateSize', INTERMEDIATE_SIZE)
+    VOCAB_SIZE = section.getint('VocabSize', VOCAB_SIZE)
+    DECODER_MAX_LENGTH = section.getint('DecoderMaxLength', DECODER_MAX_LENGTH)
+    SEED = section.getint('Seed', SEED)
+
+
+def version():
+    '''Stands in for the checkpoint version, so cached results follow the fixture settings.'''
+    settings = [HIDDEN_SIZE, LAYERS, HEADS, INTERMEDIATE_SIZE, VOCAB_SIZE,
+                DECODER_MAX_LENGTH, SEED]
+    return 'fixture-' + hashlib.sha256(json.dumps(settings).encode('utf-8')).hexdigest()[:12]
+
+
+def get_device():
+    import torch
+    if torch.cuda.is_available():
+        return torch.device('cuda')
+    elif torch.backends.mps.is_available():
+        return torch.device('mps')
+    return torch.device('cpu')
+
+
+def write_vocabulary():
+    '''
+    A RoBERTa vocabulary of the special tokens, the 256 byte-level symbols
+    and the label tokens, with no merges, so any text tokenizes to bytes.
+    '''
+    global tokenizer_dir
+    with tokenizer_lock:
+        if tokenizer_dir is not None:
+            return tokenizer_dir
+        from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+        tokens = ['<s>', '<pad>', '</s>', '<unk>']
+        tokens += sorted(set(bytes_to_unicode().values()))
+        tokens += LABEL_TOKENS
+        tokens += [f'<extra_{i}>' for i in range(max(0, VOCAB_SIZE - len(tokens) - 1))]
+        tokens.append('<mask>')
+        directory = tempfile.mkdtemp(prefix='coedpilot-fixture-')
+        with open(os.path.join(directory, 'vocab.json'), 'w', encoding='utf-8') as f:
+            json.dump({token: i for i, token in enumerate(tokens)}, f)
+        with open(os.path.join(directory, 'merges.txt'), 'w', encoding='utf-8') as f:
+            f.write('#version: 0.2\n')
+        tokenizer_dir = directory
+        return directory
+
+
+def tokenizer(fast=False):
+    from transformers import RobertaTokenizer, RobertaTokenizerFast
+    directory = write_vocabulary()
+    tokenizer_class = RobertaTokenizerFast if fast else RobertaTokenizer
+    return tokenizer_class(os.path.join(directory, 'vocab.json'),
+                           os.path.join(directory, 'merges.txt'))
+
+
+def roberta_config(tokenizer):
+    from transformers import RobertaConfig
+    return RobertaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=HIDDEN_SIZE,
+        num_hidden_layers=LAYERS,
+        num_attention_heads=HEADS,
+        intermediate_size=INTERMEDIATE_SIZE,
+        max_position_embeddings=514,
+        type_vocab_size=1,
+        pad_token_id=tokenizer.pad_token_id,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id)
+
+
+def load_locator(model_path):
+    import torch
+    from transformers import RobertaModel
+    from locator.model import Seq2Seq
+    torch.manual_seed(SEED)
+    device = get_device()
+    fixture_tokenizer = tokenizer()
+    config = roberta_config(fixture_tokenizer)
+    model = Seq2Seq(encoder=RobertaModel(config), config=config,
+                    beam_size=10, max_length=512,
+                    sos_id=fixture_tokenizer.cls_token_id, eos_id=fixture_tokenizer.sep_token_id,
+                    mask_id=fixture_tokenizer.mask_token_id)
+    model.to(device)
+    return model, fixture_tokenizer, device
+
+
+def load_generator(model_path):
+    import torch
+    import torch.nn as nn
+    from transformers import RobertaModel
+    from generator.model import Seq2Seq
+    torch.manual_seed(SEED)
+    device = get_device()
+    fixture_tokenizer = tokenizer()
+    config = roberta_config(fixture_tokenizer)
+    decoder_layer = nn.TransformerDecoderLayer(
+        d_model=config.hidden_size, nhead=config.num_attention_heads,
+        dim_feedforward=INTERMEDIATE_SIZE)
+    decoder = nn.TransformerDecoder(decoder_layer, num_layers=LAYERS)
+    model = Seq2Seq(encoder=RobertaModel(config), decoder=decoder, config=config,
+                    beam_size=10, max_length=DECODER_MAX_LENGTH,
+                    sos_id=fixture_tokenizer.cls_token_id, eos_id=fixture_tokenizer.sep_token_id)
+    model.to(device)
+    return model, fixture_tokenizer, device
+
+
+def load_embedding(model_path):
+    import torch
+    from transformers import RobertaModel
+    torch.manual_seed(SEED)
+    device = get_device()
+    fixture_tokenizer = tokenizer()
+    model = RobertaModel(roberta_config(fixture_tokenizer))
+    model.to(device)
+    return model, fixture_tokenizer, device
+
+
+def load_dependency(model_path):
+    import torch
+    from transformers import RobertaModel
+    from discriminator.dependency_analyzer import DependencyAnalyzer, DependencyClassifier
+    torch.manual_seed(SEED)
+    fixture_tokenizer = tokenizer(fast=True)
+    fixture_tokenizer.add_tokens(['<from>', '<to>'], special_tokens=True)
+    encoder = RobertaModel(roberta_config(fixture_tokenizer))
+    model = DependencyAnalyzer(encoder=encoder, match_tokenizer=fixture_tokenizer)
+    return DependencyClassifier(model, fixture_tokenizer)
+
+
+def regression_model():
+    '''Maps (dependency score, embedding similarity) to their mean.'''
+    from sklearn.linear_model import LinearRegression
+    return LinearRegression().fit([[0, 0], [1, 0], [0, 1], [1, 1]], [0, 0.5, 0.5, 1])
+
+
+LOADERS = {
+    'locator': load_locator,
+    'generator': load_generator,
+    'embedding': load_embedding,
+    'dependency': load_dependency
+}
+
+
+def get_loader(model_role, model_loader):
+    '''The fixture loader of a role in fixture mode, or else `model_loader`.'''
+    if not ENABLED:
+        return model_loader
+    return LOADERS[model_role]
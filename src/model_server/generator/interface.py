@@ -4,10 +4,12 @@ import torch.nn as nn
 
 from .model import Seq2Seq
 from tqdm import tqdm
-from torch.utils.data import DataLoader, SequentialSampler, TensorDataset
 from transformers import (RobertaConfig, RobertaModel, RobertaTokenizer)
 from perf import Stopwatch
-from model_manager import load_model_with_cache
+from model_manager import load_model_with_cache, get_tokenizer, build_encoder
+from batching import get_batcher, trim_padding
+from metrics import tokens_processed, beam_steps
+from tracing import span
 
 MODEL_CLASSES = {'roberta': (RobertaConfig, RobertaModel, RobertaTokenizer)}
 
@@ -143,11 +145,11 @@ def load_model(model_path):
         device = torch.device('mps')
     else:
         device = torch.device('cpu')
-    config_class, model_class, tokenizer_class = MODEL_CLASSES['roberta']
-    config = config_class.from_pretrained("microsoft/codebert-base")
-    tokenizer = tokenizer_class.from_pretrained("microsoft/codebert-base")
-    encoder = model_class.from_pretrained(
-        "microsoft/codebert-base", config=config)
+    config = RobertaConfig.from_pretrained("microsoft/codebert-base")
+    # shared with the locator
+    tokenizer = get_tokenizer("microsoft/codebert-base")
+    # every weight comes from the checkpoint, skip the pretrained ones
+    encoder = build_encoder(config)
     decoder_layer = nn.TransformerDecoderLayer(
         d_model=config.hidden_size,
         nhead=config.num_attention_heads)
@@ -160,6 +162,52 @@ def load_model(model_path):
     return model, tokenizer, device
 
 
+def make_batch_fn(model, device, language):
+    '''
+    Build the function run by the batcher: takes (source_ids, source_mask)
+    rows from any number of requests, returns the beam of predicted token ids
+    for each row. Decoding stops early for rows whose request is cancelled.
+    '''
+    def batch_fn(rows, tokens):
+        source_ids = torch.tensor([row[0] for row in rows], dtype=torch.long)
+        source_mask = torch.tensor([row[1] for row in rows], dtype=torch.long)
+        source_ids, source_mask = trim_padding(source_ids, source_mask)
+        model.eval()
+        with torch.no_grad():
+            preds = model(source_ids=source_ids.to(device),
+                          source_mask=source_mask.to(device),
+                          cancel_tokens=tokens)
+        beam_steps.inc(language, amount=model.last_decode_steps)
+        return list(preds.cpu())
+
+    return batch_fn
+
+
+def cache_inputs(json_input):
+    '''
+    The part of a request the prediction depends on, for the result cache.
+    Only the lines around the edit reach the model, so the rest of the file
+    is left out of the key.
+    '''
+    targetFileLines = json_input["targetFileContent"].splitlines(True)
+    editLineIdx = json_input["atLines"]
+    startLineIdx = max(0, editLineIdx[0] - CONTEXT_LENGTH)
+    endLineIdx = min(len(targetFileLines), editLineIdx[-1] + CONTEXT_LENGTH + 1)
+    return {
+        "codeWindow": targetFileLines[startLineIdx:endLineIdx],
+        "atLines": [it - startLineIdx for it in editLineIdx],
+        "commitMessage": json_input["commitMessage"],
+        "editType": json_input["editType"],
+        "prevEdits": [[it["beforeEdit"], it["afterEdit"]]
+                      for it in json_input["prevEdits"]]
+    }
+
+
+def preload(language):
+    '''Load the model for `language` ahead of the first request.'''
+    load_model_with_cache(MODEL_ROLE, language, load_model)
+
+
 def predict(json_input, language):
     '''
     Function: interface between generator and VScode extension
@@ -186,6 +234,8 @@ def predict(json_input, language):
     # check model cache
     model, tokenizer, device = load_model_with_cache(
         MODEL_ROLE, language, load_model)
+    batcher = get_batcher(MODEL_ROLE, language,
+                          lambda: make_batch_fn(model, device, language))
     stopwatch.lap('load model')
 
     # 提取从 JavaScript 传入的参数
@@ -226,37 +276,24 @@ def predict(json_input, language):
     stopwatch.lap('assemble input text')
 
     # prepare model input (tensor format)
-    batch_size = 1
     eval_examples = read_examples(model_input, labels)
-    eval_features = convert_examples_to_features(
-        eval_examples, tokenizer, stage='test')
-    all_source_ids = torch.tensor(
-        [f.source_ids for f in eval_features], dtype=torch.long)
-    all_source_mask = torch.tensor(
-        [f.source_mask for f in eval_features], dtype=torch.long)
-    eval_data = TensorDataset(all_source_ids, all_source_mask)
-
-    eval_sampler = SequentialSampler(eval_data)
-    eval_dataloader = DataLoader(
-        eval_data,
-        sampler=eval_sampler,
-        batch_size=batch_size)
-    stopwatch.lap('prepare data loader')
-
-    # run model
+    with span('tokenize input'):
+        eval_features = convert_examples_to_features(
+            eval_examples, tokenizer, stage='test')
+    rows = [(f.source_ids, f.source_mask) for f in eval_features]
+    tokens_processed.inc(MODEL_ROLE, language,
+                         amount=sum(sum(row[1]) for row in rows))
+    stopwatch.lap('prepare model input')
+
+    # run model, beam searches of concurrent requests share batches
     replacements = []
-    for batch in tqdm(eval_dataloader, total=len(eval_dataloader)):
-        batch = tuple(t.to(device) for t in batch)
-        source_ids, source_mask = batch
-        with torch.no_grad():
-            preds = model(source_ids=source_ids, source_mask=source_mask)
-            for pred in preds[0]:  # batch_size=1
-                t = pred.cpu().numpy()
-                t = list(t)
-                if 0 in t:
-                    t = t[:t.index(0)]
-                text = tokenizer.decode(t, clean_up_tokenization_spaces=False)
-                replacements.append(text)
+    for preds in batcher.submit(rows):
+        for pred in preds:
+            t = list(pred.numpy())
+            if 0 in t:
+                t = t[:t.index(0)]
+            text = tokenizer.decode(t, clean_up_tokenization_spaces=False)
+            replacements.append(text)
     stopwatch.lap('infer result')
 
     # if editType == 'add':
@@ -266,4 +303,5 @@ def predict(json_input, language):
     stopwatch.lap('post-process result')
     print("+++ Generator profiling:")
     stopwatch.print_result()
+    stopwatch.record(MODEL_ROLE, language)
     return {"data": result}
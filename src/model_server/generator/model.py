@@ -4,6 +4,7 @@
 import torch
 import torch.nn as nn
 import torch
+from tracing import span
 
 if torch.cuda.is_available():
     device = torch.device('cuda')
@@ -12,6 +13,11 @@ elif torch.backends.mps.is_available():
 else:
     device = torch.device('cpu')
 
+def causal_mask(length, device):
+    '''Additive attention mask hiding later target positions, -1e4 above the diagonal.'''
+    return torch.triu(torch.full((length, length), -1e4, device=device), diagonal=1)
+
+
 class Seq2Seq(nn.Module):
     """
         Build Seqence-to-Sequence.
@@ -25,6 +31,9 @@ class Seq2Seq(nn.Module):
         * `max_length`- max length of target for beam search.
         * `sos_id`- start of symbol ids in target for beam search.
         * `eos_id`- end of symbol ids in target for beam search.
+
+        In prediction, `cancel_tokens` optionally gives one cancel token per
+        example; a cancelled example stops decoding at the next step.
     """
 
     def __init__(self, encoder, decoder, config, beam_size=None,
@@ -33,7 +42,6 @@ class Seq2Seq(nn.Module):
         self.encoder = encoder
         self.decoder = decoder
         self.config = config
-        self.register_buffer("bias", torch.tril(torch.ones(2048, 2048)))
         self.dense = nn.Linear(config.hidden_size, config.hidden_size)
         self.lm_head = nn.Linear(
             config.hidden_size,
@@ -47,6 +55,11 @@ class Seq2Seq(nn.Module):
         self.sos_id = sos_id
         self.eos_id = eos_id
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints from before the causal mask was built on the fly
+        state_dict.pop(prefix + 'bias', None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def _tie_or_clone_weights(self, first_module, second_module):
         """ Tie or clone module weights depending of weither we are using TorchScript or not
         """
@@ -63,13 +76,13 @@ class Seq2Seq(nn.Module):
                                    self.encoder.embeddings.word_embeddings)
 
     def forward(self, source_ids=None, source_mask=None,
-                target_ids=None, target_mask=None, args=None):
+                target_ids=None, target_mask=None, args=None, cancel_tokens=None):
         global device
-        outputs = self.encoder(source_ids, attention_mask=source_mask)
-        encoder_output = outputs[0].permute([1, 0, 2]).contiguous()
+        with span('encoder', shape=list(source_ids.shape)):
+            outputs = self.encoder(source_ids, attention_mask=source_mask)
+            encoder_output = outputs[0].permute([1, 0, 2]).contiguous()
         if target_ids is not None:
-            attn_mask = -1e4 * \
-                (1 - self.bias[:target_ids.shape[1], :target_ids.shape[1]])
+            attn_mask = causal_mask(target_ids.shape[1], target_ids.device)
             tgt_embeddings = self.encoder.embeddings(
                 target_ids).permute([1, 0, 2]).contiguous()
             out = self.decoder(
@@ -93,43 +106,56 @@ class Seq2Seq(nn.Module):
             outputs = loss, loss * active_loss.sum(), active_loss.sum()
             return outputs
         else:
-            # Predict
+            # Predict, decoding the beams of every example in the batch
+            # together so concurrent requests share decoder passes
             preds = []
             zero = torch.tensor(
                 [0],
                 dtype=torch.long,
                 device= device)
-            for i in range(source_ids.shape[0]):
-                context = encoder_output[:, i:i + 1]
-                context_mask = source_mask[i:i + 1, :]
-                beam = Beam(self.beam_size, self.sos_id, self.eos_id)
-                input_ids = beam.getCurrentState()
-                context = context.repeat(1, self.beam_size, 1)
-                context_mask = context_mask.repeat(self.beam_size, 1)
+            batch_size = source_ids.shape[0]
+            beams = [Beam(self.beam_size, self.sos_id, self.eos_id)
+                     for _ in range(batch_size)]
+            beam_input_ids = [beam.getCurrentState() for beam in beams]
+            # [src_len, batch_size * beam_size, hidden]
+            context = encoder_output.repeat_interleave(self.beam_size, dim=1)
+            context_mask = source_mask.repeat_interleave(self.beam_size, dim=0)
+            active = list(range(batch_size))
+            self.last_decode_steps = 0
+            with span('beam search decode', examples=batch_size):
                 for _ in range(self.max_length):
-                    if beam.done():
+                    active = [i for i in active if not beams[i].done() and not (
+                        cancel_tokens is not None and cancel_tokens[i] is not None
+                        and cancel_tokens[i].cancelled)]
+                    if len(active) == 0:
                         break
-                    attn_mask = -1e4 * \
-                        (1 -
-                         self.bias[:input_ids.shape[1], :input_ids.shape[1]])
+                    self.last_decode_steps += 1
+                    rows = torch.tensor(
+                        [i * self.beam_size + k for i in active for k in range(self.beam_size)],
+                        dtype=torch.long,
+                        device=context.device)
+                    input_ids = torch.cat([beam_input_ids[i] for i in active], 0)
+                    attn_mask = causal_mask(input_ids.shape[1], input_ids.device)
                     tgt_embeddings = self.encoder.embeddings(
                         input_ids).permute([1, 0, 2]).contiguous()
                     out = self.decoder(
                         tgt_embeddings,
-                        context,
+                        context.index_select(1, rows),
                         tgt_mask=attn_mask,
                         memory_key_padding_mask=(
-                            1 - context_mask).bool())
+                            1 - context_mask.index_select(0, rows)).bool())
                     out = torch.tanh(self.dense(out))
                     hidden_states = out.permute(
                         [1, 0, 2]).contiguous()[:, -1, :]
                     out = self.lsm(self.lm_head(hidden_states)).data
-                    beam.advance(out)
-                    input_ids.data.copy_(
-                        input_ids.data.index_select(
-                            0, beam.getCurrentOrigin()))
-                    input_ids = torch.cat(
-                        (input_ids, beam.getCurrentState()), -1)
+                    for n, i in enumerate(active):
+                        beam = beams[i]
+                        beam.advance(
+                            out[n * self.beam_size:(n + 1) * self.beam_size])
+                        beam_input_ids[i] = torch.cat(
+                            (beam_input_ids[i].index_select(0, beam.getCurrentOrigin()),
+                             beam.getCurrentState()), -1)
+            for beam in beams:
                 hyp = beam.getHyp(beam.getFinal())
                 pred = beam.buildTargetTokens(hyp)[:self.beam_size]
                 pred = [torch.cat([x.view(-1) for x in p] + [zero] *
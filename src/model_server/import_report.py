@@ -0,0 +1,95 @@
+# Report where the import time of the server and the model code goes.
+#
+# Usage: python import_report.py [MODULE ...] [options]
+# Example: python import_report.py server locator.interface --top 15
+#
+# Each module is imported in a fresh interpreter with `-X importtime`, and the
+# per-module timings it writes to stderr are parsed into a table. `server` by
+# itself should stay free of torch and transformers, which are imported when a
+# role is preloaded or first used.
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+DEFAULT_MODULES = ['server', 'discriminator.interface', 'locator.interface', 'generator.interface']
+# packages whose presence in the server's own imports means something went eager
+HEAVY_PACKAGES = ['torch', 'transformers', 'sklearn', 'pandas', 'numpy', 'huggingface_hub']
+
+
+def parse_importtime(stderr):
+    '''[(module, self us, cumulative us, depth)] from `-X importtime` output.'''
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return imports
+
+
+def measure(module):
+    # importing server only defines the app, serving happens under __main__
+    directory = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=directory, capture_output=True, text=True)
+    imports = parse_importtime(result.stderr)
+    error = None
+    if result.returncode != 0:
+        error = result.stderr.strip().splitlines()[-1]
+    return imports, error
+
+
+def summarize(module, imports, error, top):
+    total = sum(self_us for _, self_us, _, _ in imports)
+    loaded = {name.split('.')[0] for name, _, _, _ in imports}
+    slowest = sorted(imports, key=lambda it: it[2], reverse=True)[:top]
+    return {
+        "module": module,
+        "error": error,
+        "totalMs": total / 1000,
+        "modules": len(imports),
+        "heavy": [package for package in HEAVY_PACKAGES if package in loaded],
+        "top": [{"module": name, "selfMs": self_us / 1000, "cumulativeMs": cumulative_us / 1000}
+                for name, self_us, cumulative_us, _ in slowest]
+    }
+
+
+def print_report(report):
+    for it in report:
+        print(f">>> import {it['module']}: {it['totalMs']:.1f} ms, {it['modules']} modules")
+        if it["error"]:
+            print(f"+++ failed: {it['error']}")
+        if it["heavy"]:
+            print(f"    heavy packages: {', '.join(it['heavy'])}")
+        print(f"    {'cumulative ms':>14}{'self ms':>10}  module")
+        for row in it["top"]:
+            print(f"    {row['cumulativeMs']:>14.1f}{row['selfMs']:>10.1f}  {row['module']}")
+        print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tabulate -X importtime for the model server.')
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES)
+    parser.add_argument('--top', type=int, default=20, help='rows per module')
+    parser.add_argument('--output', help='also write the report here as JSON')
+    args = parser.parse_args()
+
+    report = []
+    for module in args.modules:
+        imports, error = measure(module)
+        report.append(summarize(module, imports, error, args.top))
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=4)
+    if any(it["error"] for it in report):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+# Replay captured predict requests against a running model server.
+#
+# Usage: python loadtest.py CAPTURE.jsonl [options]
+# Example: python loadtest.py capture.jsonl --mode open --rate 5 --duration 60
+#
+# Requests are captured by setting [capture] Path in server.ini. In closed-loop
+# mode `--concurrency` clients send the next request as soon as the previous
+# answer arrives. In open-loop mode requests start at `--rate` per second
+# (Poisson arrivals), or at the captured pace times `--speed` without a rate,
+# whether or not earlier ones have finished. Open-loop latency counts from
+# the scheduled start, so a saturated server can't hide its queueing.
+
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import threading
+import http.client
+from urllib.parse import urlsplit
+from collections import defaultdict
+
+
+def load_capture(path, endpoints):
+    entries = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if endpoints and entry["endpoint"] not in endpoints:
+                continue
+            entry["payload"] = json.dumps(entry["body"]).encode('utf-8')
+            entries.append(entry)
+    entries.sort(key=lambda entry: entry["time"])
+    return entries
+
+
+class Client:
+    """One keep-alive connection to the server, per thread."""
+
+    def __init__(self, url, timeout):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = http.client.HTTPConnection(
+                self.host, self.port, timeout=self.timeout)
+            self.local.connection = connection
+        return connection
+
+    def get(self, path):
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            connection.request('GET', path)
+            return connection.getresponse().read().decode('utf-8')
+        finally:
+            connection.close()
+
+    def send(self, entry, keep_sessions, use_cache):
+        headers = {"Content-Type": "application/json"}
+        if keep_sessions and entry.get("sessionId"):
+            headers["X-Session-Id"] = entry["sessionId"]
+        if not use_cache:
+            headers["Cache-Control"] = "no-cache"
+        try:
+            connection = self.connection()
+            connection.request('POST', entry["endpoint"], entry["payload"], headers)
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        except (OSError, http.client.HTTPException) as err:
+            self.local.connection = None
+            return type(err).__name__
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = defaultdict(list)  # endpoint -> [(status, seconds)]
+        self.lock = threading.Lock()
+
+    def add(self, endpoint, status, seconds):
+        with self.lock:
+            self.samples[endpoint].append((status, seconds))
+
+
+def percentile(sorted_values, q):
+    if len(sorted_values) == 0:
+        return float('nan')
+    # nearest rank
+    index = min(len(sorted_values) - 1, max(0, math.ceil(q / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def next_entry(entries, state, lock):
+    with lock:
+        entry = entries[state["next"] % len(entries)]
+        state["next"] += 1
+        return entry
+
+
+def run_closed(client, entries, args, recorder):
+    lock = threading.Lock()
+    state = {"next": 0}
+    end_time = time.perf_counter() + args.duration
+
+    def loop():
+        while time.perf_counter() < end_time:
+            with lock:
+                if args.requests and state["next"] >= args.requests:
+                    return
+            entry = next_entry(entries, state, lock)
+            start = time.perf_counter()
+            status = client.send(entry, args.keep_sessions, args.use_cache)
+            recorder.add(entry["endpoint"], status, time.perf_counter() - start)
+
+    threads = [threading.Thread(target=loop, daemon=True) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def arrival_times(entries, args):
+    '''Seconds after the start at which each request is sent.'''
+    count = args.requests or (len(entries) if not args.rate else None)
+    if args.rate:
+        rng = random.Random(args.seed)
+        at = 0.0
+        i = 0
+        while (count is None or i < count) and at < args.duration:
+            yield i, at
+            at += rng.expovariate(args.rate)
+            i += 1
+    else:
+        # the captured pace, looped if --requests asks for more
+        span = entries[-1]["time"] - entries[0]["time"]
+        for i in range(count):
+            loop, offset = divmod(i, len(entries))
+            at = (loop * (span + 1) + entries[offset]["time"] - entries[0]["time"]) / args.speed
+            if at >= args.duration:
+                return
+            yield i, at
+
+
+def run_open(client, entries, args, recorder):
+    semaphore = threading.Semaphore(args.concurrency)
+    dropped = 0
+    threads = []
+    start_time = time.perf_counter()
+
+    def send(entry, scheduled):
+        try:
+            status = client.send(entry, args.keep_sessions, args.use_cache)
+            recorder.add(entry["endpoint"], status, time.perf_counter() - scheduled)
+        finally:
+            semaphore.release()
+
+    for i, at in arrival_times(entries, args):
+        scheduled = start_time + at
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        # --concurrency caps the requests in flight, the rest are counted as dropped
+        if not semaphore.acquire(blocking=False):
+            dropped += 1
+            continue
+        thread = threading.Thread(
+            target=send, args=(entries[i % len(entries)], scheduled), daemon=True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return dropped
+
+
+def parse_phase_seconds(text):
+    '''(role, phase) -> (sum, count) of coedpilot_phase_seconds, across workers.'''
+    totals = defaultdict(lambda: [0.0, 0])
+    for line in text.splitlines():
+        if not line.startswith('coedpilot_phase_seconds_sum') and \
+                not line.startswith('coedpilot_phase_seconds_count'):
+            continue
+        name_labels, value = line.rsplit(' ', 1)
+        name, labels = name_labels.split('{', 1)
+        labels = dict(it.split('=', 1) for it in labels.rstrip('}').split('",'))
+        labels = {key: value.strip('"') for key, value in labels.items()}
+        key = (labels["role"], labels["phase"])
+        totals[key][0 if name.endswith('_sum') else 1] += float(value)
+    return totals
+
+
+def phase_report(before, after):
+    report = dict()
+    for key, (total, count) in after.items():
+        total -= before.get(key, (0.0, 0))[0]
+        count -= before.get(key, (0.0, 0))[1]
+        if count > 0:
+            report[f'{key[0]}/{key[1]}'] = {"count": int(count), "meanMs": 1000 * total / count}
+    return report
+
+
+def summarize(recorder, elapsed):
+    report = dict()
+    all_samples = []
+    for endpoint, samples in sorted(recorder.samples.items()):
+        all_samples.extend(samples)
+        report[endpoint] = summarize_samples(samples, elapsed)
+    report["all"] = summarize_samples(all_samples, elapsed)
+    return report
+
+
+def summarize_samples(samples, elapsed):
+    statuses = defaultdict(int)
+    for status, _ in samples:
+        statuses[str(status)] += 1
+    latencies = sorted(seconds for status, seconds in samples if status == 200)
+    return {
+        "requests": len(samples),
+        "ok": len(latencies),
+        "statuses": dict(statuses),
+        "throughput": len(latencies) / elapsed if elapsed > 0 else 0,
+        "p50Ms": 1000 * percentile(latencies, 50),
+        "p95Ms": 1000 * percentile(latencies, 95),
+        "p99Ms": 1000 * percentile(latencies, 99),
+        "maxMs": 1000 * latencies[-1] if latencies else float('nan')
+    }
+
+
+def print_report(report):
+    print(f"{'endpoint':<16}{'requests':>9}{'ok':>7}{'req/s':>9}"
+          f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}  statuses")
+    for endpoint, it in report["endpoints"].items():
+        print(f"{endpoint:<16}{it['requests']:>9}{it['ok']:>7}{it['throughput']:>9.2f}"
+              f"{it['p50Ms']:>10.1f}{it['p95Ms']:>10.1f}{it['p99Ms']:>10.1f}{it['maxMs']:>10.1f}"
+              f"  {it['statuses']}")
+    if report["dropped"]:
+        print(f"dropped (over --concurrency in flight): {report['dropped']}")
+    if report["phases"]:
+        print("\nserver phases (mean over this run):")
+        for phase, it in sorted(report["phases"].items()):
+            print(f"  {phase:<50}{it['count']:>7}{it['meanMs']:>10.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay captured requests against the model server.')
+    parser.add_argument('capture', help='JSON lines written by [capture] Path')
+    parser.add_argument('--url', default='http://127.0.0.1:5003')
+    parser.add_argument('--mode', choices=['closed', 'open'], default='closed')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='clients (closed loop) or max requests in flight (open loop)')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='open loop: requests per second, 0 for the captured pace')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='open loop without --rate: replay this many times faster')
+    parser.add_argument('--duration', type=float, default=60, help='seconds')
+    parser.add_argument('--requests', type=int, default=0, help='stop after this many, 0 for no limit')
+    parser.add_argument('--endpoints', nargs='*', default=[],
+                        help='e.g. /content /range, default all')
+    parser.add_argument('--keep-sessions', action='store_true',
+                        help='send the captured X-Session-Id, so newer requests cancel older ones')
+    parser.add_argument('--use-cache', action='store_true',
+                        help='allow result cache hits, off by default to measure the models')
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='also write the report here as JSON')
+    args = parser.parse_args()
+
+    entries = load_capture(args.capture, args.endpoints)
+    if len(entries) == 0:
+        print(f'No requests to replay in {args.capture}')
+        sys.exit(1)
+    client = Client(args.url, args.timeout)
+    try:
+        phases_before = parse_phase_seconds(client.get('/metrics'))
+    except (OSError, http.client.HTTPException):
+        phases_before = None
+        print('+++ /metrics unavailable, server phase timings are skipped')
+
+    recorder = Recorder()
+    start_time = time.perf_counter()
+    dropped = 0
+    if args.mode == 'closed':
+        run_closed(client, entries, args, recorder)
+    else:
+        dropped = run_open(client, entries, args, recorder)
+    elapsed = time.perf_counter() - start_time
+
+    phases = dict()
+    if phases_before is not None:
+        phases = phase_report(phases_before, parse_phase_seconds(client.get('/metrics')))
+    report = {
+        "mode": args.mode,
+        "concurrency": args.concurrency,
+        "rate": args.rate,
+        "elapsedSeconds": elapsed,
+        "dropped": dropped,
+        "endpoints": summarize(recorder, elapsed),
+        "phases": phases
+    }
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,10 +4,14 @@ import math
 
 from .model import Seq2Seq
 from tqdm import tqdm
-from torch.utils.data import DataLoader, SequentialSampler, TensorDataset
 from transformers import (RobertaConfig, RobertaModel, RobertaTokenizer)
 from perf import Stopwatch
-from model_manager import load_model_with_cache
+from model_manager import load_model_with_cache, get_tokenizer, build_encoder
+from batching import get_batcher, trim_padding
+import backends
+from cancellation import checkpoint
+from tracing import span
+from metrics import files_processed, windows_processed, tokens_processed, masks_processed
 import json
 
 CODE_WINDOW_LENGTH = 10
@@ -130,12 +134,11 @@ def load_model(model_path):
         device = torch.device('mps')
     else:
         device = torch.device('cpu')
-    config_class, model_class, tokenizer_class = (
-        RobertaConfig, RobertaModel, RobertaTokenizer)
-    config = config_class.from_pretrained("microsoft/codebert-base")
-    tokenizer = tokenizer_class.from_pretrained("microsoft/codebert-base")
-    encoder = model_class.from_pretrained(
-        "microsoft/codebert-base", config=config)
+    config = RobertaConfig.from_pretrained("microsoft/codebert-base")
+    # shared with the generator
+    tokenizer = get_tokenizer("microsoft/codebert-base")
+    # every weight comes from the checkpoint, skip the pretrained ones
+    encoder = build_encoder(config)
     model = Seq2Seq(encoder=encoder, config=config,
                     beam_size=10, max_length=512,
                     sos_id=tokenizer.cls_token_id, eos_id=tokenizer.sep_token_id, mask_id=tokenizer.mask_token_id)
@@ -144,6 +147,33 @@ def load_model(model_path):
     return model, tokenizer, device
 
 
+def make_batch_fn(model, tokenizer, device, language):
+    '''
+    Build the function run by the batcher: takes (source_ids, source_mask)
+    rows from any number of requests, returns for each row the predicted
+    label ids and confidences at its <mask> positions.
+    '''
+    model.eval()
+    # PyTorch, or an ONNX Runtime or TorchScript export, see backends.py
+    runner = backends.get_runner(MODEL_ROLE, language, model, device)
+
+    def batch_fn(rows, tokens):
+        source_ids = torch.tensor([row[0] for row in rows], dtype=torch.long)
+        source_mask = torch.tensor([row[1] for row in rows], dtype=torch.long)
+        source_ids, source_mask = trim_padding(source_ids, source_mask)
+        label_ids, confidences = runner(source_ids, source_mask)
+        outputs = []
+        for i in range(label_ids.shape[0]):
+            masked = source_ids[i] == tokenizer.mask_token_id
+            outputs.append((
+                label_ids[i][masked].tolist(),
+                confidences[i][masked].tolist()
+            ))
+        return outputs
+
+    return batch_fn
+
+
 def normalize_string(s):
 # if not isinstance(s,     if)        return s
 #    # 当检测到 s 含有 ' 时，进行转义
@@ -180,6 +210,74 @@ def merge_adjacent_removals(results):
     return merged_results
 
 
+def build_windows(file_lines, tokenizer, commit_message, prev_edits):
+    '''
+    Cut the lines of a file into model inputs of at most CODE_WINDOW_LENGTH
+    masked lines and 508 tokens, each followed by the commit message and the
+    previous edits.
+    '''
+    model_inputs = []
+    window_token_cnt = 0
+    window_line_cnt = 0
+    window_text = ""
+
+    def try_feed_in_window(text):
+        nonlocal window_token_cnt, window_line_cnt, window_text
+        masked_line = " <mask> " + text
+        masked_line_token_cnt = len(tokenizer.tokenize(masked_line))
+        if window_token_cnt + masked_line_token_cnt < 508 and window_line_cnt < CODE_WINDOW_LENGTH:
+            window_token_cnt += masked_line_token_cnt
+            window_line_cnt += 1
+            window_text += masked_line
+            return True
+        else:
+            return False
+
+    def end_window():
+        nonlocal window_token_cnt, window_line_cnt, window_text
+        if len(window_text) > 0:  # 只有在窗口有内容时才处理
+            model_input = window_text + ' </s> ' + commit_message
+            for prevEdit in prev_edits:
+                model_input += ' </s> replace ' + \
+                    prevEdit["beforeEdit"] + ' add ' + prevEdit["afterEdit"]
+            model_inputs.append(model_input)
+        window_token_cnt = 0
+        window_line_cnt = 0
+        window_text = ""
+
+    i = 0
+    while i < len(file_lines):
+        cur_line = file_lines[i]
+        if try_feed_in_window(cur_line):
+            i += 1
+        else:
+            if window_line_cnt == 0:    # the first line is longer than window limit
+                while True:
+                    cur_line = cur_line[:len(cur_line) // 2]
+                    if try_feed_in_window(cur_line):
+                        break
+                i += 1
+            else:
+                end_window()
+    end_window()
+    return model_inputs
+
+
+def cache_inputs(json_input):
+    '''The part of a request the prediction depends on, for the result cache.'''
+    return {
+        "files": json_input["files"],
+        "commitMessage": json_input["commitMessage"],
+        "prevEdits": [[it["beforeEdit"], it["afterEdit"]]
+                      for it in json_input["prevEdits"]]
+    }
+
+
+def preload(language):
+    '''Load the model for `language` ahead of the first request.'''
+    load_model_with_cache(MODEL_ROLE, language, load_model)
+
+
 def predict(json_input, language):
     '''
     Function: interface between locator and VScode extension
@@ -211,6 +309,8 @@ def predict(json_input, language):
     # check model cache
     model, tokenizer, device = load_model_with_cache(
         MODEL_ROLE, language, load_model)
+    batcher = get_batcher(MODEL_ROLE, language,
+                          lambda: make_batch_fn(model, tokenizer, device, language))
     stopwatch.lap('load model')
 
     # 提取从 JavaScript 传入的参数
@@ -221,61 +321,17 @@ def predict(json_input, language):
     print("+++ Prev Edits:")
     print(json.dumps(prevEdits, indent=4))
 
-    window_token_cnt = 0
-    window_line_cnt = 0
-    window_text = ""
-
-    def try_feed_in_window(text, line_idx):
-        nonlocal window_token_cnt, window_line_cnt, window_text
-        masked_line = " <mask> " + text
-        masked_line_token_cnt = len(tokenizer.tokenize(masked_line))
-        if window_token_cnt + masked_line_token_cnt < 508 and window_line_cnt < 10:
-            window_token_cnt += masked_line_token_cnt
-            window_line_cnt += 1
-            window_text += masked_line
-            return True
-        else:
-            return False
-
-    def end_window(input_list):
-        nonlocal prevEdits, commitMessage, window_token_cnt, window_line_cnt, window_text
-        if len(window_text) > 0:  # 只有在窗口有内容时才处理
-            model_input = window_text + ' </s> ' + commitMessage
-            for prevEdit in prevEdits:
-                model_input += ' </s> replace ' + \
-                    prevEdit["beforeEdit"] + ' add ' + prevEdit["afterEdit"]
-            input_list.append(model_input)
-        window_token_cnt = 0
-        window_line_cnt = 0
-        window_text = ""
-
     # 获取每个文件的内容
     for file in files:
+        checkpoint()
         targetFilePath = file[0]
         targetFileContent = file[1]
         # 获取文件行数
         targetFileLines = targetFileContent.splitlines(True)  # 保留每行的换行符
         targetFileLineNum = len(targetFileLines)
 
-        model_inputs = []
-
-        i = 0
-        while i < targetFileLineNum:
-            cur_line = targetFileLines[i]
-            if try_feed_in_window(cur_line, i):
-                i += 1
-            else:
-                if window_line_cnt == 0:    # the first line is longer than window limit
-                    while True:
-                        cur_line = cur_line[:len(cur_line) // 2]
-                        if try_feed_in_window(cur_line):
-                            break
-                        attempts += 1
-                    i += 1
-                else:
-                    end_window(model_inputs)
-        if len(window_text) > 0:
-            end_window(model_inputs)
+        model_inputs = build_windows(
+            targetFileLines, tokenizer, commitMessage, prevEdits)
         stopwatch.lap_by_task('assemble input text')
 
         # 在处理完所有窗口后
@@ -286,54 +342,25 @@ def predict(json_input, language):
             print(f"Window {idx}: {mask_count} masks")
             total_masks += mask_count
         print(f"Total masks: {total_masks} with target file lines: {targetFileLineNum}")
-        # prepare model input (tensor format)
+        files_processed.inc(MODEL_ROLE, language)
+        windows_processed.inc(MODEL_ROLE, language, amount=len(model_inputs))
+        masks_processed.inc(language, amount=total_masks)
+        # prepare model input and run model, windows of concurrent requests
+        # share batches
         examples = read_examples(model_inputs)
-        eval_features = convert_examples_to_features(
-            examples, tokenizer, stage='test')
-        all_source_ids = torch.tensor(
-            [f.source_ids for f in eval_features], dtype=torch.long)
-        all_source_mask = torch.tensor(
-            [f.source_mask for f in eval_features], dtype=torch.long)
-        all_target_ids = torch.tensor(
-            [f.target_ids for f in eval_features], dtype=torch.long)
-        all_target_mask = torch.tensor(
-            [f.target_mask for f in eval_features], dtype=torch.long)
-        eval_data = TensorDataset(all_source_ids, all_source_mask, all_target_ids, all_target_mask)   
-
-        eval_sampler = SequentialSampler(eval_data)
-        eval_dataloader = DataLoader(
-            eval_data,
-            sampler=eval_sampler,
-            batch_size=10,
-            shuffle=False)
-
-        # run model
-        model.eval()
+        with span('tokenize windows', windows=len(model_inputs)):
+            eval_features = convert_examples_to_features(
+                examples, tokenizer, stage='test')
+        rows = [(f.source_ids, f.source_mask) for f in eval_features]
+        tokens_processed.inc(MODEL_ROLE, language,
+                             amount=sum(sum(row[1]) for row in rows))
         preds = []
         confidences = []
-        softmax = torch.nn.Softmax(dim=-1)
-        for batch in tqdm(eval_dataloader, total=len(eval_dataloader)):
-            batch = tuple(t.to(device) for t in batch)
-            source_ids, source_mask,target_ids,target_mask = batch                  
-            with torch.no_grad():
-                lm_logits = model(source_ids=source_ids, source_mask=source_mask, target_ids=target_ids,target_mask=target_mask, train=False).to('cpu')
-                # extract masked edit operations
-                for i in range(lm_logits.shape[0]):  # for sample within batch
-                    output = []
-                    confidence = []
-                    for j in range(lm_logits.shape[1]):  # for every token
-                        if source_ids[i][j] == tokenizer.mask_token_id: # if is masked
-                            output.append(
-                                            tokenizer.decode(
-                                                torch.argmax(lm_logits[i][j]),
-                                                clean_up_tokenization_spaces=False
-                                            )
-                                        )
-                            confidence.append(
-                                softmax(lm_logits[i][j]).max().item()
-                            )
-                    preds.extend(output)
-                    confidences.extend(confidence)
+        for pred_ids, confidence in batcher.submit(rows):
+            preds.extend(
+                tokenizer.decode(pred_id, clean_up_tokenization_spaces=False)
+                for pred_id in pred_ids)
+            confidences.extend(confidence)
 
         if len(preds) != targetFileLineNum:
             # TODO: solve this problem when some lines are too long
@@ -374,6 +401,7 @@ def predict(json_input, language):
     stopwatch.lap('post-process result')
     print("+++ Locator profiling:")
     stopwatch.print_result()
+    stopwatch.record(MODEL_ROLE, language)
 
     # # 重新组织预测结果
     # final_preds = [None] * targetFileLineNum
@@ -4,6 +4,7 @@
 import torch
 import torch.nn as nn
 import torch
+from tracing import span
 
 
 class Seq2Seq(nn.Module):
@@ -26,7 +27,6 @@ class Seq2Seq(nn.Module):
         super(Seq2Seq, self).__init__()
         self.encoder = encoder
         self.config = config
-        self.register_buffer("bias", torch.tril(torch.ones(2048, 2048)))
         self.dense = nn.Linear(config.hidden_size, config.hidden_size)
         self.lm_head = nn.Linear(
             config.hidden_size,
@@ -40,8 +40,11 @@ class Seq2Seq(nn.Module):
         self.sos_id = sos_id
         self.eos_id = eos_id
         self.mask_id = mask_id
-        self.label_weight = torch.zeros(config.vocab_size)
-        self.label_weight[self.mask_id] = 1.0
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints from before the causal mask was built on the fly
+        state_dict.pop(prefix + 'bias', None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def _tie_or_clone_weights(self, first_module, second_module):
         """ Tie or clone module weights depending of weither we are using TorchScript or not
@@ -60,11 +63,13 @@ class Seq2Seq(nn.Module):
 
     def forward(self, source_ids=None, source_mask=None,
                 target_ids=None, target_mask=None, train=True):
-        outputs = self.encoder(source_ids, attention_mask=source_mask)
-        encoder_output = outputs[0].permute([1, 0, 2]).contiguous()
-        hidden_states = torch.tanh(self.dense(
-            encoder_output)).permute([1, 0, 2]).contiguous()
-        lm_logits = self.lm_head(hidden_states).contiguous()
+        with span('encoder', shape=list(source_ids.shape)):
+            outputs = self.encoder(source_ids, attention_mask=source_mask)
+            encoder_output = outputs[0].permute([1, 0, 2]).contiguous()
+        with span('lm_head'):
+            hidden_states = torch.tanh(self.dense(
+                encoder_output)).permute([1, 0, 2]).contiguous()
+            lm_logits = self.lm_head(hidden_states).contiguous()
         if train:
             # Flatten the tokens
             active_loss = (source_ids == self.mask_id).contiguous(
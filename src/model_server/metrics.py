@@ -0,0 +1,164 @@
+import bisect
+import threading
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60)
+
+registry = []
+collectors = []
+
+
+def format_labels(names, values):
+    if len(names) == 0:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class Metric:
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = dict()
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def _key(self, labels):
+        if len(labels) != len(self.label_names):
+            raise ValueError(
+                f'{self.name} expects labels {self.label_names}, got {labels}')
+        return tuple(str(it) for it in labels)
+
+    def header(self):
+        return [f'# HELP {self.name} {self.documentation}',
+                f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, *labels):
+        return self._values.get(self._key(labels), 0)
+
+    def items(self):
+        with self._lock:
+            return list(self._values.items())
+
+    def render(self):
+        with self._lock:
+            return [f'{self.name}{format_labels(self.label_names, key)} {value}'
+                    for key, value in self._values.items()]
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, *labels, value):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def render(self):
+        with self._lock:
+            return [f'{self.name}{format_labels(self.label_names, key)} {value}'
+                    for key, value in self._values.items()]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, *labels, value):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # per-bucket counts (not cumulative), +Inf last, then sum
+                state = [[0] * (len(self.buckets) + 1), 0.0]
+                self._values[key] = state
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    labels = format_labels(
+                        self.label_names + ('le',), key + (str(bound),))
+                    lines.append(f'{self.name}_bucket{labels} {cumulative}')
+                labels = format_labels(self.label_names, key)
+                lines.append(f'{self.name}_sum{labels} {total}')
+                lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+def register_collector(collector):
+    '''
+    `collector()` is called on every scrape and returns (metric name, kind,
+    documentation, [(labels dict, value), ...]) tuples, for values that are
+    cheaper to read on demand than to keep up to date.
+    '''
+    collectors.append(collector)
+
+
+def render():
+    '''Render every metric in the Prometheus text exposition format.'''
+    lines = []
+    for metric in registry:
+        lines.extend(metric.header())
+        lines.extend(metric.render())
+    for collector in collectors:
+        for name, kind, documentation, samples in collector():
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                lines.append(
+                    f'{name}{format_labels(tuple(labels.keys()), tuple(labels.values()))} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+phase_seconds = Histogram(
+    'coedpilot_phase_seconds', 'Time spent in each phase of a predict call.',
+    ('role', 'language', 'phase'))
+request_seconds = Histogram(
+    'coedpilot_request_seconds', 'End-to-end predict request latency.',
+    ('role', 'language', 'status'))
+files_processed = Counter(
+    'coedpilot_files_total', 'Workspace files processed.', ('role', 'language'))
+windows_processed = Counter(
+    'coedpilot_windows_total', 'Code windows fed to a model.', ('role', 'language'))
+tokens_processed = Counter(
+    'coedpilot_tokens_total', 'Non-padding input tokens fed to a model encoder.',
+    ('role', 'language'))
+masks_processed = Counter(
+    'coedpilot_masks_total', 'Masked lines labelled by the locator.', ('language',))
+beam_steps = Counter(
+    'coedpilot_beam_steps_total', 'Generator beam search decode steps.', ('language',))
+model_loads = Counter(
+    'coedpilot_model_loads_total', 'Models loaded.', ('role', 'language'))
+model_load_seconds = Histogram(
+    'coedpilot_model_load_seconds', 'Time to load a model.', ('role', 'language'))
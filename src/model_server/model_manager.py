@@ -1,27 +1,393 @@
 import os
-
-model_info_cache = dict()
+import time
+import threading
+from contextlib import contextmanager
+import batching
+import fixtures
+import snapshot
+import quantization
+from metrics import Counter, register_collector, model_loads, model_load_seconds
 
 BASE_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'models')
 
+# Defaults, overridden by the [models] section of server.ini
+MEMORY_BUDGET_MB = 0  # 0 keeps every model loaded
+EVICTION = 'lru'  # or 'lfu'
+USE_SNAPSHOTS = True
+
+model_evictions = Counter(
+    'coedpilot_model_evictions_total', 'Models unloaded to stay within the memory budget.',
+    ('role', 'language'))
+
 
 def get_model_path(model_role, language):
-    print(BASE_DIR)
+    if model_role == 'dependency':
+        # shared by all languages, in the directory the analyzer was released in
+        return os.path.join(BASE_DIR, 'dependency-analyzer', 'pytorch_model.bin')
     return os.path.join(BASE_DIR, language, f'{model_role}_model.bin')
 
 
-def load_model_with_cache(model_role, language, model_loader):
+def get_snapshot_dir(model_role, language):
+    return os.path.join(BASE_DIR, language, f'{model_role}_snapshot')
+
+
+def get_quantized_dir(model_role, language):
+    return os.path.join(BASE_DIR, language, f'{model_role}_int8')
+
+
+def get_model_version(model_role, language):
+    '''Identify the model a role would load: its checkpoint and whether it is quantized.'''
+    version = get_checkpoint_version(model_role, language)
+    if quantization.is_enabled(model_role, language):
+        version += '-int8'
+    return version
+
+
+def get_checkpoint_version(model_role, language):
+    '''Identify the checkpoint a role would load, by size and modification time.'''
+    if fixtures.ENABLED:
+        return fixtures.version()
+    version = get_file_version(get_model_path(model_role, language))
+    if version is None:
+        version = get_file_version(os.path.join(
+            get_snapshot_dir(model_role, language), snapshot.WEIGHTS_FILE))
+    return version or 'absent'
+
+
+def get_file_version(path):
+    '''Size and modification time of a file, or None if it doesn't exist.'''
     try:
-        model_info = model_info_cache[model_role][language]
-    except Exception as err:
-        print(
-            f"+++ Model type: {model_role} is not loaded for language: {language}. Trying to load model...")
-        model_info = model_loader(get_model_path(model_role, language))
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return f'{stat.st_size}-{stat.st_mtime_ns}'
+
+
+def measure_bytes(model_info):
+    '''
+    (parameter bytes, buffer bytes) of the torch modules in what a loader
+    returned. Tied weights count once.
+    '''
+    items = model_info if isinstance(model_info, (tuple, list)) else (model_info,)
+    seen = set()
+    parameter_bytes = 0
+    buffer_bytes = 0
+
+    def size(tensor):
+        if tensor.data_ptr() in seen:
+            return 0
+        seen.add(tensor.data_ptr())
+        return tensor.numel() * tensor.element_size()
+
+    for item in items:
+        # e.g. DependencyClassifier keeps its module in `.model`
+        module = item if hasattr(item, 'named_parameters') else getattr(item, 'model', None)
+        if not hasattr(module, 'named_parameters'):
+            continue
+        parameter_bytes += sum(size(tensor) for tensor in module.parameters())
+        # int8 Linear layers keep their weights in packed params instead
+        parameter_bytes += sum(
+            size(it.weight()) for it in module.modules()
+            if hasattr(it, '_packed_params') and callable(getattr(it, 'weight', None)))
+        buffer_bytes += sum(size(tensor) for tensor in module.buffers())
+    return parameter_bytes, buffer_bytes
+
+
+def estimate_bytes(model_info):
+    '''Bytes held by the tensors of the torch modules in what a loader returned.'''
+    return sum(measure_bytes(model_info))
+
+
+def get_rss_bytes():
+    '''Resident set size of this process, or 0 where /proc is unavailable.'''
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+tokenizers = dict()
+tokenizers_lock = threading.Lock()
+
+
+def get_tokenizer(name, fast=False, added_tokens=()):
+    '''
+    One tokenizer instance per name, class and added tokens, shared by every
+    role and language that uses it, e.g. the locator and generator models.
+    '''
+    key = (name, fast, tuple(added_tokens))
+    with tokenizers_lock:
+        if key not in tokenizers:
+            from transformers import RobertaTokenizer, RobertaTokenizerFast
+            tokenizer_class = RobertaTokenizerFast if fast else RobertaTokenizer
+            tokenizer = tokenizer_class.from_pretrained(name)
+            if added_tokens:
+                tokenizer.add_tokens(list(added_tokens), special_tokens=True)
+            tokenizers[key] = tokenizer
+        return tokenizers[key]
+
+
+def build_encoder(config):
+    '''
+    A RoBERTa encoder of `config` with uninitialized weights, for loaders
+    that overwrite every weight from a checkpoint anyway.
+    '''
+    from transformers import RobertaModel
+    from transformers.modeling_utils import no_init_weights
+    with no_init_weights():
+        return RobertaModel(config)
+
 
-        if model_role not in model_info_cache:
-            model_info_cache[model_role] = dict()
-        model_info_cache[model_role][language] = model_info
+class ModelEntry:
+    def __init__(self):
+        self.value = None
+        self.size_bytes = 0
+        self.parameter_bytes = 0
+        self.buffer_bytes = 0
+        self.rss_delta_bytes = 0
+        self.refs = 0
+        self.uses = 0
+        self.last_used = time.monotonic()
+        self.loaded = threading.Event()
+        self.error = None
+
+
+class ModelRegistry:
+    """
+        Models shared by all requests, keyed by role and language.
+
+        A model is loaded once, however many requests ask for it at the same
+        time, and is held by a reference count while a request uses it.
+        Beyond `memory_budget` bytes (0 for no limit) the least recently used
+        (or, with policy 'lfu', least used) unreferenced models are unloaded,
+        together with their batchers. If every resident model is in use the
+        budget is exceeded rather than failing the request.
+    """
+
+    def __init__(self, memory_budget=0, policy='lru'):
+        self.memory_budget = memory_budget
+        self.policy = policy
+        self._entries = dict()
+        self._lock = threading.Lock()
+
+    def resident_bytes(self):
+        with self._lock:
+            return sum(entry.size_bytes for entry in self._entries.values())
+
+    def acquire(self, model_role, language, model_loader):
+        '''Return the model, loading it if needed. Call release() when done.'''
+        key = (model_role, language)
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is None:
+                    entry = ModelEntry()
+                    entry.refs = 1
+                    self._entries[key] = entry
+                    loading = True
+                else:
+                    entry.refs += 1
+                    loading = False
+            if loading:
+                return self._load(key, entry, model_loader)
+            entry.loaded.wait()
+            if entry.error is None:
+                with self._lock:
+                    entry.uses += 1
+                    entry.last_used = time.monotonic()
+                return entry.value
+            # the load this request waited for failed, try again
+            with self._lock:
+                entry.refs -= 1
+
+    def _load(self, key, entry, model_loader):
+        model_role, language = key
+        model_path = get_model_path(model_role, language)
+        try:
+            expected = os.path.getsize(model_path)
+        except OSError:
+            expected = 0
+        with self._lock:
+            self._make_room(expected)
 
         print(
-            f"+++ Model type: {model_role} for language: {language} is loaded")
+            f"+++ Model type: {model_role} is not loaded for language: {language}. Trying to load model from {model_path}...")
+        start_time = time.perf_counter()
+        # approximate if other models load at the same time
+        rss_before = get_rss_bytes()
+        try:
+            value = model_loader(model_path)
+        except BaseException as err:
+            with self._lock:
+                del self._entries[key]
+            entry.error = err
+            entry.loaded.set()
+            raise
+        model_loads.inc(model_role, language)
+        model_load_seconds.observe(
+            model_role, language, value=time.perf_counter() - start_time)
+
+        rss_delta = get_rss_bytes() - rss_before
+        parameter_bytes, buffer_bytes = measure_bytes(value)
+        with self._lock:
+            entry.value = value
+            entry.parameter_bytes = parameter_bytes
+            entry.buffer_bytes = buffer_bytes
+            entry.size_bytes = parameter_bytes + buffer_bytes
+            entry.rss_delta_bytes = rss_delta
+            entry.uses = 1
+            entry.last_used = time.monotonic()
+            self._make_room(0)
+            resident = sum(it.size_bytes for it in self._entries.values())
+        entry.loaded.set()
+        print(
+            f"+++ Model type: {model_role} for language: {language} is loaded, "
+            f"{entry.parameter_bytes / 2 ** 20:.1f} MiB parameters, "
+            f"{entry.buffer_bytes / 2 ** 20:.1f} MiB buffers, RSS {rss_delta / 2 ** 20:+.1f} MiB, "
+            f"{resident / 2 ** 20:.1f} MiB resident")
+        return value
+
+    def release(self, model_role, language):
+        with self._lock:
+            entry = self._entries.get((model_role, language))
+            if entry is not None and entry.refs > 0:
+                entry.refs -= 1
+                if entry.refs == 0:
+                    # catch up if models in use pushed us over the budget
+                    self._make_room(0)
+
+    def _make_room(self, needed):
+        '''Unload unreferenced models until `needed` more bytes fit. Call with the lock held.'''
+        if self.memory_budget <= 0:
+            return
+        resident = sum(entry.size_bytes for entry in self._entries.values())
+        if resident + needed <= self.memory_budget:
+            return
+        if self.policy == 'lfu':
+            def order(item): return (item[1].uses, item[1].last_used)
+        else:
+            def order(item): return item[1].last_used
+        idle = sorted(((key, entry) for key, entry in self._entries.items()
+                       if entry.refs == 0 and entry.loaded.is_set()), key=order)
+        for key, entry in idle:
+            if resident + needed <= self.memory_budget:
+                break
+            self._evict(key, entry)
+            resident -= entry.size_bytes
+        if resident + needed > self.memory_budget:
+            print(f"+++ Models in use need {(resident + needed) / 2 ** 20:.1f} MiB, "
+                  f"over the {self.memory_budget / 2 ** 20:.1f} MiB budget")
+
+    def _evict(self, key, entry):
+        model_role, language = key
+        del self._entries[key]
+        batching.drop_batcher(model_role, language)
+        model_evictions.inc(model_role, language)
+        print(f"+++ Model type: {model_role} for language: {language} is unloaded, "
+              f"freed {entry.size_bytes / 2 ** 20:.1f} MiB")
+
+    def evict(self, model_role, language):
+        '''Unload a model now unless a request is using it. Returns whether it was unloaded.'''
+        key = (model_role, language)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.refs > 0 or not entry.loaded.is_set():
+                return False
+            self._evict(key, entry)
+            return True
+
+    def stats(self):
+        with self._lock:
+            models = [{
+                "role": key[0],
+                "language": key[1],
+                "bytes": entry.size_bytes,
+                "parameterBytes": entry.parameter_bytes,
+                "bufferBytes": entry.buffer_bytes,
+                "rssDeltaBytes": entry.rss_delta_bytes,
+                "refs": entry.refs,
+                "uses": entry.uses,
+                "loaded": entry.loaded.is_set()
+            } for key, entry in self._entries.items()]
+        return {
+            "memoryBudget": self.memory_budget,
+            "residentBytes": sum(it["bytes"] for it in models),
+            "policy": self.policy,
+            "rssBytes": get_rss_bytes(),
+            "models": models
+        }
+
+
+registry = ModelRegistry()
+thread_state = threading.local()
+
+
+def configure(config):
+    global MEMORY_BUDGET_MB, EVICTION, USE_SNAPSHOTS
+    if not config.has_section('models'):
+        return
+    section = config['models']
+    MEMORY_BUDGET_MB = section.getint('MemoryBudgetMb', MEMORY_BUDGET_MB)
+    EVICTION = section.get('Eviction', EVICTION).strip().lower()
+    USE_SNAPSHOTS = section.getboolean('UseSnapshots', USE_SNAPSHOTS)
+    registry.memory_budget = MEMORY_BUDGET_MB * 2 ** 20
+    registry.policy = EVICTION
+
+
+@contextmanager
+def request_scope():
+    '''
+    Models returned by load_model_with_cache() inside this scope stay
+    referenced, so they can't be evicted, until the scope exits.
+    '''
+    outer = getattr(thread_state, 'held', None)
+    thread_state.held = []
+    try:
+        yield
+    finally:
+        held = thread_state.held
+        thread_state.held = outer
+        for model_role, language in held:
+            registry.release(model_role, language)
+
+
+def load_model_with_cache(model_role, language, model_loader):
+    # in fixture mode every role gets a small randomly initialized model
+    model_loader = fixtures.get_loader(model_role, model_loader)
+    snapshot_dir = get_snapshot_dir(model_role, language)
+    if USE_SNAPSHOTS and not fixtures.ENABLED and snapshot.is_available(snapshot_dir):
+        checkpoint_loader = model_loader
+
+        def model_loader(model_path):
+            # a snapshot of an older checkpoint would serve stale weights
+            if snapshot.is_current(snapshot_dir, get_file_version(model_path)):
+                return snapshot.load(model_role, snapshot_dir)
+            print(f"+++ Snapshot of {model_role} for {language} is older than its checkpoint, "
+                  f"loading the checkpoint. Run: python snapshot.py {language} {model_role}")
+            return checkpoint_loader(model_path)
+    if quantization.is_enabled(model_role, language):
+        # fixture models change with their settings, they aren't worth caching
+        model_loader = quantization.get_loader(
+            model_role, model_loader, get_quantized_dir(model_role, language),
+            get_checkpoint_version(model_role, language),
+            cache=quantization.CACHE and not fixtures.ENABLED)
+    model_info = registry.acquire(model_role, language, model_loader)
+    held = getattr(thread_state, 'held', None)
+    if held is not None:
+        held.append((model_role, language))
+    else:
+        # preloading, or a script without requests
+        registry.release(model_role, language)
     return model_info
+
+
+def collect_resident_bytes():
+    stats = registry.stats()
+    samples = [({"role": it["role"], "language": it["language"]}, it["bytes"])
+               for it in stats["models"] if it["loaded"]]
+    return [('coedpilot_model_resident_bytes', 'gauge',
+             'Memory held by the tensors of a loaded model.', samples)]
+
+
+register_collector(collect_resident_bytes)
@@ -1,46 +1,64 @@
 import time
-import pandas as pd
+from metrics import phase_seconds
+from tracing import current_trace, now_us
 
 
 class Stopwatch:
+    """
+        Time the phases of a predict call. Each lap is also added as a span to
+        the current request trace, if any.
+
+        `lap` starts a new row per call; `lap_by_task` adds the duration to
+        the row of the same task, for phases repeated in a loop.
+    """
+
     def __init__(self):
-        self.laps = pd.DataFrame(columns=['Phase', 'Task', 'Duration'])
+        self.laps = []          # [phase, task, duration]
+        self.task_rows = dict()  # task -> row in self.laps
 
     def start(self):
         self.last_time = time.perf_counter()
+        self.last_us = now_us()
+
+    def _trace(self, task):
+        trace = current_trace()
+        time_us = now_us()
+        if trace is not None:
+            trace.add_event(task, self.last_us, time_us)
+        self.last_us = time_us
 
     def lap(self, task=''):
         time_now = time.perf_counter()
         task = task.strip()
-        idx = len(self.laps)
-        self.laps.loc[idx] = [
-            idx + 1,
-            task,
-            time_now - self.last_time
-        ]
+        self.laps.append([len(self.laps) + 1, task, time_now - self.last_time])
+        self.task_rows.setdefault(task, self.laps[-1])
+        self._trace(task)
         self.last_time = time.perf_counter()
 
     def lap_by_task(self, task=''):
         time_now = time.perf_counter()
         task = task.strip()
-        idx = len(self.laps)
-        if self.laps.loc[self.laps['Task'] == task].empty:
-            self.laps.loc[idx] = [
-                idx + 1,
-                task,
-                time_now - self.last_time
-            ]
-        else:
-            self.laps.loc[self.laps['Task'] == task,
-                          'Duration'] += time_now - self.last_time
+        row = self.task_rows.get(task)
+        if row is None:
+            row = [len(self.laps) + 1, task, 0.0]
+            self.laps.append(row)
+            self.task_rows[task] = row
+        row[2] += time_now - self.last_time
+        self._trace(task)
         self.last_time = time.perf_counter()
 
+    def record(self, role, language):
+        '''Add the duration of every task to the phase latency histogram.'''
+        for _, task, duration in self.laps:
+            phase_seconds.observe(role, language, task, value=duration)
+
     def print_result(self):
-        print(self.laps.to_string(
-            index=False,
-            justify='center',
-            formatters={'Duration': lambda x: "{:.3f}".format(x)}
-        ))
+        rows = [['Phase', 'Task', 'Duration']] + \
+            [[str(phase), task, "{:.3f}".format(duration)]
+             for phase, task, duration in self.laps]
+        widths = [max(len(row[i]) for row in rows) for i in range(3)]
+        for row in rows:
+            print(' '.join(row[i].center(widths[i]) for i in range(3)))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,333 @@
+# Rank the discriminator's candidate files cheaply before the dependency analyzer.
+#
+# Usage: python prefilter.py CAPTURE.jsonl [options]
+# Example: python prefilter.py capture.jsonl --top-files 5 10 20 50 --output prefilter.json
+#
+# The dependency analyzer scores the hunk against every 10-line window of
+# every file, which makes it the bulk of a /discriminator request. With
+# [prefilter] enabled the files are first ranked by BM25 over their
+# identifiers, or by the share of the hunk's identifiers they contain, and
+# only the best TopFiles, those scoring at least KeepAbove times the best,
+# and optionally the EmbeddingTopFiles most similar by embedding, reach it.
+# The rest are predicted unrelated.
+#
+# Run as a script it replays captured /discriminator requests in this process
+# without the prefilter and reports, for each --top-files, the share of the
+# files selected then that the prefilter would keep (recall) and the share of
+# windows left for the dependency analyzer. Then it runs them again with the
+# [prefilter] settings and reports their recall and latency. Each run starts
+# without stored window embeddings, so the second doesn't reuse the first's.
+
+import re
+import os
+import sys
+import copy
+import json
+import math
+import time
+import hashlib
+import argparse
+import threading
+import statistics
+from collections import Counter as TermCounts, OrderedDict
+from metrics import Counter
+
+# Defaults, overridden by the [prefilter] section of server.ini
+ENABLED = False
+METHOD = 'bm25'  # or 'overlap'
+TOP_FILES = 20  # requests with no more files are not filtered
+KEEP_ABOVE = 0.0  # also keep files scoring this share of the best, 0 to disable
+EMBEDDING_TOP_FILES = 0  # also keep the files most similar by embedding
+MAX_CACHED_FILES = 4096
+
+METHODS = ['bm25', 'overlap']
+BM25_K1 = 1.2
+BM25_B = 0.75
+IDENTIFIER = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+SUBWORD = re.compile(r'[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+')
+
+prefilter_files = Counter(
+    'coedpilot_prefilter_files_total', 'Discriminator candidate files by prefilter outcome.',
+    ('result',))
+
+
+def configure(config):
+    global ENABLED, METHOD, TOP_FILES, KEEP_ABOVE, EMBEDDING_TOP_FILES
+    if not config.has_section('prefilter'):
+        return
+    section = config['prefilter']
+    ENABLED = section.getboolean('Enabled', ENABLED)
+    METHOD = section.get('Method', METHOD).strip().lower()
+    TOP_FILES = section.getint('TopFiles', TOP_FILES)
+    KEEP_ABOVE = section.getfloat('KeepAbove', KEEP_ABOVE)
+    EMBEDDING_TOP_FILES = section.getint('EmbeddingTopFiles', EMBEDDING_TOP_FILES)
+    if METHOD not in METHODS:
+        print(f"+++ Unknown prefilter method {METHOD}, using bm25")
+        METHOD = 'bm25'
+
+
+def applies(file_count):
+    return ENABLED and file_count > TOP_FILES
+
+
+def terms(text):
+    '''Identifiers and their lowercase subwords, e.g. getUserName: getusername, get, user, name.'''
+    found = []
+    for identifier in IDENTIFIER.findall(text):
+        found.append(identifier.lower())
+        subwords = [it.lower() for part in identifier.split('_') for it in SUBWORD.findall(part)]
+        if len(subwords) > 1:
+            found.extend(subwords)
+    return [it for it in found if len(it) > 1]
+
+
+class TermCache:
+    """Term counts of file contents, by content hash, the least recently used dropped."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, content):
+        key = hashlib.sha1(content.encode('utf-8')).digest()
+        with self._lock:
+            counts = self._entries.get(key)
+            if counts is not None:
+                self._entries.move_to_end(key)
+                return counts
+        counts = TermCounts(terms(content))
+        with self._lock:
+            self._entries[key] = counts
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return counts
+
+
+cache = TermCache(MAX_CACHED_FILES)
+
+
+def bm25_scores(query, documents):
+    '''BM25 of each document's term counts for the query terms, idf over `documents`.'''
+    lengths = [sum(counts.values()) for counts in documents]
+    average_length = max(sum(lengths) / len(documents), 1)
+    query = set(query)
+    frequencies = {term: sum(term in counts for counts in documents) for term in query}
+    idf = {term: math.log(1 + (len(documents) - n + 0.5) / (n + 0.5))
+           for term, n in frequencies.items()}
+    scores = []
+    for counts, length in zip(documents, lengths):
+        score = 0.0
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * length / average_length)
+        for term in query:
+            count = counts.get(term, 0)
+            if count:
+                score += idf[term] * count * (BM25_K1 + 1) / (count + norm)
+        scores.append(score)
+    return scores
+
+
+def overlap_scores(query, documents):
+    '''The share of the distinct query terms in each document.'''
+    query = set(query)
+    if not query:
+        return [0.0] * len(documents)
+    return [sum(term in counts for term in query) / len(query) for counts in documents]
+
+
+def lexical_scores(hunk, contents, method=None):
+    '''Score of each file content against the hunk text.'''
+    documents = [cache.get(content) for content in contents]
+    score = overlap_scores if (method or METHOD) == 'overlap' else bm25_scores
+    return score(terms(hunk), documents)
+
+
+def select(scores, similarities=None, top_files=None, keep_above=None, embedding_top_files=None):
+    '''
+    Indexes, in file order, of the files to keep: the `top_files` best by
+    lexical score, those scoring at least `keep_above` times the best and,
+    given the embedding `similarities`, the `embedding_top_files` most similar.
+    '''
+    top_files = TOP_FILES if top_files is None else top_files
+    keep_above = KEEP_ABOVE if keep_above is None else keep_above
+    embedding_top_files = EMBEDDING_TOP_FILES if embedding_top_files is None \
+        else embedding_top_files
+    ranked = sorted(range(len(scores)), key=lambda i: -scores[i])
+    kept = set(ranked[:top_files])
+    best = scores[ranked[0]] if ranked else 0
+    if keep_above > 0 and best > 0:
+        kept.update(i for i in ranked[top_files:] if scores[i] >= keep_above * best)
+    if similarities is not None and embedding_top_files > 0:
+        kept.update(sorted(range(len(similarities)),
+                           key=lambda i: -similarities[i])[:embedding_top_files])
+    prefilter_files.inc('kept', amount=len(kept))
+    prefilter_files.inc('dropped', amount=len(scores) - len(kept))
+    return sorted(kept)
+
+
+def request_files(body):
+    '''(hunk text, [[path, content], ...]) the discriminator compares, as its predict picks them.'''
+    prev_edit = body["prevEdits"][-1]
+    hunk = "".join([prev_edit["codeAbove"], prev_edit["beforeEdit"], prev_edit["codeBelow"]])
+    files = [it for it in body["files"] if it[0] != body["targetFilePath"]]
+    return hunk, files
+
+
+def window_count(content):
+    # cal_dep_score's 10-line windows
+    return len(content.splitlines()) // 10 + 1
+
+
+def forget_embeddings():
+    '''Start a pass without the window embeddings and term counts of earlier ones.'''
+    import embedding_store
+    import window_index
+    # in memory only, vectors on disk would outlive the reset
+    embedding_store.store.reset(embedding_store.store.memory_budget)
+    with window_index.indexes_lock:
+        window_index.indexes.clear()
+    global cache
+    cache = TermCache(MAX_CACHED_FILES)
+
+
+def run_all(entries, predict, enabled):
+    '''[(selected file paths, seconds)] of every entry.'''
+    import model_manager
+    global ENABLED
+    ENABLED = enabled
+    # load the models before timing
+    predict(copy.deepcopy(entries[0]["body"]), entries[0]["body"]["language"])
+    forget_embeddings()
+    results = []
+    for i, entry in enumerate(entries):
+        # predict modifies its input
+        json_input = copy.deepcopy(entry["body"])
+        with model_manager.request_scope():
+            start_time = time.perf_counter()
+            try:
+                output = predict(json_input, json_input["language"])["data"]
+            except Exception as err:
+                print(f'+++ /discriminator failed: {type(err).__name__}: {err}')
+                output = None
+            results.append((output, time.perf_counter() - start_time))
+        if (i + 1) % 50 == 0:
+            print(f'>>> {"prefilter" if enabled else "all files"}: {i + 1}/{len(entries)} requests')
+    return results
+
+
+def recall(expected, selected):
+    expected = set(expected)
+    return len(expected & set(selected)) / len(expected) if expected else 1.0
+
+
+def sweep(entries, unfiltered, top_files, method):
+    '''Recall and share of windows kept by the lexical stage alone, for each top-files.'''
+    report = dict()
+    for k in top_files:
+        recalls, shares = [], []
+        for entry, (expected, _) in zip(entries, unfiltered):
+            if expected is None:
+                continue
+            hunk, files = request_files(entry["body"])
+            if len(files) > k:
+                kept = select(lexical_scores(hunk, [it[1] for it in files], method),
+                              top_files=k, keep_above=0, embedding_top_files=0)
+            else:
+                kept = range(len(files))
+            total = sum(window_count(it[1]) for it in files)
+            shares.append(sum(window_count(files[i][1]) for i in kept) / total if total else 1.0)
+            recalls.append(recall(expected, [files[i][0] for i in kept]))
+        report[k] = {
+            "recall": statistics.mean(recalls) if recalls else float('nan'),
+            "minRecall": min(recalls) if recalls else float('nan'),
+            "windowShare": statistics.mean(shares) if shares else float('nan')
+        }
+    return report
+
+
+def compare(unfiltered, filtered):
+    pairs = [(a, b) for a, b in zip(unfiltered, filtered) if a[0] is not None and b[0] is not None]
+    if not pairs:
+        return dict()
+    all_median = statistics.median(a[1] for a, _ in pairs)
+    prefilter_median = statistics.median(b[1] for _, b in pairs)
+    return {
+        "requests": len(pairs),
+        "recall": statistics.mean(recall(a[0], b[0]) for a, b in pairs),
+        "exactMatch": statistics.mean(float(set(a[0]) == set(b[0])) for a, b in pairs),
+        "allFilesMedianMs": 1000 * all_median,
+        "prefilterMedianMs": 1000 * prefilter_median,
+        "speedup": all_median / prefilter_median if prefilter_median > 0 else float('nan')
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the recall of the discriminator prefilter on captured requests.')
+    parser.add_argument('capture', help='JSON lines written by [capture] Path')
+    parser.add_argument('--requests', type=int, default=0, help='use the first N, 0 for all')
+    parser.add_argument('--top-files', type=int, nargs='*', default=[5, 10, 20, 50],
+                        help='lexical cut-offs to report')
+    parser.add_argument('--method', choices=METHODS, help='default from [prefilter]')
+    parser.add_argument('--fixtures', action='store_true',
+                        help='use small random models instead of the checkpoints')
+    parser.add_argument('--output', help='also write the report here as JSON')
+    args = parser.parse_args()
+
+    global METHOD
+    import configparser
+    import batching
+    import fixtures
+    import model_manager
+    import embedding_store
+    import window_index
+    from loadtest import load_capture
+    config = configparser.ConfigParser()
+    config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.ini'))
+    batching.configure(config)
+    model_manager.configure(config)
+    fixtures.configure(config)
+    embedding_store.configure(config)
+    window_index.configure(config)
+    configure(config)
+    if args.fixtures:
+        fixtures.ENABLED = True
+    if args.method:
+        METHOD = args.method
+
+    # requests without previous edits select nothing
+    entries = [entry for entry in load_capture(args.capture, ['/discriminator'])
+               if entry["body"]["prevEdits"]]
+    if args.requests:
+        entries = entries[:args.requests]
+    if len(entries) == 0:
+        print(f'No /discriminator requests with previous edits in {args.capture}')
+        sys.exit(1)
+    from discriminator.interface import predict
+    unfiltered = run_all(entries, predict, enabled=False)
+    filtered = run_all(entries, predict, enabled=True)
+
+    report = {
+        "method": METHOD,
+        "sweep": sweep(entries, unfiltered, args.top_files, METHOD),
+        "configured": {"topFiles": TOP_FILES, "keepAbove": KEEP_ABOVE,
+                       "embeddingTopFiles": EMBEDDING_TOP_FILES,
+                       **compare(unfiltered, filtered)}
+    }
+    print(f"{'top files':>10}{'recall':>9}{'min':>9}{'windows':>9}")
+    for k, it in report["sweep"].items():
+        print(f"{k:>10}{it['recall']:>9.3f}{it['minRecall']:>9.3f}{it['windowShare']:>9.3f}")
+    configured = report["configured"]
+    if "requests" in configured:
+        print(f">>> [prefilter] settings: recall {configured['recall']:.3f}, "
+              f"exact match {configured['exactMatch']:.3f}, "
+              f"median {configured['allFilesMedianMs']:.1f} ms -> "
+              f"{configured['prefilterMedianMs']:.1f} ms")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == '__main__':
+    # the discriminator reads the settings of the imported module, not of __main__
+    import prefilter
+    prefilter.main()
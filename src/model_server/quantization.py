@@ -0,0 +1,127 @@
+# Dynamic int8 quantization of the models, for CPU inference.
+#
+# The Linear layers of the encoders, the generator's decoder, the dependency
+# analyzer and the embedding model store int8 weights and quantize their
+# activations on the fly. The locator and generator heads stay fp32, as the
+# head shares its weights with the token embeddings. Quantized models are
+# cached next to the checkpoints (e.g. models/python/locator_int8), so later
+# starts skip the fp32 load. Compare accuracy and speed with compare_int8.py.
+
+import os
+import time
+import snapshot
+
+# Defaults, overridden by the [quantization] section of server.ini
+ENABLED = False
+LANGUAGES = []  # empty for all
+CACHE = True
+# model role -> Enabled, from the [quantization.<role>] sections
+ROLE_ENABLED = dict()
+
+ROLES = ['locator', 'generator', 'embedding', 'dependency']
+WEIGHTS_FILE = 'model_int8.pt'
+
+
+def configure(config):
+    global ENABLED, LANGUAGES, CACHE
+    if config.has_section('quantization'):
+        section = config['quantization']
+        ENABLED = section.getboolean('Enabled', ENABLED)
+        LANGUAGES = [it.strip() for it in section.get('Languages', '').split(',') if it.strip()]
+        CACHE = section.getboolean('Cache', CACHE)
+    for model_role in ROLES:
+        name = f'quantization.{model_role}'
+        if config.has_section(name) and 'Enabled' in config[name]:
+            ROLE_ENABLED[model_role] = config[name].getboolean('Enabled')
+
+
+def is_enabled(model_role, language):
+    if not ROLE_ENABLED.get(model_role, ENABLED):
+        return False
+    # the dependency analyzer is shared by all languages
+    return len(LANGUAGES) == 0 or language == 'all' or language in LANGUAGES
+
+
+def quantizable_modules(model_role, model):
+    '''The submodules whose Linear layers are quantized.'''
+    if model_role == 'locator':
+        return [model.encoder]
+    if model_role == 'generator':
+        return [model.encoder, model.decoder]
+    return [model]
+
+
+def quantize_module(model_role, model):
+    '''Quantize a module in place, on the CPU.'''
+    import torch
+    import torch.nn as nn
+    model.to('cpu')
+    model.eval()
+    for module in quantizable_modules(model_role, model):
+        # exact types: the attention output projections of nn.TransformerDecoder
+        # are NonDynamicallyQuantizableLinear and stay fp32
+        torch.ao.quantization.quantize_dynamic(
+            module, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+def quantize(model_role, model_info):
+    '''Quantize what a role's loader returned, returning it in the same shape.'''
+    import torch
+    model, tokenizer, _ = snapshot.split_model_info(model_role, model_info)
+    quantize_module(model_role, model)
+    return snapshot.wrap(model_role, model, tokenizer, torch.device('cpu'))
+
+
+def is_cached(directory, source_version):
+    try:
+        meta = snapshot.read_metadata(directory)
+    except (OSError, ValueError):
+        return False
+    return meta.get("source") == source_version and \
+        os.path.isfile(os.path.join(directory, WEIGHTS_FILE))
+
+
+def save(model_role, model_info, directory, source_version):
+    import torch
+    model = snapshot.save_metadata(
+        model_role, model_info, directory, source=source_version)
+    torch.save(model.state_dict(), os.path.join(directory, WEIGHTS_FILE))
+
+
+def load(model_role, directory):
+    '''Load a quantized model written by save().'''
+    import torch
+    model, tokenizer, _ = snapshot.load_skeleton(model_role, directory)
+    quantize_module(model_role, model)
+    state = torch.load(os.path.join(directory, WEIGHTS_FILE), map_location='cpu')
+    model.load_state_dict(state)
+    return snapshot.wrap(model_role, model, tokenizer, torch.device('cpu'))
+
+
+def accelerator_available():
+    import torch
+    return torch.cuda.is_available() or torch.backends.mps.is_available()
+
+
+def get_loader(model_role, model_loader, directory, source_version, cache=True):
+    '''
+    A loader returning the quantized model, from `directory` if it holds one
+    of `source_version`, or else quantizing what `model_loader` returns and
+    saving it there.
+    '''
+    def load_quantized(model_path):
+        if accelerator_available():
+            # the predict paths move inputs to the accelerator
+            print(f"+++ int8 quantization runs on the CPU only, {model_role} stays fp32")
+            return model_loader(model_path)
+        if cache and is_cached(directory, source_version):
+            return load(model_role, directory)
+        model_info = model_loader(model_path)
+        start_time = time.perf_counter()
+        model_info = quantize(model_role, model_info)
+        print(f"+++ Quantized {model_role} to int8 in {time.perf_counter() - start_time:.2f}s")
+        if cache:
+            save(model_role, model_info, directory, source_version)
+        return model_info
+    return load_quantized
@@ -0,0 +1,173 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from metrics import Counter
+
+# Defaults, overridden by the [cache] section of server.ini
+ENABLED = True
+MAX_ENTRIES = 1024
+TTL_SECONDS = 600
+DISK_DIR = ''
+DISK_MAX_ENTRIES = 10000
+
+cache_requests = Counter(
+    'coedpilot_cache_requests_total', 'Result cache lookups.',
+    ('role', 'language', 'result'))
+
+
+def make_key(model_role, language, model_version, inputs):
+    '''Stable hash of the model-relevant inputs and the model they run on.'''
+    canonical = json.dumps(
+        [model_role, language, model_version, inputs],
+        sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """
+        Bounded response cache with TTL and LRU eviction, optionally backed by
+        a directory of JSON files that outlives the process.
+
+        Entries are tagged by role and language so they can be invalidated
+        together, e.g. after a model update.
+    """
+
+    def __init__(self, max_entries, ttl_seconds, disk_dir='', disk_max_entries=0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.disk_dir = disk_dir
+        self.disk_max_entries = disk_max_entries
+        self._entries = OrderedDict()  # key -> (expires, role, language, result)
+        self._lock = threading.Lock()
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def _disk_path(self, model_role, language, key):
+        return os.path.join(self.disk_dir, f'{model_role}-{language}-{key}.json')
+
+    def get(self, model_role, language, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    cache_requests.inc(model_role, language, 'hit')
+                    return entry[3]
+                del self._entries[key]
+
+        if self.disk_dir:
+            path = self._disk_path(model_role, language, key)
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    stored = json.load(f)
+            except (OSError, ValueError):
+                stored = None
+            if stored is not None and stored["expires"] > now:
+                self._put_memory(key, stored["expires"], model_role,
+                                 language, stored["result"])
+                cache_requests.inc(model_role, language, 'disk_hit')
+                return stored["result"]
+            if stored is not None:
+                self._remove_file(path)
+
+        cache_requests.inc(model_role, language, 'miss')
+        return None
+
+    def _put_memory(self, key, expires, model_role, language, result):
+        with self._lock:
+            self._entries[key] = (expires, model_role, language, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def put(self, model_role, language, key, result):
+        expires = time.time() + self.ttl_seconds
+        self._put_memory(key, expires, model_role, language, result)
+        if self.disk_dir:
+            path = self._disk_path(model_role, language, key)
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump({"expires": expires, "result": result}, f)
+                os.replace(tmp_path, path)
+            except OSError as err:
+                print(f"+++ Result cache failed to write {path}: {err}")
+            self._trim_disk()
+
+    def _remove_file(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _disk_files(self, prefix=''):
+        return [os.path.join(self.disk_dir, name) for name in os.listdir(self.disk_dir)
+                if name.startswith(prefix) and name.endswith('.json')]
+
+    def _trim_disk(self):
+        files = self._disk_files()
+        if len(files) <= self.disk_max_entries:
+            return
+        # drop the oldest tenth at once, so we don't rescan on every put
+        files.sort(key=lambda path: os.path.getmtime(path))
+        for path in files[:len(files) - self.disk_max_entries * 9 // 10]:
+            self._remove_file(path)
+
+    def invalidate(self, model_role=None, language=None):
+        '''Drop entries of a role and/or language, or every entry. Returns the number of memory entries dropped.'''
+        def matches(role, lang):
+            return (model_role is None or role == model_role) and \
+                (language is None or lang == language)
+
+        with self._lock:
+            keys = [key for key, entry in self._entries.items()
+                    if matches(entry[1], entry[2])]
+            for key in keys:
+                del self._entries[key]
+        if self.disk_dir:
+            for path in self._disk_files():
+                role, lang = os.path.basename(path).split('-')[:2]
+                if matches(role, lang):
+                    self._remove_file(path)
+        return len(keys)
+
+    def stats(self):
+        with self._lock:
+            entries = len(self._entries)
+        stats = {
+            "entries": entries,
+            "maxEntries": self.max_entries,
+            "ttlSeconds": self.ttl_seconds,
+            "requests": {"/".join(key): value
+                         for key, value in cache_requests.items()}
+        }
+        if self.disk_dir:
+            stats["diskEntries"] = len(self._disk_files())
+        return stats
+
+
+cache = None
+
+
+def configure(config):
+    global ENABLED, MAX_ENTRIES, TTL_SECONDS, DISK_DIR, DISK_MAX_ENTRIES, cache
+    if config.has_section('cache'):
+        section = config['cache']
+        ENABLED = section.getboolean('Enabled', ENABLED)
+        MAX_ENTRIES = section.getint('MaxEntries', MAX_ENTRIES)
+        TTL_SECONDS = section.getfloat('TtlSeconds', TTL_SECONDS)
+        DISK_DIR = section.get('DiskDir', DISK_DIR)
+        DISK_MAX_ENTRIES = section.getint('DiskMaxEntries', DISK_MAX_ENTRIES)
+    cache = ResultCache(MAX_ENTRIES, TTL_SECONDS, DISK_DIR, DISK_MAX_ENTRIES) \
+        if ENABLED else None
+
+
+def get_cache():
+    global cache
+    if cache is None and ENABLED:
+        cache = ResultCache(MAX_ENTRIES, TTL_SECONDS, DISK_DIR, DISK_MAX_ENTRIES)
+    return cache
@@ -1,72 +1,350 @@
+import time
+BOOT_TIME = time.perf_counter()
 import os
+import importlib
 from flask import Flask, config, request, make_response
 from waitress import serve
-from discriminator.interface import predict as disc_predict
-from locator.interface import predict as loc_predict
-from generator.interface import predict as gen_predict
 import json
+import uuid
 import configparser
+import admission
+import backends
+import batching
+import capture
+import fixtures
+import cancellation
+import embedding_store
+import window_index
+import prefilter
+import metrics
+import quantization
+import result_cache
+import single_flight
+import tracing
+import warmup
+import wire
+import workspace_store
+from workspace_store import WorkspaceNotFound, HashMismatch, MalformedChanges
+import model_manager
+from model_manager import get_model_version
 
 app = Flask(__name__)
 
 DEBUG = True
 SUPPORTED_LANGUAGES = ["go", "python", "java", "typescript", "javascript"]
 
-print(">>> Modules loaded. Server ready.")
 
+def lazy(module_name, function_name):
+    '''
+    A function that imports its module on first call. The interfaces pull
+    in torch, transformers and sklearn, so the HTTP layer doesn't import
+    them up front; preloading or the first request does.
+    '''
+    def call(*args, **kwargs):
+        module = importlib.import_module(module_name)
+        return getattr(module, function_name)(*args, **kwargs)
+    return call
 
-def make_plain_text_response(result):
-    response = make_response(result, 200)
+
+PRELOADERS = {
+    'discriminator': lazy('discriminator.interface', 'preload'),
+    'locator': lazy('locator.interface', 'preload'),
+    'generator': lazy('generator.interface', 'preload')
+}
+PREDICTORS = {
+    'discriminator': lazy('discriminator.interface', 'predict'),
+    'locator': lazy('locator.interface', 'predict'),
+    'generator': lazy('generator.interface', 'predict')
+}
+# roles whose results are cached, with the request fields they depend on
+CACHE_INPUTS = {
+    'locator': lazy('locator.interface', 'cache_inputs'),
+    'generator': lazy('generator.interface', 'cache_inputs')
+}
+
+print(f">>> Modules loaded in {time.perf_counter() - BOOT_TIME:.2f}s. Server ready.")
+
+
+def make_result_response(result):
+    # JSON as text/plain by default, see wire.encode_response for the options
+    return wire.encode_response(request, result)
+
+
+def make_400_response(err_msg):
+    response = make_response(err_msg, 400)
     response.mimetype = "text/plain"
     response.charset = "utf-8"
     return response
 
 
-def make_400_response(err_msg):
-    response = make_response(err_msg, 400)
+def make_409_response(err_msg):
+    response = make_response(err_msg, 409)
+    response.mimetype = "text/plain"
+    response.charset = "utf-8"
+    return response
+
+
+def make_404_response(err_msg):
+    response = make_response(err_msg, 404)
     response.mimetype = "text/plain"
     response.charset = "utf-8"
     return response
 
 
+def make_busy_response(err):
+    # 429 when the queue is full, 503 when the request waited too long
+    response = make_response(str(err), err.status)
+    response.mimetype = "text/plain"
+    response.charset = "utf-8"
+    response.headers['Retry-After'] = str(err.retry_after)
+    return response
+
+
+def make_412_response(mismatched_paths):
+    # the client should resend these files in full
+    response = make_response({"mismatched": mismatched_paths}, 412)
+    return response
+
+
 def run_predict(predict_name, predict_func):
     print(f">>> Running {predict_name}")
-    json_str = request.data.decode('utf-8')
-    input_json = json.loads(json_str)
+    input_json = wire.decode_request(request)
 
     language = input_json["language"]
     if language not in SUPPORTED_LANGUAGES:
         return make_400_response(f"Not supporting language {language} yet.")
 
+    try:
+        input_json = workspace_store.resolve_files(input_json)
+    except WorkspaceNotFound as err:
+        return make_404_response(f"Workspace {err} is not registered.")
+    except HashMismatch as err:
+        return make_412_response(err.paths)
+    except MalformedChanges as err:
+        return make_400_response(f"Malformed workspace changes: {err}")
+
+    # a newer request from the same editor session supersedes this one
+    session_id = request.headers.get('X-Session-Id', input_json.get('sessionId'))
+    request_id = request.headers.get('X-Request-Id', uuid.uuid4().hex)
+    capture.record(request.path, input_json, session_id)
+
     if DEBUG:
         print(
             f">>> {predict_name} inferencing: \n${json.dumps(input_json, indent=4)}")
-    result = predict_func(input_json, language)
+    token = cancellation.begin(session_id, predict_name, request_id)
+    trace = tracing.start_trace(request_id, predict_name)
+    start_time = time.perf_counter()
+    status = 'error'
+    # load tests send Cache-Control: no-cache to measure the models
+    use_cache = predict_name in CACHE_INPUTS and \
+        'no-cache' not in request.headers.get('Cache-Control', '')
+    cache = result_cache.get_cache() if use_cache else None
+    coalesced = False
+
+    def compute():
+        # the models this request loads can't be unloaded until it's done
+        with admission.admit(predict_name, input_json, cancellation.current_token()), \
+                model_manager.request_scope():
+            return predict_func(input_json, language)
+
+    try:
+        key = result_cache.make_key(
+            predict_name, language, get_model_version(predict_name, language),
+            CACHE_INPUTS[predict_name](input_json) if predict_name in CACHE_INPUTS
+            else {k: v for k, v in input_json.items() if k != 'sessionId'})
+        result = cache.get(predict_name, language, key) if cache is not None else None
+        if result is None:
+            # identical requests in flight share one computation
+            result, coalesced = single_flight.run(predict_name, key, token, compute)
+            if cache is not None and not coalesced:
+                cache.put(predict_name, language, key, result)
+            status = 'coalesced' if coalesced else 'ok'
+        else:
+            status = 'cached'
+    except cancellation.RequestCancelled as err:
+        print(f">>> {predict_name} cancelled: {err}")
+        status = 'cancelled'
+        return make_409_response(str(err))
+    except admission.Rejected as err:
+        print(f">>> {predict_name} rejected: {err}")
+        status = 'rejected'
+        return make_busy_response(err)
+    finally:
+        cancellation.end(predict_name, token)
+        tracing.end_trace(trace)
+        metrics.request_seconds.observe(
+            predict_name, language, status, value=time.perf_counter() - start_time)
 
     if DEBUG:
         print(f">>> {predict_name} output: \n${json.dumps(result, indent=4)}")
     print(f">>> {predict_name} sending output")
-    return make_plain_text_response(result)
+    response = make_result_response(result)
+    response.headers['X-Request-Id'] = request_id
+    if cache is not None:
+        response.headers['X-Cache'] = 'hit' if status == 'cached' else 'miss'
+    if coalesced:
+        response.headers['X-Coalesced'] = '1'
+    return response
+
+
+@app.errorhandler(wire.UnsupportedEncoding)
+def handle_unsupported_encoding(err):
+    response = make_response(str(err), 415)
+    response.mimetype = "text/plain"
+    response.charset = "utf-8"
+    return response
 
 
 @app.route('/discriminator', methods=['POST'])
 def run_discriminator():
-    return run_predict('discriminator', disc_predict)
+    return run_predict('discriminator', PREDICTORS['discriminator'])
 
 
 @app.route('/range', methods=['POST'])
 def run_range():
-    return run_predict('locator', loc_predict)
+    return run_predict('locator', PREDICTORS['locator'])
 
 
 @app.route('/content', methods=['POST'])
 def run_content():
-    return run_predict('generator', gen_predict)
+    return run_predict('generator', PREDICTORS['generator'])
+
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    return make_response("ok", 200)
+
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    # 503 until the models in [preload] are loaded and warmed up
+    ready = warmup.is_ready()
+    return make_response({"ready": ready, "models": warmup.get_status()},
+                         200 if ready else 503)
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    response = make_response(metrics.render(), 200)
+    response.mimetype = "text/plain"
+    response.headers['Content-Type'] = "text/plain; version=0.0.4; charset=utf-8"
+    return response
+
+
+@app.route('/trace/<trace_id>', methods=['GET'])
+def get_trace(trace_id):
+    # load the output in chrome://tracing or https://ui.perfetto.dev
+    trace = tracing.get_trace(trace_id)
+    if trace is None:
+        return make_404_response(f"No trace kept for request {trace_id}.")
+    return make_response(trace.to_chrome_trace(), 200)
+
+
+@app.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    cache = result_cache.get_cache()
+    return make_result_response({"data": cache.stats() if cache is not None else None})
+
+
+@app.route('/embeddings/stats', methods=['GET'])
+def get_embedding_stats():
+    return make_result_response({"data": embedding_store.store.stats()})
+
+
+@app.route('/cache/invalidate', methods=['POST'])
+def invalidate_cache():
+    # optional body: {"role": "locator" | "generator", "language": str}
+    input_json = wire.decode_request(request) if len(request.get_data()) > 0 else {}
+    cache = result_cache.get_cache()
+    dropped = 0
+    if cache is not None:
+        dropped = cache.invalidate(input_json.get("role"), input_json.get("language"))
+    return make_result_response({"data": {"dropped": dropped}})
+
+
+@app.route('/admission/stats', methods=['GET'])
+def get_admission_stats():
+    scheduler = admission.get_scheduler()
+    return make_result_response({"data": scheduler.stats() if scheduler is not None else None})
+
+
+@app.route('/models', methods=['GET'])
+def get_models():
+    return make_result_response({"data": model_manager.registry.stats()})
+
+
+@app.route('/workspace/register', methods=['POST'])
+def register_workspace():
+    input_json = wire.decode_request(request)
+    try:
+        hashes = workspace_store.store.register(
+            input_json.get("workspaceId"), input_json.get("files"))
+    except MalformedChanges as err:
+        return make_400_response(f"Malformed workspace: {err}")
+    return make_result_response({"data": {"hashes": hashes}})
+
+
+@app.route('/workspace/update', methods=['POST'])
+def update_workspace():
+    input_json = wire.decode_request(request)
+    workspace_id = input_json.get("workspaceId")
+    try:
+        workspace_store.store.update(workspace_id, input_json.get("changes"))
+    except WorkspaceNotFound:
+        return make_404_response(f"Workspace {workspace_id} is not registered.")
+    except HashMismatch as err:
+        return make_412_response(err.paths)
+    except MalformedChanges as err:
+        return make_400_response(f"Malformed workspace changes: {err}")
+    return make_result_response(
+        {"data": {"hashes": workspace_store.store.get_hashes(workspace_id)}})
+
+
+@app.route('/workspace/release', methods=['POST'])
+def release_workspace():
+    input_json = wire.decode_request(request)
+    try:
+        workspace_store.store.release(input_json.get("workspaceId"))
+    except MalformedChanges as err:
+        return make_400_response(f"Malformed workspace: {err}")
+    return make_result_response({"data": workspace_store.store.stats()})
 
 
 if __name__ == '__main__':
     # app.run(host='0.0.0.0', port=5001, debug=True)
     config = configparser.ConfigParser()
     config.read(f'{os.path.dirname(__file__)}/server.ini')
+    batching.configure(config)
+    workspace_store.configure(config)
+    tracing.configure(config)
+    wire.configure(config)
+    result_cache.configure(config)
+    model_manager.configure(config)
+    admission.configure(config)
+    capture.configure(config)
+    single_flight.configure(config)
+    fixtures.configure(config)
+    quantization.configure(config)
+    backends.configure(config)
+    embedding_store.configure(config)
+    window_index.configure(config)
+    prefilter.configure(config)
+    languages, roles, warm_up = warmup.read_config(config)
+
+    def preload(role, language):
+        PRELOADERS[role](language)
+
+    def start_warm_up(worker_index=None):
+        if worker_index is not None:
+            # workers can't share the disk files of the embedding store
+            embedding_store.store.set_owner(f'worker{worker_index}')
+        warmup.start(languages, roles, preload, PREDICTORS, warm_up)
+
+    if config.getint('workers', 'Count', fallback=0) > 0:
+        import worker_pool
+        worker_pool.run(app, config, preload, start_warm_up)
+    start_warm_up()
+    # more threads than admission slots, so queued requests can be rejected early
     serve(app, host=config['DEFAULT']['ListenHost'],
-          port=config['DEFAULT']['ListenPort'])
+          port=config['DEFAULT']['ListenPort'],
+          threads=config['DEFAULT'].getint('Threads', 4))
@@ -0,0 +1,70 @@
+import threading
+from cancellation import GroupToken, use_token
+from metrics import Counter
+
+# Defaults, overridden by the [coalescing] section of server.ini
+ENABLED = True
+
+coalesced_requests = Counter(
+    'coedpilot_coalesced_requests_total',
+    'Requests answered by an identical request already in flight.', ('role',))
+
+
+class Flight:
+    def __init__(self):
+        self.token = GroupToken()
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+in_flight = dict()  # key -> Flight
+in_flight_lock = threading.Lock()
+
+
+def configure(config):
+    global ENABLED
+    if config.has_section('coalescing'):
+        ENABLED = config['coalescing'].getboolean('Enabled', ENABLED)
+
+
+def run(model_role, key, token, compute):
+    '''
+    Return `compute()`, or, if a request with the same key is already being
+    computed, wait for and share its result. Returns (result, coalesced).
+
+    The computation runs with a GroupToken, cancelled only when every
+    request sharing it is. A request that was itself cancelled still gets
+    RequestCancelled.
+    '''
+    if not ENABLED:
+        return compute(), False
+    with in_flight_lock:
+        flight = in_flight.get(key)
+        leader = flight is None or flight.token.cancelled
+        if leader:
+            # a flight whose requests are all cancelled may be stopping, start over
+            flight = Flight()
+            in_flight[key] = flight
+        flight.token.add(token)
+
+    if leader:
+        try:
+            with use_token(flight.token):
+                flight.result = compute()
+        except BaseException as err:
+            flight.error = err
+        finally:
+            with in_flight_lock:
+                if in_flight.get(key) is flight:
+                    del in_flight[key]
+            flight.done.set()
+    else:
+        coalesced_requests.inc(model_role)
+        print(f"+++ Request {token.request_id} joined an identical {model_role} request")
+        flight.done.wait()
+
+    if flight.error is not None:
+        raise flight.error
+    token.check()
+    return flight.result, not leader
@@ -0,0 +1,258 @@
+# Convert checkpoints into self-contained snapshots that load fast.
+#
+# Usage: python snapshot.py LANGUAGE [ROLE ...]
+# Example: python snapshot.py python locator generator
+#
+# A snapshot is a directory holding the encoder config, the tokenizer, the
+# constructor arguments of the model and its weights in safetensors format.
+# Loading it builds the module skeleton from the config, with its parameters
+# on the meta device, and makes the tensors of the memory-mapped file its
+# parameters without copying them, instead of building a pretrained
+# model from the HF hub cache and then overwriting it with a pickled
+# checkpoint. Once a snapshot exists the server uses it automatically, as
+# long as the checkpoint it was made from hasn't changed.
+
+import os
+import sys
+import json
+import time
+import importlib.util
+from contextlib import contextmanager, nullcontext
+
+# Optional, snapshots are skipped when it isn't installed. Imported on use,
+# as it imports torch.
+HAS_SAFETENSORS = importlib.util.find_spec('safetensors') is not None
+
+ROLES = ['locator', 'generator', 'embedding', 'dependency']
+META_FILE = 'snapshot.json'
+WEIGHTS_FILE = 'model.safetensors'
+
+
+def is_available(directory):
+    return HAS_SAFETENSORS and os.path.isfile(os.path.join(directory, META_FILE))
+
+
+def is_current(directory, source_version):
+    '''
+    Whether a snapshot was made from the checkpoint of `source_version`.
+    A snapshot that doesn't record its checkpoint is stale, unless there is
+    no checkpoint (`source_version` is None) to load instead.
+    '''
+    if source_version is None:
+        return True
+    try:
+        return read_metadata(directory).get("source") == source_version
+    except (OSError, ValueError):
+        return False
+
+
+def model_arguments(model_role, model):
+    '''Constructor arguments of the model that aren't in the encoder config.'''
+    if model_role == 'locator':
+        return {"beam_size": model.beam_size, "max_length": model.max_length,
+                "sos_id": model.sos_id, "eos_id": model.eos_id, "mask_id": model.mask_id}
+    if model_role == 'generator':
+        layer = model.decoder.layers[0]
+        return {"beam_size": model.beam_size, "max_length": model.max_length,
+                "sos_id": model.sos_id, "eos_id": model.eos_id,
+                "decoder_layers": len(model.decoder.layers),
+                "decoder_heads": layer.self_attn.num_heads,
+                "decoder_feedforward": layer.linear1.out_features}
+    return {}
+
+
+def split_model_info(model_role, model_info):
+    '''(module, tokenizer, encoder config) of what a role's loader returns.'''
+    if model_role == 'dependency':
+        return model_info.model, model_info.tokenizer, model_info.model.encoder.config
+    model, tokenizer, _ = model_info
+    config = model.config if model_role == 'embedding' else model.encoder.config
+    return model, tokenizer, config
+
+
+def save_metadata(model_role, model_info, directory, **meta):
+    '''Write everything but the weights of a loaded model, returning the module.'''
+    model, tokenizer, config = split_model_info(model_role, model_info)
+    os.makedirs(directory, exist_ok=True)
+    config.save_pretrained(directory)
+    tokenizer.save_pretrained(os.path.join(directory, 'tokenizer'))
+    meta = dict(role=model_role, arguments=model_arguments(model_role, model), **meta)
+    with open(os.path.join(directory, META_FILE), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=4)
+    return model
+
+
+def save(model_role, model_info, directory, source_version=None):
+    '''Write a snapshot of a loaded model, of the checkpoint of `source_version`, to `directory`.'''
+    import safetensors.torch
+    model = save_metadata(model_role, model_info, directory, source=source_version)
+    # save_model() stores tied weights, like lm_head and the embeddings, once
+    safetensors.torch.save_model(model.to('cpu'), os.path.join(directory, WEIGHTS_FILE))
+
+
+def build_skeleton(model_role, config, tokenizer, arguments):
+    import torch.nn as nn
+    from transformers import RobertaModel
+    if model_role == 'locator':
+        from locator.model import Seq2Seq
+        return Seq2Seq(encoder=RobertaModel(config), config=config, **arguments)
+    if model_role == 'generator':
+        from generator.model import Seq2Seq
+        arguments = dict(arguments)
+        decoder_layer = nn.TransformerDecoderLayer(
+            d_model=config.hidden_size, nhead=arguments.pop("decoder_heads"),
+            dim_feedforward=arguments.pop("decoder_feedforward"))
+        decoder = nn.TransformerDecoder(
+            decoder_layer, num_layers=arguments.pop("decoder_layers"))
+        return Seq2Seq(encoder=RobertaModel(config), decoder=decoder, config=config, **arguments)
+    if model_role == 'embedding':
+        return RobertaModel(config)
+    from discriminator.dependency_analyzer import DependencyAnalyzer
+    # the config already has the vocabulary with <from> and <to>
+    return DependencyAnalyzer(encoder=RobertaModel(config))
+
+
+def read_metadata(directory):
+    with open(os.path.join(directory, META_FILE), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+@contextmanager
+def parameters_on_meta():
+    '''
+    Create the parameters of modules built inside on the meta device, without
+    memory. Buffers, e.g. RoBERTa's position ids, are created as usual.
+    '''
+    import torch.nn as nn
+    register_parameter = nn.Module.register_parameter
+
+    def register_on_meta(module, name, param):
+        register_parameter(module, name, param)
+        # tying assigns a parameter that is on the meta device already
+        if param is not None and not param.is_meta:
+            param_cls = type(module._parameters[name])
+            kwargs = module._parameters[name].__dict__
+            kwargs["requires_grad"] = param.requires_grad
+            module._parameters[name] = param_cls(module._parameters[name].to('meta'), **kwargs)
+
+    nn.Module.register_parameter = register_on_meta
+    try:
+        yield
+    finally:
+        nn.Module.register_parameter = register_parameter
+
+
+def load_skeleton(model_role, directory, on_meta=False):
+    '''
+    The module of a snapshot with uninitialized weights, or with its
+    parameters on the meta device, its tokenizer and metadata.
+    '''
+    from transformers import RobertaConfig
+    from transformers.modeling_utils import no_init_weights
+    from model_manager import get_tokenizer
+    meta = read_metadata(directory)
+    config = RobertaConfig.from_pretrained(directory)
+    tokenizer = get_tokenizer(os.path.join(directory, 'tokenizer'), fast=model_role == 'dependency')
+    # the weights are overwritten right away, don't spend time initializing them
+    with no_init_weights(), parameters_on_meta() if on_meta else nullcontext():
+        model = build_skeleton(model_role, config, tokenizer, meta["arguments"])
+    return model, tokenizer, meta
+
+
+def assign_weights(model, state):
+    '''
+    Make the tensors of `state` the parameters of a skeleton built with
+    parameters_on_meta(), without copying them. Tied parameters, stored once
+    by save(), are tied again.
+    '''
+    shared = dict()  # parameter -> the names it goes by
+    for name, param in model.named_parameters(remove_duplicate=False):
+        shared.setdefault(id(param), []).append(name)
+    model.load_state_dict(state, strict=False, assign=True)
+    for names in shared.values():
+        loaded = [name for name in names if name in state]
+        if len(loaded) == 0:
+            continue
+        param = model.get_parameter(loaded[0])
+        for name in names:
+            if name not in state:
+                module_name, _, attribute = name.rpartition('.')
+                setattr(model.get_submodule(module_name), attribute, param)
+    missing = [name for name, tensor in list(model.named_parameters()) + list(model.named_buffers())
+               if tensor.is_meta]
+    if missing:
+        raise RuntimeError(f'Weights missing from the snapshot: {", ".join(missing)}')
+
+
+def wrap(model_role, model, tokenizer, device):
+    '''What the role's loader returns, for a module on `device`.'''
+    if model_role == 'dependency':
+        from discriminator.dependency_analyzer import DependencyClassifier
+        return DependencyClassifier(model, tokenizer)
+    return model, tokenizer, device
+
+
+def load(model_role, directory, device=None):
+    '''Load a snapshot written by save(), returning what the role's loader returns.'''
+    import torch
+    import safetensors.torch
+    if device is None:
+        if torch.cuda.is_available():
+            device = torch.device('cuda')
+        elif torch.backends.mps.is_available():
+            device = torch.device('mps')
+        else:
+            device = torch.device('cpu')
+    model, tokenizer, _ = load_skeleton(model_role, directory, on_meta=True)
+    # the tensors load_file() reads from the mapped file become the parameters, uncopied
+    assign_weights(model, safetensors.torch.load_file(
+        os.path.join(directory, WEIGHTS_FILE), device='cpu'))
+    model.to(device)
+    return wrap(model_role, model, tokenizer, device)
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(f'Usage: {sys.argv[0]} LANGUAGE [ROLE ...]')
+        print(f'  Roles: {", ".join(ROLES)}, all by default')
+        sys.exit(1)
+    if not HAS_SAFETENSORS:
+        print('safetensors is not installed: pip install safetensors')
+        sys.exit(1)
+    import torch
+    import model_manager
+    from locator.interface import load_model as load_locator
+    from generator.interface import load_model as load_generator
+    from discriminator.interface import load_model as load_embedding, load_dependency_analyzer
+    loaders = {
+        'locator': load_locator,
+        'generator': load_generator,
+        'embedding': load_embedding,
+        'dependency': load_dependency_analyzer
+    }
+    language = sys.argv[1]
+    for model_role in sys.argv[2:] or ROLES:
+        # the dependency analyzer is shared by all languages
+        role_language = 'all' if model_role == 'dependency' else language
+        model_path = model_manager.get_model_path(model_role, role_language)
+        source_version = model_manager.get_file_version(model_path)
+        if source_version is None:
+            print(f'+++ No checkpoint of {model_role} at {model_path}')
+            sys.exit(1)
+        directory = model_manager.get_snapshot_dir(model_role, role_language)
+        print(f'>>> Converting {model_role} for {role_language} to {directory}')
+        model_info = loaders[model_role](model_path)
+        save(model_role, model_info, directory, source_version)
+
+        start_time = time.perf_counter()
+        loaded = load(model_role, directory, torch.device('cpu'))
+        print(f'>>> Snapshot loads in {time.perf_counter() - start_time:.2f}s')
+        original = split_model_info(model_role, model_info)[0].state_dict()
+        for name, tensor in split_model_info(model_role, loaded)[0].state_dict().items():
+            if not torch.equal(tensor, original[name].to('cpu')):
+                print(f'+++ {name} differs from the checkpoint')
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+# Defaults, overridden by the [tracing] section of server.ini
+ENABLED = True
+KEEP_TRACES = 200
+
+thread_state = threading.local()
+finished_traces = OrderedDict()
+finished_traces_lock = threading.Lock()
+
+
+def configure(config):
+    global ENABLED, KEEP_TRACES
+    if not config.has_section('tracing'):
+        return
+    ENABLED = config['tracing'].getboolean('Enabled', ENABLED)
+    KEEP_TRACES = config['tracing'].getint('KeepTraces', KEEP_TRACES)
+
+
+def now_us():
+    return time.perf_counter_ns() // 1000
+
+
+class Trace:
+    """Events of one request, as Chrome trace 'complete' events."""
+
+    def __init__(self, trace_id, name):
+        self.trace_id = trace_id
+        self.name = name
+        self.events = []
+        self._lock = threading.Lock()
+
+    def add_event(self, name, start_us, end_us, tid=None, args=None):
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": start_us,
+            "dur": end_us - start_us,
+            "pid": os.getpid(),
+            "tid": tid if tid is not None else threading.get_ident()
+        }
+        if args:
+            event["args"] = args
+        with self._lock:
+            self.events.append(event)
+
+    def to_chrome_trace(self):
+        with self._lock:
+            events = sorted(self.events, key=lambda it: (it["ts"], -it["dur"]))
+        return {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {"traceId": self.trace_id, "name": self.name}
+        }
+
+
+class TraceGroup:
+    """Forward events to several traces, for work shared by batched requests."""
+
+    def __init__(self, traces):
+        self.traces = traces
+
+    def add_event(self, name, start_us, end_us, tid=None, args=None):
+        for trace in self.traces:
+            trace.add_event(name, start_us, end_us, tid, args)
+
+
+class Span:
+    __slots__ = ('trace', 'name', 'args', 'start_us')
+
+    def __init__(self, trace, name, args):
+        self.trace = trace
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start_us = now_us()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.trace.add_event(self.name, self.start_us, now_us(), args=self.args)
+        return False
+
+
+class NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = NoopSpan()
+
+
+def current_trace():
+    return getattr(thread_state, 'trace', None)
+
+
+def span(name, **args):
+    '''
+    Time a block as a span of the current request's trace. Spans nest by
+    time. Without an active trace this returns a shared no-op object.
+    '''
+    trace = getattr(thread_state, 'trace', None)
+    if trace is None:
+        return NOOP_SPAN
+    return Span(trace, name, args)
+
+
+def start_trace(trace_id, name):
+    '''Begin tracing the request handled by this thread. Returns None if tracing is disabled.'''
+    if not ENABLED:
+        thread_state.trace = None
+        return None
+    trace = Trace(trace_id, name)
+    thread_state.trace = trace
+    return trace
+
+
+def end_trace(trace):
+    thread_state.trace = None
+    if trace is None:
+        return
+    with finished_traces_lock:
+        finished_traces[trace.trace_id] = trace
+        while len(finished_traces) > KEEP_TRACES:
+            finished_traces.popitem(last=False)
+
+
+def get_trace(trace_id):
+    with finished_traces_lock:
+        return finished_traces.get(trace_id)
+
+
+class activate:
+    '''
+    Make `traces` current on this thread for the duration of a block, so
+    spans opened by shared work (e.g. a batch) land in every request's trace.
+    '''
+
+    def __init__(self, traces):
+        traces = [it for it in traces if it is not None]
+        if len(traces) == 0:
+            self.trace = None
+        elif len(traces) == 1:
+            self.trace = traces[0]
+        else:
+            self.trace = TraceGroup(traces)
+
+    def __enter__(self):
+        self.previous = current_trace()
+        thread_state.trace = self.trace
+        return self.trace
+
+    def __exit__(self, exc_type, exc, tb):
+        thread_state.trace = self.previous
+        return False
@@ -0,0 +1,110 @@
+import threading
+import traceback
+from model_manager import request_scope
+
+WARM_UP_FILE = '''import os
+
+
+def read_config(path):
+    with open(path) as f:
+        return f.read()
+
+
+def main():
+    config = read_config(os.path.join(os.getcwd(), 'config.ini'))
+    print(config)
+'''
+
+ready = threading.Event()
+status = dict()  # "role/language" -> "loading" | "warming up" | "ready" | "failed: ..."
+status_lock = threading.Lock()
+
+
+def read_config(config):
+    '''Return (languages, roles, warm_up) from the [preload] section.'''
+    def split(value):
+        return [it.strip() for it in value.split(',') if it.strip()]
+
+    languages = split(config.get('preload', 'Languages', fallback=''))
+    roles = split(config.get('preload', 'Roles', fallback=''))
+    warm_up = config.getboolean('preload', 'WarmUp', fallback=True)
+    return languages, roles, warm_up
+
+
+def synthetic_request(model_role, language):
+    '''A small request exercising the same code path as real traffic.'''
+    prev_edits = [{
+        "beforeEdit": "    print(config)\n",
+        "afterEdit": "    print(config.strip())\n",
+        "codeAbove": "def main():\n",
+        "codeBelow": "\n"
+    }]
+    if model_role == 'generator':
+        return {
+            "language": language,
+            "targetFileContent": WARM_UP_FILE,
+            "commitMessage": "Strip the config before printing",
+            "editType": "replace",
+            "prevEdits": prev_edits,
+            "atLines": [5]
+        }
+    return {
+        "language": language,
+        "files": [["warm_up/main.py", WARM_UP_FILE],
+                  ["warm_up/util.py", WARM_UP_FILE.replace('main', 'run')]],
+        "targetFilePath": "warm_up/main.py",
+        "commitMessage": "Strip the config before printing",
+        "prevEdits": prev_edits
+    }
+
+
+def set_status(model_role, language, state):
+    with status_lock:
+        status[f'{model_role}/{language}'] = state
+
+
+def get_status():
+    with status_lock:
+        return dict(status)
+
+
+def is_ready():
+    with status_lock:
+        failed = any(state.startswith('failed') for state in status.values())
+    return ready.is_set() and not failed
+
+
+def run(languages, roles, preload_fn, predict_fns, warm_up=True):
+    '''
+    Load every role for every language with `preload_fn(role, language)`,
+    then run one synthetic request through `predict_fns[role]` so the first
+    real request doesn't pay for lazy initialization.
+    '''
+    for language in languages:
+        for model_role in roles:
+            set_status(model_role, language, 'loading')
+    for language in languages:
+        for model_role in roles:
+            try:
+                print(f">>> Preloading {model_role} for {language}")
+                preload_fn(model_role, language)
+                if warm_up:
+                    set_status(model_role, language, 'warming up')
+                    with request_scope():
+                        predict_fns[model_role](
+                            synthetic_request(model_role, language), language)
+                set_status(model_role, language, 'ready')
+            except Exception as err:
+                traceback.print_exc()
+                set_status(model_role, language, f'failed: {err}')
+    ready.set()
+    print(f">>> Startup finished: {get_status()}")
+
+
+def start(languages, roles, preload_fn, predict_fns, warm_up=True):
+    '''Run the startup phase in the background, so /healthz answers meanwhile.'''
+    thread = threading.Thread(
+        target=run, args=(languages, roles, preload_fn, predict_fns, warm_up),
+        name='warm-up', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,296 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from metrics import Counter
+
+# Defaults, overridden by the [ann] section of server.ini
+ENABLED = True
+MIN_WINDOWS = 5000  # smaller requests compare against every window
+LISTS = 0  # inverted lists, 0 for about sqrt(number of windows)
+PROBES = 8
+TOP_FILES = 50
+MAX_INDEXES = 8
+TRAIN_MIN_VECTORS = 2048
+KMEANS_ITERATIONS = 10
+
+ann_searches = Counter(
+    'coedpilot_ann_searches_total', 'Discriminator similarity searches over a window index.',
+    ('result',))
+
+
+def configure(config):
+    global ENABLED, MIN_WINDOWS, LISTS, PROBES, TOP_FILES, MAX_INDEXES
+    if not config.has_section('ann'):
+        return
+    section = config['ann']
+    ENABLED = section.getboolean('Enabled', ENABLED)
+    MIN_WINDOWS = section.getint('MinWindows', MIN_WINDOWS)
+    LISTS = section.getint('Lists', LISTS)
+    PROBES = section.getint('Probes', PROBES)
+    TOP_FILES = section.getint('TopFiles', TOP_FILES)
+    MAX_INDEXES = section.getint('MaxIndexes', MAX_INDEXES)
+
+
+def normalize(vectors):
+    import numpy as np
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def quantize(vectors):
+    '''int8 codes and per-vector scales of normalized vectors.'''
+    import numpy as np
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales = np.maximum(scales, 1e-12).astype(np.float32)
+    codes = np.round(vectors / scales[:, None]).astype(np.int8)
+    return codes, scales
+
+
+def kmeans(vectors, count, iterations, seed=0):
+    '''Spherical k-means: `count` unit centroids of unit vectors.'''
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), count, replace=False)]
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        empty = np.linalg.norm(sums, axis=1) == 0
+        # restart empty lists from random vectors
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        centroids = normalize(sums)
+    return centroids
+
+
+class InvertedList:
+    """int8 codes of the windows assigned to one centroid, removed ones marked dead."""
+
+    def __init__(self, dim):
+        import numpy as np
+        self.codes = np.zeros((0, dim), dtype=np.int8)
+        self.scales = np.zeros(0, dtype=np.float32)
+        self.file_ids = np.zeros(0, dtype=np.int32)
+        self.alive = np.zeros(0, dtype=bool)
+
+    def add(self, codes, scales, file_ids):
+        import numpy as np
+        start = len(self.scales)
+        self.codes = np.concatenate([self.codes, codes])
+        self.scales = np.concatenate([self.scales, scales])
+        self.file_ids = np.concatenate([self.file_ids, file_ids])
+        self.alive = np.concatenate([self.alive, np.ones(len(scales), dtype=bool)])
+        return range(start, start + len(scales))
+
+    def dead(self):
+        return len(self.alive) - int(self.alive.sum())
+
+
+class WindowIndex:
+    """
+        An IVF index over the window embeddings of one workspace, for the
+        per-file max cosine similarity to a hunk. Vectors are normalized and
+        stored as int8 codes with a scale each, in the inverted list of their
+        nearest centroid; a search scores only the lists of the `probes`
+        centroids nearest to the query.
+
+        Files are added, replaced or removed as their content changes. Until
+        there are TRAIN_MIN_VECTORS windows everything sits in one list and
+        searches are exact over the quantized vectors; the centroids are
+        trained then, and again each time the index has grown fourfold.
+    """
+
+    def __init__(self, dim):
+        self.dim = dim
+        self.lock = threading.Lock()
+        self.centroids = None
+        self.lists = [InvertedList(dim)]
+        self.files = dict()  # path -> (content hash, file id)
+        self.paths = dict()  # file id -> path
+        self.locations = dict()  # file id -> [(list index, positions)]
+        self.next_file_id = 0
+        self.trained_size = 0
+
+    def size(self):
+        return sum(len(it.alive) - it.dead() for it in self.lists)
+
+    def file_hash(self, path):
+        entry = self.files.get(path)
+        return entry[0] if entry is not None else None
+
+    def remove_file(self, path):
+        entry = self.files.pop(path, None)
+        if entry is None:
+            return
+        file_id = entry[1]
+        del self.paths[file_id]
+        for list_index, positions in self.locations.pop(file_id):
+            self.lists[list_index].alive[positions.start:positions.stop] = False
+
+    def add_file(self, path, content_hash, vectors):
+        import numpy as np
+        self.remove_file(path)
+        file_id = self.next_file_id
+        self.next_file_id += 1
+        self.files[path] = (content_hash, file_id)
+        self.paths[file_id] = path
+        self.locations[file_id] = []
+        if len(vectors) == 0:
+            return
+        vectors = normalize(np.asarray(vectors, dtype=np.float32))
+        codes, scales = quantize(vectors)
+        assignment = np.zeros(len(vectors), dtype=np.int64) if self.centroids is None \
+            else np.argmax(vectors @ self.centroids.T, axis=1)
+        for list_index in np.unique(assignment):
+            rows = assignment == list_index
+            positions = self.lists[list_index].add(
+                codes[rows], scales[rows], np.full(int(rows.sum()), file_id, dtype=np.int32))
+            self.locations[file_id].append((int(list_index), positions))
+
+    def vectors(self):
+        '''(dequantized vectors, file ids) of every live window.'''
+        import numpy as np
+        vectors = [it.codes[it.alive].astype(np.float32) * it.scales[it.alive][:, None]
+                   for it in self.lists]
+        file_ids = [it.file_ids[it.alive] for it in self.lists]
+        return np.concatenate(vectors), np.concatenate(file_ids)
+
+    def rebuild(self, train=True):
+        '''
+        Reassign the live windows, dropping removed ones. With `train` the
+        centroids are trained on them first, otherwise all go to one list.
+        '''
+        import numpy as np
+        vectors, file_ids = self.vectors()
+        size = len(vectors)
+        vectors = normalize(vectors)
+        if train:
+            count = LISTS if LISTS > 0 else int(np.sqrt(size))
+            count = max(1, min(count, size))
+            # train on a sample, 64 windows per list are plenty
+            sample = np.random.default_rng(0).choice(size, min(size, 64 * count), replace=False)
+            self.centroids = kmeans(vectors[sample], count, KMEANS_ITERATIONS)
+            assignment = np.argmax(vectors @ self.centroids.T, axis=1)
+            self.trained_size = size
+        else:
+            count = 1
+            assignment = np.zeros(size, dtype=np.int64)
+        self.lists = [InvertedList(self.dim) for _ in range(count)]
+        self.locations = {file_id: [] for file_id in self.paths}
+        codes, scales = quantize(vectors)
+        order = np.lexsort((file_ids, assignment))
+        for list_index in np.unique(assignment):
+            rows = order[assignment[order] == list_index]
+            self.lists[list_index].add(codes[rows], scales[rows], file_ids[rows])
+            # rows of a file are contiguous in its list
+            start = 0
+            for file_id, count_in_list in zip(*np.unique(file_ids[rows], return_counts=True)):
+                self.locations[int(file_id)].append(
+                    (int(list_index), range(start, start + int(count_in_list))))
+                start += int(count_in_list)
+        if train:
+            print(f"+++ Window index trained: {size} windows in {count} lists")
+
+    def maintain(self):
+        size = self.size()
+        dead = sum(it.dead() for it in self.lists)
+        if self.centroids is None:
+            if size >= TRAIN_MIN_VECTORS:
+                self.rebuild()
+            elif dead > max(size, TRAIN_MIN_VECTORS):
+                # edits replace a file's windows, drop the old ones now and then
+                self.rebuild(train=False)
+        elif size >= 4 * self.trained_size or dead > size:
+            self.rebuild()
+
+    def sync(self, files, embed_files, complete=False):
+        '''
+        Bring the index up to date with `files`, [[path, content], ...],
+        embedding the windows of new and changed files with
+        `embed_files(contents)`, which returns one array of window vectors
+        per content. With `complete`, indexed files not in `files` are
+        removed. Returns the number of files embedded.
+        '''
+        hashes = {path: hashlib.sha1(content.encode('utf-8')).hexdigest()
+                  for path, content in files}
+        changed = [(path, content) for path, content in files
+                   if self.file_hash(path) != hashes[path]]
+        if complete:
+            for path in [path for path in self.files if path not in hashes]:
+                self.remove_file(path)
+        if changed:
+            for (path, _), vectors in zip(changed, embed_files([it[1] for it in changed])):
+                self.add_file(path, hashes[path], vectors)
+        self.maintain()
+        return len(changed)
+
+    def search(self, query, probes, top_files, paths=None):
+        '''
+        {path: max similarity} of the `top_files` best files in the probed
+        lists, only among `paths` if given.
+        '''
+        import numpy as np
+        query = normalize(np.asarray(query, dtype=np.float32))
+        wanted = None
+        if paths is not None:
+            wanted = np.array([self.files[path][1] for path in paths if path in self.files],
+                              dtype=np.int32)
+        if self.centroids is None:
+            probed = range(len(self.lists))
+        else:
+            probed = np.argsort(-(self.centroids @ query))[:probes]
+        best = dict()
+        for list_index in probed:
+            inverted = self.lists[list_index]
+            if len(inverted.alive) == 0:
+                continue
+            rows = inverted.alive
+            if wanted is not None:
+                rows = rows & np.isin(inverted.file_ids, wanted)
+            scores = (inverted.codes[rows].astype(np.float32) @ query) * inverted.scales[rows]
+            file_ids = inverted.file_ids[rows]
+            if len(scores) == 0:
+                continue
+            # per-file max within the list
+            order = np.lexsort((-scores, file_ids))
+            first = np.ones(len(order), dtype=bool)
+            first[1:] = file_ids[order][1:] != file_ids[order][:-1]
+            for file_id, score in zip(file_ids[order][first], scores[order][first]):
+                file_id = int(file_id)
+                if score > best.get(file_id, -2.0):
+                    best[file_id] = float(score)
+        ranked = sorted(best.items(), key=lambda it: -it[1])[:top_files]
+        return {self.paths[file_id]: score for file_id, score in ranked}
+
+
+indexes = OrderedDict()  # (model id, workspace id) -> WindowIndex
+indexes_lock = threading.Lock()
+
+
+def get_index(model_id, workspace_id, dim):
+    '''The index of a workspace, created on first use; the least recently used beyond MAX_INDEXES are dropped.'''
+    key = (model_id, workspace_id)
+    with indexes_lock:
+        index = indexes.get(key)
+        if index is None or index.dim != dim:
+            index = WindowIndex(dim)
+            indexes[key] = index
+        indexes.move_to_end(key)
+        while len(indexes) > MAX_INDEXES:
+            indexes.popitem(last=False)
+        return index
+
+
+def file_similarity(model_id, workspace_id, query, files, embed_files, complete=False):
+    '''
+    Approximate {path: max cosine similarity to `query`} for the TOP_FILES
+    files of `files` closest to it, keeping the workspace's index in sync.
+    Files indexed for earlier requests but not in `files` are not scored.
+    '''
+    index = get_index(model_id, workspace_id, len(query))
+    with index.lock:
+        embedded = index.sync(files, embed_files, complete)
+        result = index.search(query, PROBES, TOP_FILES, [path for path, _ in files])
+    ann_searches.inc('trained' if index.centroids is not None else 'exact')
+    print(f"+++ Window index: {index.size()} windows, {embedded} files embedded, "
+          f"{len(result)} candidate files")
+    return result
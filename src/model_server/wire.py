@@ -0,0 +1,115 @@
+import gzip
+import json
+from flask import make_response
+
+# Optional fast paths, used when installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Defaults, overridden by the [wire] section of server.ini
+COMPRESS_MIN_BYTES = 1024
+GZIP_LEVEL = 5
+ZSTD_LEVEL = 3
+
+MSGPACK_TYPES = ('application/msgpack', 'application/x-msgpack')
+
+
+class UnsupportedEncoding(ValueError):
+    """The request uses a content encoding or type this server can't read."""
+    pass
+
+
+def configure(config):
+    global COMPRESS_MIN_BYTES, GZIP_LEVEL, ZSTD_LEVEL
+    if not config.has_section('wire'):
+        return
+    section = config['wire']
+    COMPRESS_MIN_BYTES = section.getint('CompressMinBytes', COMPRESS_MIN_BYTES)
+    GZIP_LEVEL = section.getint('GzipLevel', GZIP_LEVEL)
+    ZSTD_LEVEL = section.getint('ZstdLevel', ZSTD_LEVEL)
+
+
+def loads_json(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps_json(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode('utf-8')
+
+
+def decompress(data, encoding):
+    encoding = encoding.strip().lower()
+    if encoding in ('', 'identity'):
+        return data
+    if encoding in ('gzip', 'x-gzip'):
+        return gzip.decompress(data)
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    raise UnsupportedEncoding(f'Content-Encoding {encoding} is not supported.')
+
+
+def decode_request(request):
+    '''
+    Parse the body of a request, honouring Content-Encoding (gzip, zstd) and
+    Content-Type (JSON by default, or MessagePack).
+    '''
+    data = decompress(request.get_data(),
+                      request.headers.get('Content-Encoding', ''))
+    if request.mimetype in MSGPACK_TYPES:
+        if msgpack is None:
+            raise UnsupportedEncoding('MessagePack is not installed on this server.')
+        return msgpack.unpackb(data, raw=False)
+    return loads_json(data)
+
+
+def accepts(header, value):
+    return any(it.split(';')[0].strip() == value for it in header.split(','))
+
+
+def encode_response(request, result, status=200):
+    '''
+    Serialize `result` as MessagePack if the client accepts it, or else as
+    JSON with the text/plain mimetype the extension expects. Large bodies are
+    compressed with zstd or gzip according to Accept-Encoding.
+    '''
+    accept = request.headers.get('Accept', '')
+    if msgpack is not None and any(accepts(accept, it) for it in MSGPACK_TYPES):
+        body = msgpack.packb(result, use_bin_type=True)
+        mimetype = MSGPACK_TYPES[0]
+    else:
+        body = dumps_json(result)
+        mimetype = "text/plain"
+
+    content_encoding = None
+    if len(body) >= COMPRESS_MIN_BYTES:
+        accept_encoding = request.headers.get('Accept-Encoding', '')
+        if zstandard is not None and accepts(accept_encoding, 'zstd'):
+            body = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+            content_encoding = 'zstd'
+        elif accepts(accept_encoding, 'gzip'):
+            body = gzip.compress(body, compresslevel=GZIP_LEVEL)
+            content_encoding = 'gzip'
+
+    response = make_response(body, status)
+    response.mimetype = mimetype
+    if mimetype == "text/plain":
+        response.charset = "utf-8"
+    if content_encoding is not None:
+        response.headers['Content-Encoding'] = content_encoding
+    response.vary.add('Accept')
+    response.vary.add('Accept-Encoding')
+    return response
@@ -0,0 +1,478 @@
+import os
+import gc
+import sys
+import json
+import time
+import signal
+import select
+import threading
+import http.client
+from urllib.parse import quote
+from collections import OrderedDict
+from flask import Flask, request, make_response
+from waitress import serve
+import warmup
+
+MAX_STICKY_SESSIONS = 4096
+# a worker that dies is forked again after this delay, doubled while it
+# keeps dying within HEALTHY_SECONDS of its start
+RESPAWN_MIN_SECONDS = 1
+RESPAWN_MAX_SECONDS = 60
+HEALTHY_SECONDS = 30
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'transfer-encoding',
+                      'te', 'trailer', 'upgrade', 'content-length', 'host'}
+
+
+class Worker:
+    def __init__(self, index, port, languages):
+        self.index = index
+        self.port = port
+        self.languages = languages
+        self.pid = None
+        self.in_flight = 0
+        self.alive = False
+        self.started_at = 0
+        self.restarts = 0
+        self.respawn_delay = RESPAWN_MIN_SECONDS
+
+
+def assign_languages(languages, count, index):
+    '''
+    Spread languages round-robin over the workers for affinity routing. With
+    fewer languages than workers, each language gets several workers.
+    '''
+    if len(languages) == 0:
+        return []
+    if len(languages) >= count:
+        return languages[index::count]
+    return [languages[index % len(languages)]]
+
+
+class WorkerPool:
+    """
+        Pre-fork worker pool. The parent loads the models once, then forks
+        `count` workers that share the weight pages copy-on-write, and itself
+        becomes a front process routing requests to the workers.
+
+        Routing is either `least-loaded` or `language`, which prefers the
+        least loaded worker assigned to the request's language. Requests of
+        one editor session (X-Session-Id) keep going to the same worker, so
+        supersede-and-cancel and the workspace store keep working.
+
+        Workers are forked by a fork server, forked from the parent before it
+        starts serving, and a worker that dies is forked again by it. Its
+        sessions are routed afresh; their workspaces died with it, so
+        clients register them again.
+    """
+
+    def __init__(self, count, base_port, routing, languages, threads_per_worker,
+                 server_threads=4):
+        self.routing = routing
+        self.threads_per_worker = threads_per_worker
+        self.server_threads = server_threads
+        self.workers = []
+        for i in range(count):
+            self.workers.append(Worker(
+                i, base_port + i, assign_languages(languages, count, i)))
+        self._lock = threading.Lock()
+        self._sticky = OrderedDict()
+        self._stopping = False
+        self._commands = None
+        self._fork_server_pid = None
+        self._events = None
+
+    def start(self, app, on_worker_start, host='127.0.0.1'):
+        # objects allocated so far (the models) are never collected, so the
+        # collector won't touch, and thereby copy, their pages in the workers
+        gc.freeze()
+        # Workers are forked by a fork server forked now, while this process
+        # is single-threaded: a fork from the serving front process would
+        # copy locks other threads hold into the worker, held forever.
+        commands_read, self._commands = os.pipe()
+        events_read, events_write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(self._commands)
+            os.close(events_read)
+            try:
+                self._run_fork_server(commands_read, events_write, app, on_worker_start, host)
+            finally:
+                os._exit(0)
+        os.close(commands_read)
+        os.close(events_write)
+        self._fork_server_pid = pid
+        self._events = os.fdopen(events_read, 'r', encoding='utf-8')
+        for worker in self.workers:
+            self._spawn(worker)
+        threading.Thread(target=self._watch, name='worker-watcher', daemon=True).start()
+
+    def _run_fork_server(self, commands, events, app, on_worker_start, host):
+        '''
+        Fork a worker for every index read from `commands`, reap them, and
+        report "started INDEX PID" and "exited INDEX PID STATUS" to `events`.
+        Exit, stopping the workers, once the front process closes `commands`.
+        '''
+        # Ctrl-C stops the front, which then stops the workers
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        children = dict()  # pid -> worker index
+        received = b''
+        while True:
+            ready, _, _ = select.select([commands], [], [], 0.5)
+            if ready:
+                data = os.read(commands, 4096)
+                if len(data) == 0:
+                    break
+                received += data
+                while b'\n' in received:
+                    line, received = received.split(b'\n', 1)
+                    worker = self.workers[int(line)]
+                    pid = os.fork()
+                    if pid == 0:
+                        os.close(commands)
+                        os.close(events)
+                        signal.signal(signal.SIGINT, signal.default_int_handler)
+                        try:
+                            self._run_worker(worker, app, on_worker_start, host)
+                        finally:
+                            os._exit(0)
+                    children[pid] = worker.index
+                    os.write(events, f'started {worker.index} {pid}\n'.encode())
+            while len(children) > 0:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+                if pid == 0:
+                    break
+                index = children.pop(pid, None)
+                if index is not None:
+                    os.write(events, f'exited {index} {pid} {status}\n'.encode())
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    def _spawn(self, worker):
+        try:
+            os.write(self._commands, f'{worker.index}\n'.encode())
+        except OSError as err:
+            print(f"+++ Can't start worker {worker.index}, the fork server is gone: {err}")
+
+    def _run_worker(self, worker, app, on_worker_start, host):
+        import torch
+        if self.threads_per_worker > 0:
+            torch.set_num_threads(self.threads_per_worker)
+        on_worker_start(worker.index)
+        serve(app, host=host, port=worker.port, threads=self.server_threads)
+
+    def _watch(self):
+        '''Follow the fork server's reports on the workers.'''
+        for line in self._events:
+            kind, index, pid, *status = line.split()
+            worker = self.workers[int(index)]
+            if kind == 'started':
+                with self._lock:
+                    worker.pid = int(pid)
+                    worker.alive = True
+                    worker.started_at = time.monotonic()
+                print(f">>> Worker {worker.index} (pid {pid}) serving on port {worker.port}, "
+                      f"languages: {worker.languages}")
+            else:
+                self._on_exit(worker, int(status[0]))
+        _, status = os.waitpid(self._fork_server_pid, 0)
+        if not self._stopping:
+            print(f"+++ Fork server exited with status {status}, workers that die aren't replaced")
+
+    def _on_exit(self, worker, status):
+        with self._lock:
+            worker.alive = False
+            # route the worker's sessions afresh, not to its replacement
+            for session_id in [session_id for session_id, it in self._sticky.items()
+                               if it is worker]:
+                del self._sticky[session_id]
+        print(f">>> Worker {worker.index} (pid {worker.pid}) exited with status {status}")
+        if self._stopping:
+            return
+        if time.monotonic() - worker.started_at >= HEALTHY_SECONDS:
+            worker.respawn_delay = RESPAWN_MIN_SECONDS
+        delay = worker.respawn_delay
+        worker.respawn_delay = min(2 * delay, RESPAWN_MAX_SECONDS)
+        print(f">>> Restarting worker {worker.index} in {delay}s")
+        timer = threading.Timer(delay, self._respawn, (worker,))
+        timer.daemon = True
+        timer.start()
+
+    def _respawn(self, worker):
+        if self._stopping:
+            return
+        worker.restarts += 1
+        self._spawn(worker)
+
+    def stop(self):
+        self._stopping = True
+        for worker in self.workers:
+            if worker.alive:
+                os.kill(worker.pid, signal.SIGTERM)
+        # the fork server exits, stopping any worker it is still starting
+        os.close(self._commands)
+
+    def _choose(self, language):
+        alive = [worker for worker in self.workers if worker.alive]
+        if len(alive) == 0:
+            return None
+        if self.routing == 'language' and language is not None:
+            preferred = [worker for worker in alive if language in worker.languages]
+            if len(preferred) > 0:
+                alive = preferred
+        return min(alive, key=lambda worker: worker.in_flight)
+
+    def acquire(self, session_id, language):
+        with self._lock:
+            worker = self._sticky.get(session_id) if session_id is not None else None
+            if worker is None or not worker.alive:
+                worker = self._choose(language)
+                if worker is None:
+                    return None
+                if session_id is not None:
+                    self._sticky[session_id] = worker
+                    if len(self._sticky) > MAX_STICKY_SESSIONS:
+                        self._sticky.popitem(last=False)
+            if session_id is not None:
+                self._sticky.move_to_end(session_id)
+            worker.in_flight += 1
+            return worker
+
+    def release(self, worker):
+        with self._lock:
+            worker.in_flight -= 1
+
+    def stats(self):
+        with self._lock:
+            return [{"index": worker.index, "pid": worker.pid, "port": worker.port,
+                     "alive": worker.alive, "inFlight": worker.in_flight,
+                     "restarts": worker.restarts,
+                     "languages": worker.languages} for worker in self.workers]
+
+
+def request_language(body):
+    language = request.headers.get('X-Language')
+    if language is None and len(body) > 0:
+        try:
+            language = json.loads(body).get("language")
+        except (ValueError, AttributeError):
+            pass
+    return language
+
+
+def label_samples(text, worker_index, families):
+    '''
+    Add a worker label to every sample of one worker's /metrics output and
+    file the lines under their metric family in `families`, name ->
+    (header lines, sample lines), so each family renders in one piece.
+    '''
+    family = None
+    for line in text.splitlines():
+        if line.startswith('#'):
+            parts = line.split(' ', 3)
+            if len(parts) >= 3 and parts[1] in ('HELP', 'TYPE'):
+                family = families.setdefault(parts[2], ([], []))
+                if line not in family[0]:
+                    family[0].append(line)
+            continue
+        if len(line) == 0:
+            continue
+        name, value = line.rsplit(' ', 1)
+        if name.endswith('}'):
+            name = name[:-1] + f',worker="{worker_index}"}}'
+        else:
+            name = name + f'{{worker="{worker_index}"}}'
+        if family is None:
+            family = families.setdefault(name.split('{', 1)[0], ([], []))
+        family[1].append(f'{name} {value}')
+
+
+def get_from_worker(worker, path, method='GET', body=None, headers=None):
+    connection = http.client.HTTPConnection('127.0.0.1', worker.port, timeout=10)
+    try:
+        connection.request(method, path, body=body, headers=headers or {})
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+
+def make_front_app(pool):
+    front = Flask(__name__)
+
+    @front.route('/healthz', methods=['GET'])
+    def healthz():
+        return make_response("ok", 200)
+
+    @front.route('/readyz', methods=['GET'])
+    def readyz():
+        # ready once every live worker has finished warming up
+        workers = {}
+        all_ready = True
+        for worker in pool.workers:
+            if not worker.alive:
+                continue
+            try:
+                status, body = get_from_worker(worker, '/readyz')
+                workers[worker.index] = json.loads(body)
+            except (OSError, ValueError, http.client.HTTPException) as err:
+                status = 503
+                workers[worker.index] = str(err)
+            all_ready = all_ready and status == 200
+        all_ready = all_ready and len(workers) > 0
+        return make_response({"ready": all_ready, "workers": workers},
+                             200 if all_ready else 503)
+
+    @front.route('/metrics', methods=['GET'])
+    def worker_metrics():
+        # each worker keeps its own metrics, merge them with a worker label
+        families = OrderedDict()
+        for worker in pool.workers:
+            if not worker.alive:
+                continue
+            try:
+                text = get_from_worker(worker, '/metrics')[1].decode('utf-8')
+            except (OSError, http.client.HTTPException):
+                continue
+            label_samples(text, worker.index, families)
+        # the samples of a family must follow its header, unbroken
+        lines = [line for headers, samples in families.values() for line in headers + samples]
+        response = make_response('\n'.join(lines) + '\n', 200)
+        response.headers['Content-Type'] = "text/plain; version=0.0.4; charset=utf-8"
+        return response
+
+    @front.route('/trace/<trace_id>', methods=['GET'])
+    def worker_trace(trace_id):
+        # only the worker that served the request keeps its trace
+        for worker in pool.workers:
+            if not worker.alive:
+                continue
+            try:
+                status, body = get_from_worker(worker, f'/trace/{quote(trace_id, safe="")}')
+            except (OSError, http.client.HTTPException):
+                continue
+            if status == 200:
+                response = make_response(body, 200)
+                response.mimetype = "application/json"
+                return response
+        return make_response(f"No trace kept for request {trace_id}.", 404)
+
+    @front.route('/cache/stats', methods=['GET'])
+    def worker_cache_stats():
+        # each worker has its own result cache
+        workers = dict()
+        for worker in pool.workers:
+            if not worker.alive:
+                continue
+            try:
+                status, body = get_from_worker(worker, '/cache/stats')
+                if status == 200:
+                    workers[worker.index] = json.loads(body)["data"]
+            except (OSError, ValueError, KeyError, http.client.HTTPException):
+                continue
+        stats = [it for it in workers.values() if it is not None]
+        if len(stats) == 0:
+            return make_response({"data": None}, 200)
+        requests = dict()
+        for it in stats:
+            for key, value in it["requests"].items():
+                requests[key] = requests.get(key, 0) + value
+        return make_response({"data": {
+            "entries": sum(it["entries"] for it in stats),
+            "maxEntries": sum(it["maxEntries"] for it in stats),
+            "ttlSeconds": stats[0]["ttlSeconds"],
+            "requests": requests,
+            "workers": workers
+        }}, 200)
+
+    @front.route('/cache/invalidate', methods=['POST'])
+    def worker_cache_invalidate():
+        # every worker's cache may hold the invalidated results
+        body = request.get_data()
+        # the answers are read here, as plain JSON
+        headers = {k: v for k, v in request.headers.items()
+                   if k.lower() not in HOP_BY_HOP_HEADERS | {'accept', 'accept-encoding'}}
+        dropped = 0
+        failed = []
+        for worker in pool.workers:
+            if not worker.alive:
+                continue
+            try:
+                status, answer = get_from_worker(
+                    worker, '/cache/invalidate', 'POST', body, headers)
+                if status != 200:
+                    return make_response(answer, status)
+                dropped += json.loads(answer)["data"]["dropped"]
+            except (OSError, ValueError, KeyError, http.client.HTTPException):
+                failed.append(worker.index)
+        if failed:
+            return make_response(f"Workers {failed} failed to invalidate, dropped {dropped}.", 502)
+        return make_response({"data": {"dropped": dropped}}, 200)
+
+    @front.route('/workers', methods=['GET'])
+    def worker_stats():
+        return make_response({"data": pool.stats()}, 200)
+
+    @front.route('/', defaults={'path': ''}, methods=['GET', 'POST'])
+    @front.route('/<path:path>', methods=['GET', 'POST'])
+    def forward(path):
+        body = request.get_data()
+        language = request_language(body) if pool.routing == 'language' else None
+        worker = pool.acquire(request.headers.get('X-Session-Id'), language)
+        if worker is None:
+            return make_response("No worker available.", 503)
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', worker.port)
+            headers = {k: v for k, v in request.headers.items()
+                       if k.lower() not in HOP_BY_HOP_HEADERS}
+            connection.request(request.method, request.full_path.rstrip('?'),
+                               body=body, headers=headers)
+            upstream = connection.getresponse()
+            response = make_response(upstream.read(), upstream.status)
+            for k, v in upstream.getheaders():
+                if k.lower() not in HOP_BY_HOP_HEADERS:
+                    response.headers[k] = v
+            connection.close()
+            return response
+        except (OSError, http.client.HTTPException) as err:
+            return make_response(f"Worker {worker.index} failed: {err}", 502)
+        finally:
+            pool.release(worker)
+
+    return front
+
+
+def run(app, config, preload_fn, on_worker_start):
+    '''
+    Preload the configured models with `preload_fn(role, language)`, fork the
+    workers serving `app`, and serve the front process on the listen address.
+    Each worker calls `on_worker_start(worker index)` before serving, e.g.
+    to warm up.
+    '''
+    section = config['workers']
+    count = section.getint('Count', 0)
+    languages, roles, _ = warmup.read_config(config)
+    threads_per_worker = section.getint('ThreadsPerWorker', 0)
+    if threads_per_worker <= 0:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // count)
+
+    # Keep the parent single-threaded inside torch: an OpenMP thread pool
+    # started before fork() cannot be used by the children. For the same
+    # reason warm-up passes run in the workers, not here.
+    import torch
+    torch.set_num_threads(1)
+    for language in languages:
+        for role in roles:
+            print(f">>> Preloading {role} for {language}")
+            preload_fn(role, language)
+
+    pool = WorkerPool(count, section.getint('BasePort', 5100),
+                      section.get('Routing', 'least-loaded'), languages, threads_per_worker,
+                      config['DEFAULT'].getint('Threads', 4))
+    pool.start(app, on_worker_start)
+    try:
+        serve(make_front_app(pool), host=config['DEFAULT']['ListenHost'],
+              port=config['DEFAULT']['ListenPort'],
+              threads=section.getint('FrontThreads', 0) or 4 * count)
+    finally:
+        pool.stop()
+    sys.exit(0)
@@ -0,0 +1,259 @@
+import sys
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Defaults, overridden by the [workspace] section of server.ini
+MEMORY_BUDGET_MB = 512
+MAX_WORKSPACES = 64
+
+
+class WorkspaceNotFound(KeyError):
+    """The workspace was never registered or has been evicted; register it again."""
+    pass
+
+
+class HashMismatch(ValueError):
+    """The server copy of some files differs from the client's; resend them in full."""
+
+    def __init__(self, paths):
+        super().__init__(f'Content hash mismatch for: {", ".join(paths)}')
+        self.paths = paths
+
+
+class MalformedChanges(ValueError):
+    """A workspace id, file list, change or edit is missing keys or has values of the wrong type."""
+    pass
+
+
+def content_hash(content):
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def apply_edits(content, edits):
+    '''
+    Apply text edits in order. Each edit replaces `length` characters at
+    `offset` with `text`, like VS Code's TextDocumentContentChangeEvent.
+    Offsets and lengths count Unicode code points, as Python strings do,
+    while VS Code counts UTF-16 code units: past any character outside the
+    Basic Multilingual Plane (e.g. an emoji) clients must convert them, or
+    the result fails the hash check.
+    '''
+    for edit in edits:
+        offset = edit["offset"]
+        content = content[:offset] + edit["text"] + \
+            content[offset + edit["length"]:]
+    return content
+
+
+def is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def check_workspace_id(workspace_id):
+    if not isinstance(workspace_id, str) or len(workspace_id) == 0:
+        raise MalformedChanges('workspaceId must be a non-empty string')
+
+
+def check_files(files):
+    '''Raise MalformedChanges unless `files` is [[path, content], ...] of strings.'''
+    if not isinstance(files, list):
+        raise MalformedChanges('files must be a list')
+    for i, it in enumerate(files):
+        if not isinstance(it, (list, tuple)) or len(it) != 2 or \
+                not isinstance(it[0], str) or not isinstance(it[1], str):
+            raise MalformedChanges(f'file {i} must be [path, content]')
+
+
+def check_changes(changes):
+    '''Raise MalformedChanges unless `changes` is a list of changes as update() takes them.'''
+    if not isinstance(changes, list):
+        raise MalformedChanges('changes must be a list')
+    for i, change in enumerate(changes):
+        if not isinstance(change, dict) or not isinstance(change.get("path"), str):
+            raise MalformedChanges(f'change {i} has no path')
+        if change.get("deleted"):
+            continue
+        if "hash" in change and not isinstance(change["hash"], str):
+            raise MalformedChanges(f'change {i}: hash must be a string')
+        if "content" in change:
+            if not isinstance(change["content"], str):
+                raise MalformedChanges(f'change {i}: content must be a string')
+            continue
+        if not isinstance(change.get("baseHash"), str) or not isinstance(change.get("edits"), list):
+            raise MalformedChanges(f'change {i} needs content, or baseHash and edits')
+        for edit in change["edits"]:
+            if not isinstance(edit, dict) or not is_int(edit.get("offset")) or \
+                    not is_int(edit.get("length")) or not isinstance(edit.get("text"), str) or \
+                    edit["offset"] < 0 or edit["length"] < 0:
+                raise MalformedChanges(
+                    f'change {i}: edits need an offset and length >= 0 and a text')
+
+
+class Workspace:
+    def __init__(self, workspace_id):
+        self.workspace_id = workspace_id
+        self.files = OrderedDict()  # path -> (hash, content)
+        self.size = 0
+
+    def put(self, path, content, expected_hash=None):
+        new_hash = content_hash(content)
+        if expected_hash is not None and new_hash != expected_hash:
+            return False
+        if path in self.files:
+            self.size -= sys.getsizeof(self.files[path][1])
+        self.files[path] = (new_hash, content)
+        self.size += sys.getsizeof(content)
+        return True
+
+    def remove(self, path):
+        if path in self.files:
+            self.size -= sys.getsizeof(self.files.pop(path)[1])
+
+
+class WorkspaceStore:
+    """
+        Keep the authoritative content of client workspaces in memory, so
+        requests only carry hashes and diffs of changed files.
+
+        Workspaces are evicted least recently used first, once there are more
+        than `max_workspaces` or their contents exceed `memory_budget`
+        bytes. The workspace being accessed is never evicted.
+    """
+
+    def __init__(self, memory_budget, max_workspaces):
+        self.memory_budget = memory_budget
+        self.max_workspaces = max_workspaces
+        self._workspaces = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, workspace_id):
+        try:
+            workspace = self._workspaces[workspace_id]
+        except KeyError:
+            raise WorkspaceNotFound(workspace_id)
+        self._workspaces.move_to_end(workspace_id)
+        return workspace
+
+    def _evict(self):
+        total = sum(it.size for it in self._workspaces.values())
+        while len(self._workspaces) > 1 and (
+                total > self.memory_budget or len(self._workspaces) > self.max_workspaces):
+            workspace_id, workspace = self._workspaces.popitem(last=False)
+            total -= workspace.size
+            print(
+                f"+++ Workspace {workspace_id} evicted, {workspace.size} bytes freed")
+
+    def register(self, workspace_id, files):
+        '''Replace the workspace with `files`, [[path, content], ...]. Return path -> hash.'''
+        check_workspace_id(workspace_id)
+        check_files(files)
+        workspace = Workspace(workspace_id)
+        for path, content in files:
+            workspace.put(path, content)
+        with self._lock:
+            self._workspaces[workspace_id] = workspace
+            self._workspaces.move_to_end(workspace_id)
+            self._evict()
+        return {path: it[0] for path, it in workspace.files.items()}
+
+    def update(self, workspace_id, changes):
+        '''
+        Apply per-file changes, each one of:
+            {"path": str, "content": str}                             full content
+            {"path": str, "baseHash": str, "edits": list, "hash": str} diff
+            {"path": str, "deleted": true}
+        `hash`, when given, is checked against the result. Files whose check
+        fails are left unchanged and reported with HashMismatch. Malformed
+        changes raise MalformedChanges before any is applied.
+        '''
+        check_workspace_id(workspace_id)
+        check_changes(changes)
+        mismatched = []
+        with self._lock:
+            workspace = self._get(workspace_id)
+            for change in changes:
+                path = change["path"]
+                if change.get("deleted"):
+                    workspace.remove(path)
+                elif "content" in change:
+                    if not workspace.put(path, change["content"], change.get("hash")):
+                        mismatched.append(path)
+                else:
+                    base = workspace.files.get(path)
+                    if base is None or base[0] != change["baseHash"]:
+                        mismatched.append(path)
+                        continue
+                    content = apply_edits(base[1], change["edits"])
+                    if not workspace.put(path, content, change.get("hash")):
+                        mismatched.append(path)
+            self._evict()
+        if len(mismatched) > 0:
+            raise HashMismatch(mismatched)
+
+    def get_files(self, workspace_id, paths=None):
+        '''Return [[path, content], ...] for `paths`, or for every file.'''
+        with self._lock:
+            workspace = self._get(workspace_id)
+            if paths is None:
+                return [[path, it[1]] for path, it in workspace.files.items()]
+            missing = [path for path in paths if path not in workspace.files]
+            if len(missing) > 0:
+                raise HashMismatch(missing)
+            return [[path, workspace.files[path][1]] for path in paths]
+
+    def get_hashes(self, workspace_id):
+        with self._lock:
+            workspace = self._get(workspace_id)
+            return {path: it[0] for path, it in workspace.files.items()}
+
+    def release(self, workspace_id):
+        check_workspace_id(workspace_id)
+        with self._lock:
+            self._workspaces.pop(workspace_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workspaces": len(self._workspaces),
+                "files": sum(len(it.files) for it in self._workspaces.values()),
+                "bytes": sum(it.size for it in self._workspaces.values()),
+                "budgetBytes": self.memory_budget
+            }
+
+
+store = WorkspaceStore(MEMORY_BUDGET_MB * 1024 * 1024, MAX_WORKSPACES)
+
+
+def configure(config):
+    if not config.has_section('workspace'):
+        return
+    section = config['workspace']
+    store.memory_budget = section.getint(
+        'MemoryBudgetMb', MEMORY_BUDGET_MB) * 1024 * 1024
+    store.max_workspaces = section.getint('MaxWorkspaces', MAX_WORKSPACES)
+
+
+def resolve_files(json_input):
+    '''
+    Fill in the file contents of a predict request that refers to a
+    registered workspace instead of carrying them:
+        "workspace": {"id": str, "changes": [...]}  changes as in update()
+    `files` then comes from the store (`filePaths` narrows it down), and the
+    generator's `targetFileContent` from `targetFilePath`.
+    '''
+    workspace = json_input.get("workspace")
+    if workspace is None:
+        return json_input
+    if not isinstance(workspace, dict) or not isinstance(workspace.get("id"), str):
+        raise MalformedChanges('workspace needs an id')
+    workspace_id = workspace["id"]
+    if len(workspace.get("changes") or []) > 0:
+        store.update(workspace_id, workspace["changes"])
+    if "files" not in json_input:
+        json_input["files"] = store.get_files(
+            workspace_id, json_input.get("filePaths"))
+    if "targetFileContent" not in json_input and "targetFilePath" in json_input:
+        json_input["targetFileContent"] = store.get_files(
+            workspace_id, [json_input["targetFilePath"]])[0][1]
+    return json_input
@@ -2,6 +2,7 @@ import vscode from "vscode";
 import { getRootPath, readGlobFiles, updatePrevEdits, toPosixPath, globalEditDetector } from "./file";
 import { editorState, isLanguageSupported, queryState } from "./global-context";
 import { queryLocationFromModel, queryEditFromModel } from "./queries";
+import { isSuperseded } from "./model-client";
 import { BaseComponent } from "./base-component";
 import { EditSelector, diffTabSelectors, tempWrite } from "./compare-view";
 import { registerCommand } from "./base-component";
@@ -28,6 +29,11 @@ async function predictLocation() {
             await queryLocationFromModel(rootPath, files, currentPrevEdits, commitMessage, editorState.language);
             statusBarItem.setStatusDefault();
         } catch (err) {
+            if (isSuperseded(err)) {
+                // a newer request of this window took over, it updates the status bar
+                console.log("[ModelServer] Request superseded by a newer one");
+                return;
+            }
             console.error(err);
             statusBarItem.setStatusProblem("Some error occured when predicting locations");
             throw err;
@@ -126,6 +132,11 @@ async function predictEdit() {
         await selector.editDocumentAndShowDiff();
         statusBarItem.setStatusDefault();
     } catch (err) {
+        if (isSuperseded(err)) {
+            // a newer request of this window took over, it updates the status bar
+            console.log("[ModelServer] Request superseded by a newer one");
+            return;
+        }
         console.error(err);
         statusBarItem.setStatusProblem("Some error occured when predicting edits");
         throw err;